@@ -1,13 +1,17 @@
-import itertools
+import concurrent.futures
+import hashlib
 import math
 import matplotlib as mpl
 mpl.use('nbagg')
 import matplotlib.pyplot as plt
 import numpy as np
+import os
 import pandas as pd
+import pickle
 import scipy
 import sklearn
 import sklearn.cluster
+import threadpoolctl
 import time
 
 import aux
@@ -17,6 +21,11 @@ import cfg
 
 
 
+# data of a k-means sweep in the current process (see _set_kmeans_data)
+_kmeans_data = None
+
+
+
 def _filter(df, tsk_or_ses, symm):
     ''' filters given df for task/session and symmetric/asymmetric results '''
     if symm: 
@@ -48,8 +57,7 @@ def _add_chi_col(df, col, mea_id):
     thresh = 0 if mea_id in [cfg.MEA_SYN, cfg.MEA_LCON, cfg.MEA_GCON] else -1
     # mark rows based on whether entrainment is present or not
     # does not check for nan (results in -1), filtered out later
-    chi_func = lambda x: 1 if x[col] > thresh else -1
-    df[col + '_chi'] = df.apply(chi_func, axis=1)
+    df[col + '_chi'] = np.where(df[col] > thresh, 1, -1)
     return df
 
 
@@ -143,32 +151,51 @@ def get_samples(df_bt, dict_df_meas, tsk_or_ses='ses', symm=True, nrm=True):
 
 
 def correlate_columns(df):
-    ''' computes correlations between columns of given dataframe '''
-    res = []
-    for i, col1 in enumerate(df.columns):
-        for col2 in df.columns[(i+1):]:
-            r, p = scipy.stats.pearsonr(df[col1], df[col2])
-            res += [(col1, col2, r, p)]
-    return res
+    ''' computes correlations between columns of given dataframe
+
+    all correlations are computed at once as product of the standardized
+    data matrix with itself, p values (two-sided, as scipy.stats.pearsonr)
+    from the t distribution; columns with constant values yield nan
+
+    returns:
+        list of tuples of both columns, pearson's r, and p value, for all 
+        pairs of columns in order
+    '''
+    X = df.values.astype(float)
+    n = len(X)
+    X = X - X.mean(axis=0)
+    norms = np.sqrt((X**2).sum(axis=0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X = X / norms
+        R = np.clip(X.T @ X, -1.0, 1.0)
+        R[:, norms == 0] = np.nan
+        R[norms == 0, :] = np.nan
+        T = R * np.sqrt((n - 2) / (1 - R**2))
+    P = 2 * scipy.stats.t.sf(np.abs(T), n - 2)
+    rows, cols = np.triu_indices(len(df.columns), 1)
+    return [(df.columns[i], df.columns[j], R[i, j], P[i, j])
+            for i, j in zip(rows, cols)]
 
 
 def chisquare(df, vals1=[-1,1], vals2=[-1,1], verbosity=0, min_obs=5):
-    ''' runs chisquare for pairs of columns of df, grouped by given values '''
+    ''' runs chisquare for pairs of columns of df, grouped by given values
+
+    contingency tables of all pairs of columns are counted at once: one 
+    indicator (0/1) matrix per value, the product of the indicator matrices
+    of two values counts co-occurrences of those values for all pairs
+    '''
     assert verbosity in [0,1], 'verbosity must be 0 or 1'
+    cols = [col for col in df.columns if col != '_']
+    ind = {v: (df[cols].values == v).astype(float) for v in set(vals1+vals2)}
+    # counts per value of first column, value of second column, column pair
+    cnts = np.array([[ind[v1].T @ ind[v2] for v2 in vals2] for v1 in vals1])
     res = []
-    for i, col1 in enumerate(df.columns):
-        for col2 in df.columns[(i+1):]:
-            if col1 == '_' or col2 == '_':
-                continue
-            # get observed frequencies
-            # 1) count co-occurrences for current pair of measures
-            df_cnts = df.groupby([col1, col2]).count().iloc[:,0]
-            # 2) reindex in case some combination did not occur
-            df_cnts = df_cnts.reindex(
-                itertools.product(vals1, vals2), fill_value=0)
-            obs = np.array(df_cnts).reshape(len(vals1), -1)
+    for i, col1 in enumerate(cols):
+        for j in range(i+1, len(cols)):
+            col2 = cols[j]
+            obs = cnts[:, :, i, j].astype(int)
             # run chisquare if enough observations of each combination exist
-            if min(obs.reshape(-1, 1)) < min_obs:
+            if obs.min() < min_obs:
                 res += [(col1, col2) + (float('nan'), float('nan'))]
             else:
                 chi2 = scipy.stats.contingency.chi2_contingency(obs) 
@@ -191,55 +218,240 @@ def bh(res, p_id=3, alpha1=0.05, alpha2=0.1):
     return res[:k1], res[k1:k2], res[k2:]
 
 
-def kmeans(df, max_k, n_init):
+def _shuffle_replicates(X, n_rep, rng):
+    ''' returns n_rep copies of X, each column independently permuted
+
+    returns:
+        numpy array of shape (n_rep,) + X.shape
+    '''
+    X = np.asarray(X, dtype=float)
+    return rng.permuted(np.broadcast_to(X, (n_rep,) + X.shape), axis=1)
+
+
+def _gaussian_replicates(X, n_rep, rng):
+    ''' returns n_rep normal samples like X (column-wise mean and std)
+
+    returns:
+        numpy array of shape (n_rep,) + X.shape
+    '''
+    X = np.asarray(X, dtype=float)
+    return rng.normal(X.mean(axis=0), X.std(axis=0, ddof=1),
+                      (n_rep,) + X.shape)
+
+
+def _set_kmeans_data(Xs, sil_sample, seed):
+    ''' sets the data of all variants for _fit_kmeans in this process '''
+    global _kmeans_data
+    # distance matrix of the last variant for the silhouette (one at a time,
+    # there can be many variants)
+    _kmeans_data = {
+        'Xs': Xs, 'sil_sample': sil_sample, 'seed': seed, 'D': (None, None)}
+
+
+def _init_kmeans_worker(Xs, sil_sample, seed):
+    ''' initializes worker process for _fit_kmeans (see _set_kmeans_data) '''
+    # one thread per process, parallelism comes from the processes
+    threadpoolctl.threadpool_limits(1)
+    _set_kmeans_data(Xs, sil_sample, seed)
+
+
+def _fit_kmeans(i, k, n_init, keep=True):
+    ''' fits k-means with k clusters to data variant i and scores it
+
+    silhouette is computed from a distance matrix computed once per variant
+    and process, or on a random sample of sil_sample rows if given
+    (see _init_kmeans_worker); the fitted model is returned only if keep
+    '''
+    X = _kmeans_data['Xs'][i]
+    seed = _kmeans_data['seed']
+    kmeans = sklearn.cluster.KMeans(
+        n_clusters=k, n_init=n_init, random_state=seed + k).fit(X)
+    # labels_ are the predictions for the training data, no need to predict
+    labels = kmeans.labels_
+    if _kmeans_data['sil_sample'] is None:
+        if _kmeans_data['D'][0] != i:
+            _kmeans_data['D'] = (i, sklearn.metrics.pairwise_distances(X))
+        sil = sklearn.metrics.silhouette_score(
+            _kmeans_data['D'][1], labels, metric='precomputed')
+    else:
+        sil = sklearn.metrics.silhouette_score(
+            X, labels, sample_size=min(_kmeans_data['sil_sample'], len(X)),
+            random_state=seed)
+    ch = sklearn.metrics.calinski_harabasz_score(X, labels)
+    # inertia_ is the negated score on the training data
+    return i, k, kmeans if keep else None, kmeans.inertia_, sil, ch
+
+
+def _get_data_id(df):
+    ''' returns shape and hash of the raw values of given dataframe, which
+    identify the data of a k-means sweep (variants are derived with a seed) '''
+    X = np.ascontiguousarray(df.values, dtype=float)
+    return X.shape, hashlib.md5(X.tobytes()).hexdigest()
+
+
+def _kmeans_sweep(Xs, names, data_id, max_k, n_init, n_jobs, sil_sample,
+                  checkpoint, seed, keep):
+    ''' fits and scores k-means for k = 2..max_k on all given data variants
+
+    all fits run in parallel processes (n_jobs 1: in this process); finished
+    fits are checkpointed to a pickle file if given and an interrupted sweep
+    with the same data, variants, and parameters resumes from there
+
+    args:
+        Xs: list of standardized data variants (numpy arrays)
+        names: name per variant for progress messages (and checkpoints)
+        data_id: identifies the raw data the variants are derived from (see
+            _get_data_id), checkpoints are only resumed for the same data
+        keep: whether to keep fitted models (for variant i if keep(i))
+        (others see kmeans)
+    returns:
+        dict with tuple of model (or None), distance, silhouette and calinski
+        harabasz score per tuple of variant index and k
+    '''
+    global _kmeans_data
+    def __save(fits):
+        with open(checkpoint + '.tmp', 'wb') as pickle_file:
+            pickle.dump((params, fits), pickle_file)
+        os.replace(checkpoint + '.tmp', checkpoint)
+
+    # variants by name and whether models are kept (fits without models
+    # cannot be resumed by a sweep that keeps them, e.g., kmeans_null's)
+    params = (data_id, tuple(names), tuple(keep(i) for i in range(len(Xs))),
+              n_init, sil_sample, seed)
+    fits = {}
+    if checkpoint is not None and os.path.isfile(checkpoint):
+        with open(checkpoint, 'rb') as pickle_file:
+            params_old, fits_old = pickle.load(pickle_file)
+        if params_old == params:
+            fits = fits_old
+            print('resuming with %d finished fits' % len(fits))
+    # per variant, largest k first (those take longest); variants in order so
+    # that each process needs few distance matrices
+    todo = [(i, k) for i in range(len(Xs)) for k in range(max_k, 1, -1)
+            if (i, k) not in fits]
+    def __done(res):
+        i, k = res[:2]
+        fits[(i, k)] = res[2:]
+        print('finished %s data, k=%d at %s' % (names[i], k, time.ctime()))
+        if checkpoint is not None:
+            __save(fits)
+    if n_jobs == 1:
+        # as in a worker process, but thread limit and data (including the
+        # distance matrix) only for the duration of the sweep
+        with threadpoolctl.threadpool_limits(1):
+            try:
+                _set_kmeans_data(Xs, sil_sample, seed)
+                for i, k in todo:
+                    __done(_fit_kmeans(i, k, n_init, keep(i)))
+            finally:
+                _kmeans_data = None
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_kmeans_worker,
+                initargs=(Xs, sil_sample, seed)) as executor:
+            futures = [executor.submit(_fit_kmeans, i, k, n_init, keep(i))
+                       for i, k in todo]
+            for future in concurrent.futures.as_completed(futures):
+                __done(future.result())
+    return fits
+
+
+def kmeans(df, max_k, n_init, n_jobs=None, sil_sample=None, checkpoint=None,
+           seed=0):
     """ computes k-means score for given dataframe and controls for varying k
+
+    all values of k for all three data variants (real, shuffled, random) are
+    fitted in parallel processes; finished fits can be checkpointed to a
+    file, so an interrupted sweep resumes where it stopped
     
     args:
         df: dataframe with data for clustering, 
             one sample per row, one dimension per column
         max_k: maximum k to try, 2 up to max_k (inclusive) will be tried
         n_init: number of initializations per value of k
+        n_jobs: number of processes (default: number of cpus; 1 runs all fits
+            in this process)
+        sil_sample: if given, silhouette scores are computed on a random
+            sample of this many rows instead of all (quadratic cost)
+        checkpoint: pickle file for finished fits, loaded (if it exists and
+            matches given data and parameters) and updated after each fit
+        seed: random seed for data variants, k-means, and sampling
     returns:
         list of three dicts with best results
     """
-    def __run_clustering(X, max_k, n_init):
-        X = sklearn.preprocessing.StandardScaler().fit_transform(X)
+    rng = np.random.default_rng(seed)
+    Xs = [df.values, _shuffle_replicates(df.values, 1, rng)[0],
+          _gaussian_replicates(df.values, 1, rng)[0]]
+    Xs = [sklearn.preprocessing.StandardScaler().fit_transform(X) for X in Xs]
+    fits = _kmeans_sweep(Xs, ['real', 'shuffled', 'random'], _get_data_id(df),
+                         max_k, n_init, n_jobs, sil_sample, checkpoint, seed,
+                         lambda i: True)
+    res = []
+    for i in range(len(Xs)):
         results = {'kmeans': [], 'dist': [], 'sil': [], 'ch': []}
         for k in range(2, max_k+1):
-            print('starting k=%d at %s' % (k, time.ctime()))
-            kmeans = sklearn.cluster.KMeans(n_clusters=k, n_init=n_init).fit(X)
-            results['kmeans'].append(kmeans)
-            results['dist'].append(-kmeans.score(X))
-            results['sil'].append(
-                sklearn.metrics.silhouette_score(X, kmeans.predict(X)))
-            results['ch'].append(
-                sklearn.metrics.calinski_harabasz_score(X, kmeans.predict(X)))
-        return results
-    
-    def __shuffle_columns(df):
-        rng = np.random.default_rng(0)
-        return list(zip(*[rng.permutation(df.iloc[:,i].values)
-                          for i in range(len(df.columns))]))
-    
-    def __gen_random_data_like(df):
-        means = df.mean().values
-        stds = df.std().values
-        out_data = []
-        rng = np.random.default_rng(0)
-        for i in range(len(df)):
-            sample = []
-            for j in range(len(means)):
-                sample.append(rng.normal(means[j], stds[j]))
-            out_data.append(sample)
-        return out_data
+            for key, val in zip(['kmeans', 'dist', 'sil', 'ch'], fits[(i, k)]):
+                results[key].append(val)
+        res.append(results)
+    return res
+
+
+def kmeans_null(df, max_k, n_init, n_rep=20, n_jobs=None, sil_sample=None,
+                checkpoint=None, seed=0, percentiles=(2.5, 97.5)):
+    """ compares k-means scores of given data to null distributions
+
+    like kmeans, but with n_rep replicates each of shuffled data (columns
+    permuted independently, no structure between dimensions) and random data
+    (normal distribution with the same column-wise mean and std), drawn at
+    once and clustered in parallel; besides score envelopes, the gap
+    statistic (tibshirani et al., 2001) is computed per null distribution:
+    gap = mean(log(dist_null)) - log(dist_real), with standard error
+    gap_sd = std(log(dist_null)) * sqrt(1 + 1/n_rep); the smallest k with
+    gap(k) >= gap(k+1) - gap_sd(k+1) is a common choice for k
     
-    res = []
-    print('clustering real data')
-    res.append(__run_clustering(df.values, max_k, n_init))
-    print('clustering shuffled data')
-    res.append(__run_clustering(__shuffle_columns(df), max_k, n_init))
-    print('clustering random data')
-    res.append(__run_clustering(__gen_random_data_like(df), max_k, n_init))
+    args:
+        df: dataframe with data for clustering, 
+            one sample per row, one dimension per column
+        max_k: maximum k to try, 2 up to max_k (inclusive) will be tried
+        n_init: number of initializations per value of k
+        n_rep: number of replicates per null distribution
+        percentiles: lower and upper percentile of the null envelopes
+        (others see kmeans)
+    returns:
+        dict with pandas dataframe per null distribution ("shuffled",
+        "random"), indexed by k, with real score (dist, sil, ch) and the mean,
+        lower and upper percentile of the null distribution (suffixes _mean,
+        _lo, _hi) per score, and gap and gap_sd
+    """
+    rng = np.random.default_rng(seed)
+    nulls = {'shuffled': _shuffle_replicates(df.values, n_rep, rng),
+             'random': _gaussian_replicates(df.values, n_rep, rng)}
+    Xs = [df.values] + [X for X_null in nulls.values() for X in X_null]
+    Xs = [sklearn.preprocessing.StandardScaler().fit_transform(X) for X in Xs]
+    names = ['real'] + ['%s %d' % (null, r) for null in nulls
+                        for r in range(n_rep)]
+    fits = _kmeans_sweep(Xs, names, _get_data_id(df), max_k, n_init, n_jobs,
+                         sil_sample, checkpoint, seed, lambda i: False)
+    ks = list(range(2, max_k+1))
+    # scores per variant (rows) and k (columns)
+    scores = {}
+    for j, col in enumerate(['dist', 'sil', 'ch']):
+        scores[col] = np.array(
+            [[fits[(i, k)][j+1] for k in ks] for i in range(len(Xs))])
+    res = {}
+    for n, null in enumerate(nulls):
+        fltr = slice(1 + n * n_rep, 1 + (n+1) * n_rep)
+        df_null = pd.DataFrame(index=pd.Index(ks, name='k'))
+        for col in ['dist', 'sil', 'ch']:
+            vals = scores[col][fltr]
+            df_null[col] = scores[col][0]
+            df_null[col + '_mean'] = vals.mean(axis=0)
+            df_null[col + '_lo'], df_null[col + '_hi'] = np.percentile(
+                vals, percentiles, axis=0)
+        log_dist = np.log(scores['dist'][fltr])
+        df_null['gap'] = log_dist.mean(axis=0) - np.log(scores['dist'][0])
+        df_null['gap_sd'] = log_dist.std(axis=0) * math.sqrt(1 + 1 / n_rep)
+        res[null] = df_null
     return res
 
 
@@ -273,6 +485,39 @@ def plot_kmeans_scores(scores, col):
     plt.close()
 
 
+def plot_kmeans_null(null, col):
+    ''' plots real score and null envelope per k (results of kmeans_null) '''
+    y_label = {
+        'dist': 'sum of distances', 'sil': 'silhouette score',
+        'ch': 'calinski harabasz score', 'gap': 'gap statistic'
+    }.get(col, 'unknown')
+
+    fig, ax = plt.subplots()
+    for (name, df), color in zip(null.items(), ['r', 'g']):
+        x = df.index
+        if col == 'gap':
+            ax.errorbar(x, df['gap'], df['gap_sd'], fmt='-' + color,
+                        label=name)
+            continue
+        ax.plot(x, df[col + '_mean'], '--' + color, label=name + ' (mean)')
+        ax.fill_between(x, df[col + '_lo'], df[col + '_hi'], color=color,
+                        alpha=0.2)
+    if col != 'gap':
+        ax.plot(x, df[col], 'b', label='real')
+
+    fig.set_size_inches(5, 5)
+    plt.tick_params(
+        axis='both', which='major', labelsize=17)
+    plt.xlabel('K', fontsize=16)
+    plt.ylabel(y_label, fontsize=16)
+    plt.legend(prop={'size': 15})
+
+    plt.grid()
+    plt.tight_layout()
+    plt.show()
+    plt.close()
+
+
 def pca(df):
     ''' runs pca on given dataframe of samples, produces 3d plot '''
     X = sklearn.preprocessing.StandardScaler().fit_transform(df.values)
@@ -1,6 +1,8 @@
 import itertools
 import numpy as np
 import pandas as pd
+import scipy.sparse
+import scipy.stats
 
 import aux
 import cfg
@@ -18,12 +20,68 @@ import fio
 ################################################################################
 # auxiliary functions used only internally within this module
 
-def _normalize_features(df, nrm_type):
+def _get_moments(grps, X):
+    ''' computes count, mean, and sum of squared deviations per group
+
+    all groups and columns are computed in one pass, as a single product of
+    a sparse group indicator matrix with the (shifted) values and squares
+
+    args:
+        grps: numpy array with group (0 to number of groups - 1) per row
+        X: numpy array with values per row and column (nan if missing)
+    returns:
+        tuple of numpy arrays n, mean, and m2 per group (rows) and column
+    '''
+    valid = ~np.isnan(X)
+    # values shifted by column means for numerically stable sums of squares
+    with np.errstate(invalid='ignore'):
+        shift = np.nan_to_num(np.nanmean(np.where(valid, X, np.nan), axis=0))
+    X0 = np.where(valid, X - shift, 0.0)
+    ind = scipy.sparse.csr_matrix(
+        (np.ones(len(grps)), (np.arange(len(grps)), grps)))
+    sums = ind.T @ np.hstack([valid, X0, X0**2])
+    n, s1, s2 = np.split(sums, 3, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = shift + s1 / n
+        m2 = np.maximum(s2 - s1**2 / n, 0.0)
+    return n, mean, m2
+
+
+def _merge_moments(grps, n, mean, m2):
+    ''' merges moments (see _get_moments) of parts per group
+
+    (parallel variant of welford's algorithm: m2 of a group is the sum of the
+    parts' m2 and the parts' squared mean deviations from the group mean)
+
+    args:
+        grps: numpy array with group (0 to number of groups - 1) per part
+        n, mean, m2: numpy arrays with moments per part (rows) and column
+    returns:
+        tuple of numpy arrays n, mean, and m2 per group (rows) and column
+    '''
+    ind = scipy.sparse.csr_matrix(
+        (np.ones(len(grps)), (np.arange(len(grps)), grps))).T
+    mean = np.where(n > 0, mean, 0.0)
+    n_grp = ind @ n
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_grp = (ind @ (n * mean)) / n_grp
+        m2_grp = ind @ (np.where(n > 0, m2, 0.0)
+                        + n * (mean - np.nan_to_num(mean_grp[grps]))**2)
+    return n_grp, mean_grp, m2_grp
+
+
+def _normalize_features(df, nrm_type, df_stats=None):
     ''' normalizes features in given dataframe in specified way 
 
+    means and standard deviations per speaker or gender are computed in one
+    grouped pass over all features (or taken from given statistics) and
+    applied as a broadcast over the feature matrix
+
     args:
         df: pandas dataframe with a "*_raw" column per feature
         nrm_type: how to normalize features (see cfg.NRM_TYPES)
+        df_stats: statistics as returned by get_feature_stats, computed from
+            df if None
     returns:
         input dataframe, with new columns with normalized features,
         "*_raw" columns removed
@@ -35,21 +93,25 @@ def _normalize_features(df, nrm_type):
     else:    
         # determine mean and standard deviation per speaker or gender
         grp_col = 'spk_id' if nrm_type == cfg.NRM_SPK else 'gender'
-        df_raw = df.loc[:, [grp_col] + ['%s_raw' % f for f in cfg.FEATURES]]
-        df_means = df_raw.groupby([grp_col]).mean()
-        df_means.rename(
-            columns={c:c[:-4] + '_mean' for c in df_means.columns}, 
-            inplace=True)
-        df = df.join(df_means, on=grp_col)
-        df_stds = df_raw.groupby([grp_col]).std()
-        df_stds.rename(
-            columns={c:c[:-4] + '_std' for c in df_stds.columns}, inplace=True)
-        df = df.join(df_stds, on=grp_col)
+        X = df[['%s_raw' % f for f in cfg.FEATURES]].values.astype(float)
+        if df_stats is None:
+            grps, _ = pd.factorize(df[grp_col])
+            n, means, m2 = _get_moments(grps[grps >= 0], X[grps >= 0])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stds = np.sqrt(m2 / (n - 1))
+        else:
+            grps = df_stats.index.get_indexer(df[grp_col])
+            means = df_stats[[f + '_mean' for f in cfg.FEATURES]].values
+            stds = df_stats[[f + '_std' for f in cfg.FEATURES]].values
+        # extra row of nan for rows without (known) group (index -1)
+        nans = np.full((1, len(cfg.FEATURES)), np.nan)
+        means = np.vstack([means, nans])[grps]
+        stds = np.vstack([stds, nans])[grps]
         # z-score normalize based on means and standard deviations
-        for f in cfg.FEATURES:
-            df_zf = (df[f + '_raw'] - df[f + '_mean']) / df[f + '_std']
-            df_zf.name = f
-            df = df.join(df_zf)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            X = (X - means) / stds
+        for i, f in enumerate(cfg.FEATURES):
+            df[f] = X[:, i]
     # remove columns with raw features and feature stats
     cols = [[f + '_raw', f + '_mean', f + '_std'] for f in cfg.FEATURES_ALL]
     cols = list(itertools.chain(*cols))
@@ -57,17 +119,62 @@ def _normalize_features(df, nrm_type):
     return df
 
 
-def _join_task_data(df):
+def _gather(vals, idx):
+    ''' returns rows of vals at given indices, nan for index -1 (not found) '''
+    return np.vstack([vals, np.full((1,) + vals.shape[1:], np.nan)])[idx]
+
+
+def _create_moments_table():
+    ''' creates the table holding raw feature moments, if needed '''
+    db.dbc.execute(
+        'CREATE TABLE IF NOT EXISTS feature_moments (\n'
+        '    ses_id   INTEGER NOT NULL,\n'
+        '    spk_id   INTEGER NOT NULL,\n'
+        '    feature  TEXT NOT NULL,\n'
+        '    n        INTEGER NOT NULL,\n'
+        '    mean     NUMERIC,\n'
+        '    m2       NUMERIC,\n'
+        '    PRIMARY KEY (ses_id, spk_id, feature)\n'
+        ');')
+
+
+def _check_complete():
+    ''' recomputes the flags of chunks with all analyzed features if these
+    changed (see db.set_complete), and the chunk pairs and feature moments 
+    (if stored) of the sessions with changed flags '''
+    ses_ids = db.set_complete()
+    db.commit()
+    if len(ses_ids) == 0:
+        return
+    print('analyzed features changed, updating %d sessions' % len(ses_ids))
+    db.dbc.execute(
+        'CREATE TABLE IF NOT EXISTS ses_todo (\n'
+        '    ses_id    INTEGER NOT NULL,\n'
+        '    PRIMARY KEY (ses_id)\n'
+        ');')
+    db.dbc.executemany('INSERT OR IGNORE INTO ses_todo (ses_id) VALUES (?);',
+                       [(ses_id,) for ses_id in ses_ids])
+    db.executescript(cfg.SQL_PATH, cfg.SQL_AT_FNAME)
+    _create_moments_table()
+    if len(db.dbc.execute(
+            'SELECT 1 FROM feature_moments LIMIT 1;').fetchall()) > 0:
+        store_feature_stats(ses_ids)
+    db.commit()
+
+
+def _join_task_data(df, df_tsk=None):
     ''' loads task meta-data and joins them to given dataframe
 
     args:
         df: pandas dataframe with a "tsk_id" column
+        df_tsk: task meta-data (table tasks), loaded if None
     returns:
         input dataframe with new, added task meta-data columns
     '''
-    df_tsk = db.pd_read_sql_query('SELECT * FROM tasks')
-    df_tsk.drop(['ses_id', 'task_index', 'a_or_b'], axis=1, inplace=True)
-    df_tsk.set_index('tsk_id', inplace=True)
+    if df_tsk is None:
+        df_tsk = db.pd_read_sql_query('SELECT * FROM tasks')
+    df_tsk = df_tsk.drop(['ses_id', 'task_index', 'a_or_b'], axis=1)
+    df_tsk = df_tsk.set_index('tsk_id')
     return df.join(df_tsk, on='tsk_id')
 
 
@@ -87,132 +194,675 @@ def _compute_sims(df, extra_cols=[]):
     return df
 
 
-def _load_pairs(df, extra_cols=[]):
-    ''' loads chunk pairs and joins with given data, features, and extra columns
+def _get_pair_rows(df, df_pairs=None):
+    ''' loads chunk pairs and determines the rows of data joined with them
+
+    args:
+        df: pandas dataframe with one row per chunk ("chu_id" column)
+        df_pairs: chunk pairs of the chunks in df (p_or_x, chu_id1, chu_id2,
+            rid; e.g., as returned by db.get_chunk_pairs), all loaded if None
+    returns:
+        pandas dataframe with one row per row of the joined data (see
+        _load_pairs): position of the row of its (turn-initial) chunk in df
+        ("row") and the pair (p_or_x, chu_id1, rid; nan if the chunk has none)
+    '''
+    # pairs of chunk ids (adjacent and non-adjacent turn exchange chunks)
+    if df_pairs is None:
+        df_pairs = db.pd_read_sql_query(
+            'SELECT p_or_x, chu_id1, chu_id2, rid FROM chunk_pairs')
+    df_rows = pd.DataFrame(
+        {'chu_id': df['chu_id'].values, 'row': np.arange(len(df))})
+    df_rows = df_rows.join(df_pairs.set_index('chu_id2'), on='chu_id')
+    return df_rows.drop('chu_id', axis=1).reset_index(drop=True)
+
+
+def _load_pairs(df, extra_cols=[], df_rows=None):
+    ''' joins chunk pairs with given data, features, and extra columns
 
     args:
         df: pandas dataframe with normalized features per chunk
         extra_paired_cols: extra columns, in addition to features, to include 
             regarding paired chunks
+        df_rows: rows of the joined data as returned by _get_pair_rows
+            (determined from df if None)
     returns:
         pandas dataframe with chunk pairs (with features) per row 
     '''
-    # tmp1: pairs of chunk ids (adjacent and non-adjacent turn exchange chunks)
-    tmp1 = db.pd_read_sql_query(
-        'SELECT p_or_x, chu_id1, chu_id2, rid FROM chunk_pairs')
+    if df_rows is None:
+        df_rows = _get_pair_rows(df)
     # tmp2: all chu_ids with respective feature values and extra columns
     loc_cols = ['chu_id'] + cfg.FEATURES + extra_cols
     tmp2 = df.loc[:, loc_cols].set_index('chu_id')
-    # tmp3: df joined with pairs -> df with second, turn-final, paired chu_id
-    tmp3 = df.join(tmp1.set_index('chu_id2'), on='chu_id')
+    # tmp3: df rows per pair -> df with second, turn-final, paired chu_id
+    tmp3 = df.iloc[df_rows['row'].values].reset_index(drop=True)
+    for col in ['p_or_x', 'chu_id1', 'rid']:
+        tmp3[col] = df_rows[col].values
     # final step: full df data joined with features of paired, turn-final chu_id
     df = tmp3.join(tmp2, rsuffix='_paired', on='chu_id1')
     df.rename(columns={'chu_id1': 'chu_id_paired'}, inplace=True)
-    # reset to running index
-    df.reset_index(drop=True, inplace=True)
     # add columns for similarity between paired chunks for all features
     df = _compute_sims(df)
     return df
 
 
 
+def _get_grp_matrix(df, keys, cols):
+    ''' determines which rows of df belong to which results, for perm tests
+
+    args:
+        df: pandas dataframe with given columns
+        keys: list of result keys, tuples with one value per column, where 0
+            means "all" (as in result dataframe indices)
+        cols: columns with values corresponding to key components
+    returns:
+        scipy sparse matrix, 1 if row of df (row) belongs to key (column)
+    '''
+    idx_keys = pd.MultiIndex.from_tuples(keys)
+    rows = []
+    grps = []
+    # rows are matched once per pattern of "all" components in keys
+    for zeros in set(tuple(v == 0 for v in key) for key in keys):
+        vals = [np.zeros(len(df), dtype=int) if z else df[c].values
+                for c, z in zip(cols, zeros)]
+        codes = idx_keys.get_indexer(pd.MultiIndex.from_arrays(vals))
+        rows += [np.nonzero(codes >= 0)[0]]
+        grps += [codes[codes >= 0]]
+    rows = np.concatenate(rows)
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, np.concatenate(grps))),
+        shape=(len(df), len(keys)))
+
+
+def _shift_paired(rng, n, f, f_paired, sim_x, start, length, pos, ses, n_ses):
+    ''' null values for aux.perm_test: lsim with time-shifted paired chunks
+
+    per permutation and session, the sequence of paired (turn-final) chunks
+    is shifted circularly by a random offset against the turn-initial chunks
+
+    args:
+        rng: numpy random generator
+        n: number of permutations
+        f, f_paired, sim_x: numpy arrays with feature values of turn-initial
+            and paired chunks and non-adjacent similarities, per row
+        start, length, pos: numpy arrays with first row and number of rows
+            of the session of each row, and the position of the row in it
+        ses: numpy array with session (0 to n_ses - 1) per row
+    returns:
+        numpy array of differences between time-shifted similarities and
+        non-adjacent similarities per permutation (rows) and row (columns)
+    '''
+    length_ses = np.zeros(n_ses, dtype=int)
+    length_ses[ses] = length
+    offs = rng.integers(1, np.maximum(length_ses, 2), (n, n_ses))
+    idx = start + (pos + offs[:, ses]) % length
+    return -abs(f - f_paired[idx]) - sim_x
+
+
+def _sum_groups(grps, X):
+    ''' sums rows of X per group (0 to number of groups - 1) '''
+    ind = scipy.sparse.csr_matrix(
+        (np.ones(len(grps)), (np.arange(len(grps)), grps)))
+    return ind.T @ X
+
+
+def _rollup(df_keys, X, grp_by):
+    ''' sums values per group for all given grouping levels at once
+
+    like sql grouping sets: values are summed once per task and speaker (the
+    finest level) and all coarser levels are derived from these sums, so
+    that computing all levels costs about as much as computing one
+
+    args:
+        df_keys: pandas dataframe with ses_type, ses_id, tsk_id, and spk_id
+            per row of X
+        X: numpy array with values (no nan) per row and column
+        grp_by: list of constants from cfg.GRP_BYS
+    returns:
+        tuple of list of keys (ses_type, ses_id, tsk_id, spk_id; 0 for "all")
+        and numpy array with sums per key (rows) and column
+    '''
+    key_cols = cfg.GRP_BY_COLS[cfg.GRP_BY_TSK_SPK]
+    grps = df_keys.groupby(key_cols).ngroup().values
+    df_fine = df_keys[key_cols].iloc[np.unique(grps, return_index=True)[1]]
+    sums_fine = _sum_groups(grps, X)
+    keys = []
+    sums = []
+    for g in [g for g in cfg.GRP_BYS if g in grp_by]:
+        cols = cfg.GRP_BY_COLS[g]
+        grps = df_fine.groupby(cols).ngroup().values
+        df_lvl = df_fine.iloc[np.unique(grps, return_index=True)[1]]
+        keys += [tuple(v if c in cols else 0 for c, v in zip(key_cols, row))
+                 for row in df_lvl.itertuples(index=False)]
+        sums += [_sum_groups(grps, sums_fine)]
+    return keys, np.vstack(sums)
+
+
+def _get_key_sums(df_keys, sums):
+    ''' returns sums per task and speaker as dataframe indexed by key columns
+
+    args:
+        df_keys: pandas dataframe with ses_type, ses_id, tsk_id, and spk_id
+            per row of sums
+        sums: numpy array with sums per row
+    '''
+    key_cols = cfg.GRP_BY_COLS[cfg.GRP_BY_TSK_SPK]
+    df = pd.DataFrame(sums, index=pd.MultiIndex.from_frame(df_keys[key_cols]))
+    return df.groupby(level=key_cols).sum()
+
+
+def _ttest_rel_sums(n, s, ss, shift):
+    ''' aux.ttest_rel (t-statistic and p-value) from sums of differences
+
+    args:
+        n, s, ss: numpy arrays with count, sum, and sum of squares of the
+            differences, shifted by given shift (for numerical stability)
+    returns:
+        tuple of numpy arrays with t-statistic and p-value
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        m2 = ss - s**2 / n
+        # constant differences (t-statistic infinite or undefined)
+        m2[m2 <= 1e-12 * ss] = 0.0
+        t = (shift + s / n) / np.sqrt(m2 / (n - 1) / n)
+    return t, 2 * scipy.stats.t.sf(np.abs(t), n - 1)
+
+
+
 ################################################################################
 #                                MAIN FUNCTIONS                                #
 ################################################################################
 
-def load_data(nrm_type, extra_paired_cols=[]):
+def load_raw_data():
+    ''' loads the data load_data is based on, before normalization
+
+    to prepare several variants (e.g., normalization types) from one load,
+    see prepare_data
+
+    returns:
+        tuple of pandas dataframes: raw "big table" (one row per chunk, with
+        "*_raw" feature columns), task meta-data, and rows of the data joined
+        with chunk pairs (see _get_pair_rows)
+    '''
+    _check_complete()
+    df_bt = db.pd_read_sql_query(sql_fname=cfg.SQL_BT_FNAME)
+    df_tsk = db.pd_read_sql_query('SELECT * FROM tasks')
+    return df_bt, df_tsk, _get_pair_rows(df_bt)
+
+
+def prepare_data(raw_data, nrm_type, extra_paired_cols=[], df_stats=None):
+    ''' normalizes raw data and joins task data and chunk pairs (see load_data)
+
+    args:
+        raw_data: tuple as returned by load_raw_data (not modified)
+        nrm_type: how to normalize features (see cfg.NRM_TYPES)
+        extra_paired_cols: extra columns to include regarding paired speakers
+        df_stats: statistics to normalize with, as returned by 
+            get_feature_stats (computed from the data if None)
+    returns:
+        pandas dataframe as returned by load_data
+    '''
+    df_bt, df_tsk, df_rows = raw_data
+    # normalize features as needed
+    df_bt = _normalize_features(df_bt.copy(), nrm_type, df_stats)
+    # join task meta-data (these differ by corpus, not loaded in script above)
+    df_bt = _join_task_data(df_bt, df_tsk)
+    # add features of paired chunks (partner and non-partner) to each row and
+    # compute similarity for each pair and all features
+    df_bt = _load_pairs(df_bt, extra_paired_cols, df_rows)
+    return df_bt
+
+
+def load_data(nrm_type, extra_paired_cols=[], stored_stats=False):
     ''' loads data into one wide dataframe with redundant info 
     
     args: 
         nrm_type: how to normalize features (see cfg.NRM_TYPES)
         extra_paired_cols: extra columns to include regarding paired speakers
+        stored_stats: whether to normalize with the statistics stored by
+            store_feature_stats (instead of computing them from the data)
     returns:
         pandas dataframe with data per chunk (or chunk pair, where applicable),
         with running index (not chu_id because non-adjacent chunk pairs lead to 
         multiple rows per chunk)
     '''
     # load raw data ("big table" dataframe with redundant info)
-    df_bt = db.pd_read_sql_query(sql_fname=cfg.SQL_BT_FNAME)
-    # normalize features as needed
-    df_bt = _normalize_features(df_bt, nrm_type)
-    # join task meta-data (these differ by corpus, not loaded in script above)
-    df_bt = _join_task_data(df_bt)
-    # add features of paired chunks (partner and non-partner) to each row and
-    # compute similarity for each pair and all features
-    df_bt = _load_pairs(df_bt, extra_paired_cols)
-    return df_bt
+    raw_data = load_raw_data()
+    df_stats = get_feature_stats(nrm_type) \
+        if stored_stats and nrm_type != cfg.NRM_RAW else None
+    return prepare_data(raw_data, nrm_type, extra_paired_cols, df_stats)
 
 
-def lsim(df_bt, grp_by=cfg.GRP_BYS):
-    ''' computes local similarity for given data, per session, task, and speaker
+def iter_data(nrm_type, extra_paired_cols=[], df_stats=None, min_chunks=1):
+    ''' yields data per partition of sessions, as load_data does for all
+    sessions at once
+
+    the raw "big table" is streamed from the database one session at a time
+    (cfg.SQL_BT_FNAME is ordered by session) and sessions are collected into
+    partitions of at least min_chunks chunks, which are joined with their
+    chunk pairs only (pairs never cross sessions); only one partition is in
+    memory at once; features are normalized with statistics of all sessions,
+    which have to be given (see get_feature_stats)
+
+    args:
+        nrm_type: how to normalize features (see cfg.NRM_TYPES)
+        extra_paired_cols: extra columns to include regarding paired speakers
+        df_stats: statistics to normalize with, as returned by
+            get_feature_stats (not needed for cfg.NRM_RAW)
+        min_chunks: minimum number of chunks per partition (1 for one
+            session per partition; larger partitions save overhead per
+            partition, memory is bounded by this plus the largest session)
+    returns:
+        generator of tuples (list of session ids, pandas dataframe as
+        returned by load_data, for these sessions)
+    '''
+    def __prepare(parts):
+        ses_ids = [ses_id for ses_id, _ in parts]
+        df_raw = pd.concat([df for _, df in parts], ignore_index=True)
+        # features of a partition can all be NULL (object columns)
+        df_raw[raw_cols] = df_raw[raw_cols].astype(float)
+        df_rows = _get_pair_rows(df_raw, pd.concat(
+            [db.get_chunk_pairs(ses_id) for ses_id in ses_ids],
+            ignore_index=True))
+        return ses_ids, prepare_data(
+            (df_raw, df_tsk, df_rows), nrm_type, extra_paired_cols, df_stats)
+    assert nrm_type == cfg.NRM_RAW or df_stats is not None, \
+        'statistics of all sessions needed to normalize per partition'
+    _check_complete()
+    df_tsk = db.pd_read_sql_query('SELECT * FROM tasks')
+    raw_cols = [f + '_raw' for f in cfg.FEATURES_ALL]
+    # sessions of current partition
+    parts = []
+    n_chunks = 0
+    for ses_id, df_ses in db.iter_sessions(sql_fname=cfg.SQL_BT_FNAME):
+        parts += [(ses_id, df_ses)]
+        n_chunks += len(df_ses)
+        if n_chunks >= min_chunks:
+            yield __prepare(parts)
+            parts = []
+            n_chunks = 0
+    if len(parts) > 0:
+        yield __prepare(parts)
+
+
+def store_feature_stats(ses_ids=None):
+    ''' computes and stores raw feature moments per session and speaker
+
+    moments (count, mean, sum of squared deviations) are stored per session,
+    speaker, and feature in table feature_moments, so that statistics per
+    speaker or gender (see get_feature_stats) can be merged from them and,
+    when sessions change, only those need to be recomputed; moments of
+    sessions no longer in the database are removed
+
+    args:
+        ses_ids: sessions to (re)compute, all if None
+    '''
+    _check_complete()
+    _create_moments_table()
+    sql_stmt = \
+        'SELECT tsk.ses_id,\n' \
+        '       CASE\n' \
+        '           WHEN tur.speaker_a_or_b == "A"\n' \
+        '           THEN ses.spk_id_a\n' \
+        '           ELSE ses.spk_id_b\n' \
+        '       END spk_id,\n' \
+        '       %s\n' \
+        'FROM   chunks chu\n' \
+        'JOIN   turns tur\n' \
+        'ON     chu.tur_id == tur.tur_id\n' \
+        'JOIN   tasks tsk\n' \
+        'ON     tur.tsk_id == tsk.tsk_id\n' \
+        'JOIN   sessions ses\n' \
+        'ON     tsk.ses_id == ses.ses_id\n' \
+        'LEFT JOIN chunk_features chf\n' \
+        'ON     chu.chu_id == chf.chu_id\n' \
+        'AND    chf.complete\n' \
+        '%s' \
+        'ORDER BY tsk.ses_id;' % (',\n       '.join(
+            'chf.' + f for f in cfg.FEATURES_ALL), '%s')
+    if ses_ids is None:
+        db.dbc.execute('DELETE FROM feature_moments;')
+        dfs = db.iter_sessions(sql_stmt % '')
+    else:
+        ses_ids = sorted(set(ses_ids))
+        db.dbc.executemany('DELETE FROM feature_moments WHERE ses_id == ?;',
+                           [(ses_id,) for ses_id in ses_ids])
+        dfs = ((ses_id, db.pd_read_sql_query(
+                    sql_stmt % ('WHERE  tsk.ses_id == %d\n' % ses_id)))
+               for ses_id in ses_ids)
+    db.dbc.execute(
+        'DELETE FROM feature_moments\n'
+        'WHERE  ses_id NOT IN (SELECT ses_id FROM sessions);')
+    for ses_id, df in dfs:
+        if len(df) == 0:
+            continue
+        grps, spk_ids = pd.factorize(df['spk_id'])
+        X = df[cfg.FEATURES_ALL].values.astype(float)
+        n, mean, m2 = _get_moments(grps, X)
+        db.dbc.executemany(
+            'INSERT INTO feature_moments (ses_id, spk_id, feature, n, mean, '
+            'm2)\nVALUES (?, ?, ?, ?, ?, ?);',
+            [(int(ses_id), int(spk_id), f, int(n[i, j]),
+              None if n[i, j] == 0 else float(mean[i, j]),
+              None if n[i, j] == 0 else float(m2[i, j]))
+             for i, spk_id in enumerate(spk_ids)
+             for j, f in enumerate(cfg.FEATURES_ALL)])
+    db.commit()
+
+
+def get_feature_stats(nrm_type):
+    ''' returns feature means and standard deviations per speaker or gender
+
+    merged from the moments stored by store_feature_stats
+
+    args:
+        nrm_type: cfg.NRM_SPK (per speaker) or cfg.NRM_GND (per gender)
+    returns:
+        pandas dataframe indexed by spk_id or gender, with "*_mean" and
+        "*_std" columns per feature
+    '''
+    assert nrm_type in [cfg.NRM_SPK, cfg.NRM_GND], 'unknown normalization type'
+    _create_moments_table()
+    df = db.pd_read_sql_query(
+        'SELECT mom.ses_id, mom.spk_id, spk.gender, mom.feature, mom.n,\n'
+        '       mom.mean, mom.m2\n'
+        'FROM   feature_moments mom\n'
+        'JOIN   speakers spk\n'
+        'ON     mom.spk_id == spk.spk_id;')
+    assert len(df) > 0, 'no feature moments stored, see store_feature_stats'
+    grp_col = 'spk_id' if nrm_type == cfg.NRM_SPK else 'gender'
+    # one row per session and speaker, one column per moment and feature
+    df = df.set_index(['ses_id', 'spk_id', 'gender', 'feature']).unstack()
+    feats = [f for f in cfg.FEATURES_ALL if f in df['n'].columns]
+    grps, idx = pd.factorize(df.index.get_level_values(grp_col))
+    n, mean, m2 = _merge_moments(
+        grps, *[df[c][feats].values.astype(float) for c in ['n', 'mean', 'm2']])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.sqrt(m2 / (n - 1))
+    df_stats = pd.DataFrame(
+        np.hstack([mean, std]), index=pd.Index(idx, name=grp_col),
+        columns=[f + '_mean' for f in feats] + [f + '_std' for f in feats])
+    return df_stats
+
+
+def get_lsim_sums(sims_p, sims_x, shift=0.0):
+    ''' returns sums per turn-initial chunk that local similarity is based on
+
+    args:
+        sims_p, sims_x: numpy arrays with (mean) similarity to the adjacent
+            and to the non-adjacent paired chunks per turn-initial chunk
+            (rows) and feature (columns), nan if missing
+        shift: shift of the differences between both per feature (for
+            numerically stable sums of squares, e.g., their mean)
+    returns:
+        numpy array with six blocks of one column per feature: number of
+        similarities, number of differences, sum and sum of squares of the
+        (shifted) differences, number and sum of local similarities; sums
+        for groups of chunks are sums of these rows (see lsim_from_sums)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diffs = sims_p - sims_x
+        lsims = -sims_p / sims_x
+    # exclude nan (NULL) feature values
+    # (a missing non-adjacent similarity makes the t-test undefined)
+    valid = pd.notna(sims_p)
+    valid_diff = pd.notna(diffs)
+    valid_lsim = pd.notna(lsims)
+    diffs = np.where(valid_diff, diffs - shift, 0.0)
+    return np.hstack([valid, valid_diff, diffs, diffs**2, valid_lsim,
+                      np.where(valid_lsim, lsims, 0.0)])
+
+
+def lsim_stats(sums, shift=0.0):
+    ''' computes local similarity from sums as returned by get_lsim_sums
+
+    args:
+        sums: numpy array with sums per group (rows), see get_lsim_sums
+        shift: shift used for the sums, see get_lsim_sums
+    returns:
+        tuple of numpy arrays with number of turn-initial chunks, t-statistic,
+        p-value, and mean local similarity per group (rows) and feature
+    '''
+    n, n_diff, s, ss, n_lsim, s_lsim = np.split(sums, 6, axis=1)
+    t, p = _ttest_rel_sums(n_diff, s, ss, shift)
+    t[n_diff < n] = p[n_diff < n] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lsim_means = s_lsim / n_lsim
+    # exclude lists that are too short (t-test undefined)
+    t[n < 2] = p[n < 2] = lsim_means[n < 2] = np.nan
+    return n, t, p, lsim_means
+
+
+def lsim_from_sums(df_keys, sums, grp_by, shift=0.0):
+    ''' computes local similarity from sums as returned by get_lsim_sums
+
+    all given grouping levels are derived from the same sums at once
+
+    args:
+        df_keys: pandas dataframe with ses_type, ses_id, tsk_id, and spk_id
+            per row of sums (e.g., per turn-initial chunk)
+        sums: numpy array with sums per row, see get_lsim_sums
+        grp_by: list of constants from cfg.GRP_BYS
+        shift: shift used for the sums, see get_lsim_sums
+    returns:
+        pandas dataframe with results like lsim (without empirical p-values)
+    '''
+    keys, sums = _rollup(df_keys, sums, grp_by)
+    n, t, p, lsim_means = lsim_stats(sums, shift)
+    results = {f: {} for f in cfg.FEATURES}
+    for i, key in enumerate(keys):
+        for j, f in enumerate(cfg.FEATURES):
+            if n[i, j] > 0:
+                results[f][key] = \
+                    (t[i, j], p[i, j], int(n[i, j]) - 1, lsim_means[i, j])
+    return aux.get_df(results, ['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+
+
+def get_corr_sums(X, Y, shift_x=None, shift_y=None):
+    ''' returns sums per row that pearson's r (syn, lcon) is based on
+
+    args:
+        X, Y: numpy arrays with values per row and column (nan if missing,
+            rows with a missing value are ignored per column)
+        shift_x, shift_y: shifts of the values per column (for numerically
+            stable sums of squares), column means if None
+    returns:
+        numpy array with six blocks of one column per column of X: number
+        of values, sums of (shifted) x and y, of their squares, and of their
+        products; sums for groups of rows are sums of these rows (see
+        corr_from_sums)
+    '''
+    valid = ~np.isnan(X) & ~np.isnan(Y)
+    with np.errstate(invalid='ignore'):
+        if shift_x is None:
+            shift_x = np.nanmean(np.where(valid, X, np.nan), axis=0)
+        if shift_y is None:
+            shift_y = np.nanmean(np.where(valid, Y, np.nan), axis=0)
+    X0 = np.where(valid, X - shift_x, 0.0)
+    Y0 = np.where(valid, Y - shift_y, 0.0)
+    return np.hstack([valid, X0, Y0, X0**2, Y0**2, X0 * Y0])
+
+
+def corr_stats(sums):
+    ''' computes pearson's r (syn, lcon) from sums as returned by get_corr_sums
+
+    args:
+        sums: numpy array with sums per group (rows), see get_corr_sums
+    returns:
+        tuple of numpy arrays with number of values, r-value, and p-value per
+        group (rows) and column
+    '''
+    n, sx, sy, sxx, syy, sxy = np.split(sums, 6, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var_x = sxx - sx**2 / n
+        var_y = syy - sy**2 / n
+        # constant values (pearson's r undefined)
+        var_x[var_x <= 1e-12 * sxx] = np.nan
+        var_y[var_y <= 1e-12 * syy] = np.nan
+        r = np.clip((sxy - sx * sy / n) / np.sqrt(var_x * var_y), -1.0, 1.0)
+        r[n < 3] = np.nan
+        t = r * np.sqrt((n - 2) / ((1.0 - r) * (1.0 + r)))
+    return n, r, 2 * scipy.stats.t.sf(np.abs(t), n - 2)
+
+
+def corr_from_sums(df_keys, sums, grp_by):
+    ''' computes pearson's r (syn, lcon) from sums as returned by get_corr_sums
+
+    all given grouping levels are derived from the same sums at once; results
+    per session are always included, other results only for groups with at
+    least one value
+
+    args:
+        df_keys: pandas dataframe with ses_type, ses_id, tsk_id, and spk_id
+            per row of sums (e.g., per turn-initial chunk)
+        sums: numpy array with sums per row, see get_corr_sums
+        grp_by: list of constants from cfg.GRP_BYS
+    returns:
+        pandas dataframe with results like syn and lcon
+    '''
+    keys, sums = _rollup(df_keys, sums, grp_by)
+    n, r, p = corr_stats(sums)
+    results = {f: {} for f in cfg.FEATURES}
+    for i, key in enumerate(keys):
+        for j, f in enumerate(cfg.FEATURES):
+            if n[i, j] > 0 or key[2:] == (0, 0):
+                results[f][key] = (r[i, j], p[i, j], int(n[i, j]) - 2)
+    return aux.get_df(results, ['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+
+
+def get_lsim_sims(df_bt):
+    ''' computes similarities at turn exchanges and local similarity per chunk
 
     args:
         df_bt: "big table" pandas dataframe as returned by load_data
-        grp_by: list of constants from cfg.GRP_BYS, for which groups of data
-            the measure should be computed
     returns:
-        pandas dataframe with results (t-statistic, p-value, degrees of 
-        freedom), indexed by ses_id, tsk_id, and spk_id
-        (0 for any index component means "all", e.g., all tasks in a session)
+        pandas dataframe indexed by ses_type, ses_id, tsk_id, spk_id, and
+        chu_id of turn-initial chunks, with mean similarity to the adjacent
+        ("*_sim_p", mean of 1 val) and non-adjacent ("*_sim_x", mean of 10+
+        vals) paired chunks and local similarity ("*_lsim") per feature
     '''
-    def __lsim_test(df, f, key, level):
-        ''' runs sanity check and the actual t-test for local similarity '''
-        # exclude lists that are too short (pearsonr undefined)
-        if len(df.xs(key, level=level)) < 2:
-            return (np.nan, np.nan, len(df.xs(key, level=level))-1, np.nan)
-        else:
-            return aux.ttest_rel(df.xs(key, level=level)[f + '_sim_p'], 
-                                 df.xs(key, level=level)[f + '_sim_x']) \
-                + (df.xs(key, level=level)[f + '_lsim'].mean(),)
-    cfg.check_grp_by(grp_by)
-    # per turn-initial chunk and feature, compute mean similarity with
-    # adjacent (mean of 1 val) and non-adjacent (mean of 10+ vals) paired chunks
     grp_cols = ['ses_type', 'ses_id', 'tsk_id', 'spk_id', 'chu_id', 'p_or_x']
     df_sims = df_bt.loc[:, grp_cols + ['%s_sim' % f for f in cfg.FEATURES]]
     df_sims = df_sims.groupby(grp_cols).mean()
     # self-join to get values for both adjacent and non-adjacent in each row
-    df_sims = pd.DataFrame(df_sims.xs('p', level=5)).join( 
-        df_sims.xs('x', level=5), lsuffix='_p', rsuffix='_x')
-    # compute local similarity per feature, overall and per task, session, spk
-    results = {f: {} for f in cfg.FEATURES}
+    # (selected by mask, data without any pairs give an empty result)
+    p_or_x = df_sims.index.get_level_values(5)
+    df_sims = df_sims[p_or_x == 'p'].droplevel(5).join(
+        df_sims[p_or_x == 'x'].droplevel(5), lsuffix='_p', rsuffix='_x')
     for f in cfg.FEATURES:
         lsims = -df_sims[f + '_sim_p'] / df_sims[f + '_sim_x']
         lsims.name = '%s_lsim' % f
         df_sims = df_sims.join(lsims)
-        # exclude nan (NULL) feature values
-        df_sims_f = df_sims[pd.notna(df_sims[f + '_sim_p'])]
-        for ses_type in ['GAME', 'CONV']:
-            if ses_type not in set(df_bt['ses_type']):
-                continue
-            # result for entire session type
-            if cfg.GRP_BY_SES_TYPE in grp_by:
-                results[f][(ses_type, 0, 0, 0)] = \
-                    __lsim_test(df_sims_f, f, ses_type, 0)            
-            for ses_id in set([v[0] for v in df_sims_f.loc[ses_type].index]):
-                # result per session, symmetric measure for both speakers
-                if cfg.GRP_BY_SES in grp_by:
-                    results[f][(ses_type, ses_id, 0, 0)] = \
-                        __lsim_test(df_sims_f, f, ses_id, 1)
-                for spk_id \
-                in set([v[2] for v in df_sims_f.xs(ses_id, level=1).index]):
-                    # result per session, asymmetric measure per speaker
-                    if cfg.GRP_BY_SES_SPK in grp_by:
-                        results[f][(ses_type, ses_id, 0, spk_id)] = \
-                            __lsim_test(df_sims_f, f, (ses_id, spk_id), (1, 3))
-                for tsk_id \
-                in set([v[1] for v in df_sims_f.xs(ses_id, level=1).index]):
-                    # result per task, symmetric measure for both speakers
-                    if cfg.GRP_BY_TSK in grp_by:
-                        results[f][(ses_type, ses_id, tsk_id, 0)] = \
-                            __lsim_test(df_sims_f, f, tsk_id, 2)
-                    for spk_id \
-                    in set([v[2] for v in df_sims_f.xs(tsk_id, level=2).index]):
-                        # result per task, asymmetric measure per speaker
-                        if cfg.GRP_BY_TSK_SPK in grp_by:
-                            results[f][(ses_type, ses_id, tsk_id, spk_id)] = \
-                                __lsim_test(
-                                    df_sims_f, f, (tsk_id, spk_id), (2, 3))
-    return aux.get_df(results, ['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+    return df_sims
+
+
+def get_local_sums(df_bt):
+    ''' computes the sums the local measures are based on, per task and speaker
+
+    sums are not shifted (see get_lsim_sums, get_corr_sums), so that sums of
+    different parts of a corpus (e.g., sessions or shards) can be added up;
+    local measures for all grouping levels follow from them (see
+    lsim_from_sums, corr_from_sums)
+
+    args:
+        df_bt: "big table" pandas dataframe as returned by load_data
+    returns:
+        dict with pandas dataframe with sums per task and speaker (indexed by
+        ses_type, ses_id, tsk_id, and spk_id) per local measure (cfg.MEA_LSIM,
+        cfg.MEA_SYN, cfg.MEA_LCON)
+    '''
+    df_sims = get_lsim_sims(df_bt)
+    df_sims = df_sims[df_sims.index.get_level_values(0).isin(['GAME', 'CONV'])]
+    df_p = df_bt[df_bt['p_or_x'] == 'p']
+    sims = df_p[[f + '_sim' for f in cfg.FEATURES]].values.astype(float)
+    zeros = np.zeros(len(cfg.FEATURES))
+    return {
+        cfg.MEA_LSIM: _get_key_sums(
+            df_sims.index.to_frame(index=False),
+            get_lsim_sums(
+                df_sims[[f + '_sim_p' for f in cfg.FEATURES]].values,
+                df_sims[[f + '_sim_x' for f in cfg.FEATURES]].values)),
+        cfg.MEA_SYN: _get_key_sums(df_p, get_corr_sums(
+            df_p[cfg.FEATURES].values.astype(float),
+            df_p[[f + '_paired' for f in cfg.FEATURES]].values.astype(float),
+            zeros, zeros)),
+        cfg.MEA_LCON: _get_key_sums(df_p, get_corr_sums(
+            sims, np.repeat(df_p[['start_time']].values.astype(float),
+                            sims.shape[1], axis=1), zeros, zeros))
+    }
+
+
+def lsim(df_bt, grp_by=cfg.GRP_BYS, n_perm=0, perm_type='swap', n_jobs=None,
+         seed=0):
+    ''' computes local similarity for given data, per session, task, and speaker
+
+    optionally, significance is also determined with a permutation test of
+    the mean difference between adjacent and non-adjacent similarity, either
+    swapping the two at random per turn-initial chunk ("swap") or shifting
+    the sequence of paired chunks against the turn-initial chunks of a
+    session by a random offset ("shift"); see aux.perm_test
+
+    args:
+        df_bt: "big table" pandas dataframe as returned by load_data
+        grp_by: list of constants from cfg.GRP_BYS, for which groups of data
+            the measure should be computed
+        n_perm: number of permutations (0 for no permutation test)
+        perm_type: "swap" or "shift", see above
+        n_jobs: number of processes for the permutation test
+        seed: random seed for the permutation test
+    returns:
+        pandas dataframe with results (t-statistic, p-value, degrees of 
+        freedom, mean lsim, and empirical p-value if n_perm > 0), indexed by 
+        ses_id, tsk_id, and spk_id
+        (0 for any index component means "all", e.g., all tasks in a session)
+    '''
+    cfg.check_grp_by(grp_by)
+    grp_cols = ['ses_type', 'ses_id', 'tsk_id', 'spk_id', 'chu_id', 'p_or_x']
+    df_sims = get_lsim_sims(df_bt)
+    df_sims = df_sims[df_sims.index.get_level_values(0).isin(['GAME', 'CONV'])]
+    # compute local similarity per feature, overall and per task, session, spk,
+    # all from sums over turn-initial chunks
+    sims_p = df_sims[[f + '_sim_p' for f in cfg.FEATURES]].values
+    sims_x = df_sims[[f + '_sim_x' for f in cfg.FEATURES]].values
+    with np.errstate(invalid='ignore'):
+        shift = np.nan_to_num(np.nanmean(sims_p - sims_x, axis=0))
+    df_lsim = lsim_from_sums(
+        df_sims.index.to_frame(index=False),
+        get_lsim_sums(sims_p, sims_x, shift), grp_by, shift)
+    if n_perm > 0:
+        assert perm_type in ['swap', 'shift'], 'unknown permutation type'
+        results = {f: df_lsim[f].dropna().to_dict() for f in cfg.FEATURES}
+        idx_cols = ['ses_type', 'ses_id', 'tsk_id', 'spk_id']
+        # feature values of turn-initial and adjacent turn-final chunks
+        df_p = df_bt[df_bt['p_or_x'] == 'p'].groupby(grp_cols[:-1]).first()
+        for f in cfg.FEATURES:
+            fltr = pd.notna(df_sims[f + '_sim_p']) \
+                & pd.notna(df_sims[f + '_sim_x'])
+            df = df_sims.loc[fltr, [f + '_sim_p', f + '_sim_x']].join(
+                df_p[[f, f + '_paired']]).reset_index()
+            # chronological order per session, needed for time shifts
+            df.sort_values(['ses_id', 'chu_id'], inplace=True)
+            keys = list(results[f].keys())
+            grps = _get_grp_matrix(df, keys, idx_cols)
+            vals = (df[f + '_sim_p'] - df[f + '_sim_x']).values
+            if perm_type == 'swap':
+                null_func = aux.swap_signs
+                null_args = (vals,)
+            else:
+                ses = pd.factorize(df['ses_id'])[0]
+                length = np.bincount(ses)[ses]
+                pos = df.groupby('ses_id').cumcount().values
+                null_func = _shift_paired
+                null_args = (
+                    df[f].values, df[f + '_paired'].values,
+                    df[f + '_sim_x'].values, np.arange(len(df)) - pos,
+                    length, pos, ses, ses.max() + 1)
+            p = aux.perm_test(vals, grps, null_func, null_args, n_perm,
+                              n_jobs, seed)
+            for key, p_key in zip(keys, p):
+                results[f][key] = results[f][key] + (p_key,)
+        df_lsim = aux.get_df(
+            results, ['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+    return df_lsim
 
 
 def syn(df_bt, grp_by=[g for g in cfg.GRP_BYS if g != cfg.GRP_BY_SES_TYPE]):
@@ -227,45 +877,17 @@ def syn(df_bt, grp_by=[g for g in cfg.GRP_BYS if g != cfg.GRP_BY_SES_TYPE]):
         indexed by ses_id, tsk_id, and spk_id
         (0 for any index component means "all", e.g., all tasks in a session)
     '''
-    def __syn_test(df, f):
-        ''' runs sanity checks and the actual pearsonr for synchrony '''
-        # exclude lists that are too short or constant (pearsonr undefined)
-        if len(df) < 3 or np.std(df[f]) == 0:
-            return (np.nan, np.nan, len(df)-2)
-        else:
-            # compute correlation between turn-final and turn-initial chunks
-            return aux.pearsonr(df[f], df[f + '_paired'])
     supported = [g for g in cfg.GRP_BYS if g != cfg.GRP_BY_SES_TYPE]
     cfg.check_grp_by(grp_by, supported)
-    # compute synchrony for each feature per task, session, and speaker
-    results = {f: {} for f in cfg.FEATURES}
-    for (ses_type, ses_id), df_grp_ses \
-    in df_bt[df_bt['p_or_x'] == 'p'].groupby(['ses_type', 'ses_id']):
-        for f in cfg.FEATURES:
-            # exclude nan (NULL) feature values
-            df_grp_ses_f = df_grp_ses[pd.notna(df_grp_ses[f])]
-            df_grp_ses_f = df_grp_ses_f[pd.notna(df_grp_ses_f[f + '_paired'])]
-            # result per session, symmetric measure for both speakers
-            if cfg.GRP_BY_SES in grp_by:
-                results[f][(ses_type, ses_id, 0, 0)] = \
-                    __syn_test(df_grp_ses_f, f)
-            for spk_id, df_grp_ses_spk in df_grp_ses_f.groupby('spk_id'):
-                # result per session, asymmetric measure per speaker
-                if cfg.GRP_BY_SES_SPK in grp_by:
-                    results[f][(ses_type, ses_id, 0, spk_id)] = \
-                        __syn_test(df_grp_ses_spk, f)
-            for tsk_id, df_grp_ses_tsk in df_grp_ses_f.groupby('tsk_id'):
-                # result per task, symmetric measure for both speakers
-                if cfg.GRP_BY_TSK in grp_by:
-                    results[f][(ses_type, ses_id, tsk_id, 0)] = \
-                        __syn_test(df_grp_ses_tsk, f)
-                for spk_id, df_grp_ses_tsk_spk \
-                in df_grp_ses_tsk.groupby('spk_id'):
-                    # result per task, asymmetric measure per speaker
-                    if cfg.GRP_BY_TSK_SPK in grp_by:
-                        results[f][(ses_type, ses_id, tsk_id, spk_id)] = \
-                            __syn_test(df_grp_ses_tsk_spk, f)
-    return aux.get_df(results, ['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+    # compute synchrony for each feature per task, session, and speaker,
+    # correlating turn-final and turn-initial chunks (nan values excluded)
+    df_p = df_bt[df_bt['p_or_x'] == 'p']
+    return corr_from_sums(
+        df_p[['ses_type', 'ses_id', 'tsk_id', 'spk_id']],
+        get_corr_sums(
+            df_p[cfg.FEATURES].values.astype(float),
+            df_p[[f + '_paired' for f in cfg.FEATURES]].values.astype(float)),
+        grp_by)
 
 
 def lcon(df_bt, grp_by=[cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK]):
@@ -280,185 +902,227 @@ def lcon(df_bt, grp_by=[cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK]):
         indexed by ses_id, and spk_id
         (0 for spk_id index means both speakers in that session)
     '''
-    def __lcon_test(df, f):
-        if len(df) < 3 or np.std(df[f + '_sim']) == 0:
-            # exclude lists that are too short or constant (pearsonr undefined)
-            return (np.nan, np.nan, len(df)-2)
-        else:
-            # compute correlation between similarity and turn-initial start time
-            return aux.pearsonr(df[f + '_sim'], df['start_time'])
     cfg.check_grp_by(grp_by, supported=[cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK])
+    # compute correlation between similarity and turn-initial start time
+    # (nan similarities excluded per feature)
     # note: correlating with turn_index_ses makes very little difference
-    results = {f: {} for f in cfg.FEATURES}
-    for (ses_type, ses_id), df_grp_ses \
-    in df_bt[df_bt['p_or_x'] == 'p'].groupby(['ses_type', 'ses_id']):
-        for f in cfg.FEATURES:
-            # exclude nan (NULL) feature values
-            df_grp_ses = df_grp_ses[pd.notna(df_grp_ses[f + '_sim'])]
-            # result per session, symmetric measure for both speakers
-            if cfg.GRP_BY_SES in grp_by:
-                results[f][(ses_type, ses_id, 0, 0)] = \
-                    __lcon_test(df_grp_ses, f)
-            for spk_id, df_grp_ses_spk in df_grp_ses.groupby('spk_id'):
-                # result per session, asymmetric measure per speaker
-                if cfg.GRP_BY_SES_SPK in grp_by:
-                    results[f][(ses_type, ses_id, 0, spk_id)] = \
-                        __lcon_test(df_grp_ses_spk, f)
+    df_p = df_bt[df_bt['p_or_x'] == 'p']
+    sims = df_p[[f + '_sim' for f in cfg.FEATURES]].values.astype(float)
+    times = df_p[['start_time']].values.astype(float)
     # note: convergence per task is not computed, tsk_id is always 0;
     #       only included for consistent interface for all local measures
-    return aux.get_df(results, ['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+    return corr_from_sums(
+        df_p[['ses_type', 'ses_id', 'tsk_id', 'spk_id']],
+        get_corr_sums(sims, np.repeat(times, sims.shape[1], axis=1)), grp_by)
 
 
-def gcon(df_bt):
-    ''' computes global convergence for given data
+def get_gcon_dists(df_bt):
+    ''' computes first and second half distances between speakers (gcon)
+
+    speakers are only compared to their partners, so the distances of a
+    session depend only on its own data (see iter_data)
 
     args:
         df_bt: "big table" pandas dataframe as returned by load_data
     returns:
-        pandas dataframe with results (t-statistic, p-value, degrees of 
-        freedom), indexed by session type; second dataframe with raw first and
-        second half distances between speakers
+        pandas dataframe with raw first and second half distances and
+        convergence contribution per speaker, and per session (spk_id 0),
+        indexed by ses_type, ses_id, tsk_id (always 0), and spk_id
     '''
-    df_sub = df_bt[df_bt['p_or_x'] != 'x'].copy()
-    # "delete" tsk_id so it can be included in grouping for means below
-    # (convergence per task is not computed, but tsk_id is included in index 
-    #  for consistent interface)
-    df_sub['tsk_id'] = 0
-    # get feature mean per speaker and half
-    grp_cols = [
-        'ses_type', 'ses_id', 'tsk_id', 'spk_id', 'partner_spk_id', 'ses_half']
-    df_grps = df_sub.loc[:, grp_cols + cfg.FEATURES].groupby(grp_cols).mean()
-    # self-join to get means for both halves in each row
-    df_grps = df_grps.xs(1, level=5).join(
-        df_grps.xs(2, level=5), lsuffix='_1', rsuffix='_2')
-    # self-join again to get means for both halves for both speakers in each row
-    # (main speaker is labeled 'A', partner 'B', unrelated to normal A/B)
-    on = ['ses_type', 'ses_id', 'tsk_id', 'partner_spk_id', 'spk_id']
-    df_grps = df_grps.join(df_grps, on=on, lsuffix='A', rsuffix='B')
-    for f in cfg.FEATURES:
-        # compute distance between speaker means for each half
-        for h in [1, 2]:
-            dists = abs(df_grps['%s_%dA' % (f, h)] - df_grps['%s_%dB' % (f, h)])
-            dists.name = '%s_dist%d' % (f, h)
-            df_grps = df_grps.join(dists)
-        # compute shift from 1st to 2nd half for each speaker
-        for s in ['A', 'B']:
-            shifts = abs(df_grps['%s_1%s' % (f, s)]-df_grps['%s_2%s' % (f, s)])
-            shifts.name = '%s_shift%s' % (f, s)
-            df_grps = df_grps.join(shifts)
-        # compute fraction of contribution to total shift by the main speaker
-        # (main speaker is always labeled 'A', see above)
-        fracs = df_grps['%s_shiftA' % (f)] \
-            / (df_grps['%s_shiftA' % f] + df_grps['%s_shiftB' % f])
-        fracs.name = '%s_frac' % f
-        df_grps = df_grps.join(fracs)
-    results = {f: {} for f in cfg.FEATURES}
-    # compute global conv. per session type and feature
-    for f in cfg.FEATURES:
-        for ses_type in [0, 'GAME', 'CONV']:
-            if ses_type and ses_type not in set(df_bt['ses_type']):
-                continue
-            df_sub = df_grps.loc[ses_type] if ses_type else df_grps
-            # ignore redundant rows (distances are symmetric) 
-            df_sub = df_sub.iloc[::2]
-            # ignore rows with missing values
-            df_sub = df_sub[pd.notna(df_sub[f + '_dist1'])]
-            df_sub = df_sub[pd.notna(df_sub[f + '_dist2'])]
-            results[f][ses_type] = \
-                aux.ttest_rel(df_sub[f + '_dist1'], df_sub[f + '_dist2'])
-        # compute convergence contribution per speaker and feature
-        cons = df_grps['%s_frac' % f] \
-            * (df_grps['%s_dist1' % f] - df_grps['%s_dist2' % f])
-        cons.name = '%s_con' % f
-        df_grps = df_grps.join(cons)
-    loc_cols = list(itertools.chain(
+    df_sub = df_bt[df_bt['p_or_x'] != 'x']
+    # feature means per speaker ("unit") and half, all features at once
+    # (convergence per task is not computed, tsk_id is 0 in all results)
+    grp_cols = ['ses_type', 'ses_id', 'spk_id', 'partner_spk_id', 'ses_half']
+    df_grps = df_sub.groupby(grp_cols)
+    df_means = df_grps[cfg.FEATURES].mean().unstack('ses_half')
+    # only speakers with chunks in the first half
+    fltr = (df_grps.size().unstack('ses_half')[1] > 0).values
+    df_means = df_means[fltr]
+    units = df_means.index
+    means1 = df_means.xs(1, axis=1, level=1)[cfg.FEATURES].values
+    means2 = df_means.xs(2, axis=1, level=1)[cfg.FEATURES].values \
+        if 2 in df_means.columns.get_level_values(1) \
+        else np.full(means1.shape, np.nan)
+    # partner of each speaker by integer index (speaker 'A', partner 'B')
+    idx = units.get_indexer(pd.MultiIndex.from_arrays([
+        units.get_level_values(0), units.get_level_values(1),
+        units.get_level_values(3), units.get_level_values(2)]))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # distance between speaker means for each half
+        dist1 = abs(means1 - _gather(means1, idx))
+        dist2 = abs(means2 - _gather(means2, idx))
+        # shift from 1st to 2nd half for each speaker
+        shifts = abs(means1 - means2)
+        # fraction of contribution to total shift by the main speaker
+        fracs = shifts / (shifts + _gather(shifts, idx))
+        # convergence contribution per speaker
+        cons = fracs * (dist1 - dist2)
+    index = pd.MultiIndex.from_arrays(
+        [units.get_level_values(0), units.get_level_values(1),
+         np.zeros(len(units), dtype=int), units.get_level_values(2)],
+        names=['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+    cols = list(itertools.chain(
         *[[f + '_dist1', f + '_dist2', f + '_con'] for f in cfg.FEATURES]))
-    df_grps.set_index(df_grps.index.droplevel(4), inplace=True)
-    df_results_raw = df_grps.loc[:, loc_cols]
+    vals = np.stack([dist1, dist2, cons], axis=2).reshape(len(units), -1)
+    df_results_raw = pd.DataFrame(vals, index=index, columns=cols)
     # add symmetric measure (equivalent to sum of both speakers' contributions)
     df_tmp = df_results_raw.iloc[::2].reset_index()
     for f in cfg.FEATURES:
         df_tmp[f + '_con'] = df_tmp[f + '_dist1'] - df_tmp[f + '_dist2']
     df_tmp['spk_id'] = 0
     df_tmp.set_index(['ses_type', 'ses_id', 'tsk_id', 'spk_id'], inplace=True)
-    df_results_raw = pd.concat([df_results_raw, df_tmp], axis=0)
+    return pd.concat([df_results_raw, df_tmp], axis=0)
 
-    return aux.get_df(results, ['ses_type',]), df_results_raw
 
+def gcon_from_dists(df_results_raw, ses_types=['GAME', 'CONV']):
+    ''' computes global convergence from distances as returned by
+    get_gcon_dists (e.g., of several sessions, concatenated)
+
+    args:
+        df_results_raw: pandas dataframe as returned by get_gcon_dists
+        ses_types: session types in the data (results per type only for
+            these)
+    returns:
+        pandas dataframe with results like gcon
+    '''
+    # symmetric rows, one per session (distances are symmetric)
+    df_ses = df_results_raw[
+        df_results_raw.index.get_level_values('spk_id') == 0]
+    results = {f: {} for f in cfg.FEATURES}
+    # compute global conv. per session type and feature
+    for ses_type in [0, 'GAME', 'CONV']:
+        if ses_type and ses_type not in ses_types:
+            continue
+        df_type = df_ses if not ses_type else df_ses[
+            df_ses.index.get_level_values('ses_type') == ses_type]
+        for f in cfg.FEATURES:
+            # ignore rows with missing values
+            d1 = df_type[f + '_dist1'].values
+            d2 = df_type[f + '_dist2'].values
+            fltr = ~np.isnan(d1) & ~np.isnan(d2)
+            results[f][ses_type] = aux.ttest_rel(d1[fltr], d2[fltr])
+    return aux.get_df(results, ['ses_type',])
 
-def gsim(df_bt, df_spk_pairs_orig):
-    ''' computes global similarity for given data
+
+def gcon(df_bt):
+    ''' computes global convergence for given data
 
     args:
         df_bt: "big table" pandas dataframe as returned by load_data
-        df_spk_pairs_orig: speaker pairs dataframe based on cfg.SQL_SP_FNAME
     returns:
         pandas dataframe with results (t-statistic, p-value, degrees of 
-        freedom) per feature, indexed by session_type; 
-        second df with raw means/sims per interaction 
+        freedom), indexed by session type; second dataframe with raw first and
+        second half distances between speakers
+    '''
+    df_results_raw = get_gcon_dists(df_bt)
+    return gcon_from_dists(df_results_raw, set(df_bt['ses_type'])), \
+        df_results_raw
+
+
+def get_gsim_sums(df_bt):
+    ''' computes feature sums and counts per session, task, and speaker (gsim)
+
+    from these, the means per task and per session follow; sums of several
+    sessions can be concatenated (see iter_data)
+
+    args:
+        df_bt: "big table" pandas dataframe as returned by load_data
+    returns:
+        tuple of pandas dataframes with sums and with counts per feature,
+        indexed by ses_type, ses_id, tsk_id, and spk_id
     '''
-    df_sub = df_bt[df_bt['p_or_x'] != 'x'].copy()
+    df_sub = df_bt[df_bt['p_or_x'] != 'x']
+    grp_cols = ['ses_type', 'ses_id', 'tsk_id', 'spk_id']
+    df_grps = df_sub.groupby(grp_cols)[cfg.FEATURES]
+    return df_grps.sum(), df_grps.count()
+
+
+def gsim_from_sums(df_sums, df_cnts, df_spk_pairs_orig, n_perm=0, n_jobs=None,
+                   seed=0):
+    ''' computes global similarity from sums as returned by get_gsim_sums
+
+    args:
+        df_sums, df_cnts: feature sums and counts, see get_gsim_sums
+        (others see gsim)
+    returns:
+        see gsim
+    '''
+    sim_cols = [f + '_sim' for f in cfg.FEATURES]
+    grp_cols = ['ses_type', 'ses_id', 'tsk_id', 'spk_id']
+    ses_types = set(df_sums.index.get_level_values('ses_type'))
 
     results = {f: {} for f in cfg.FEATURES}
-    df_results_raw = pd.DataFrame()
+    dfs_raw = []
     for tsk_or_ses in ['tsk', 'ses']:
-        if tsk_or_ses == 'ses':
-            # do not differentiate between tasks for session measure
-            # ('ses' run second, so df_sub can be overwritten)
-            df_sub['tsk_id'] = 0
-        # compute the means per session, task, and speaker for all features
-        grp_cols = ['ses_type', 'ses_id', 'tsk_id', 'spk_id']
-        df_means = df_sub.loc[:,grp_cols+cfg.FEATURES].groupby(grp_cols).mean()
-        # get copy of df_spk_pairs for this iteration
-        df_spk_pairs = df_spk_pairs_orig.copy()
-        # filter out unnecessary rows from speaker pairs
         if tsk_or_ses == 'tsk':
-            df_spk_pairs = df_spk_pairs[df_spk_pairs['tsk_id'] != 0]
+            keys = grp_cols
+            df_spk_pairs = df_spk_pairs_orig[df_spk_pairs_orig['tsk_id'] != 0]
         else:
-            df_spk_pairs = df_spk_pairs[df_spk_pairs['tsk_id'] == 0]
-        # join feature means
-        df_spk_pairs = df_spk_pairs.join(df_means, on=grp_cols)
-        on = ['ses_type', 'ses_id_paired', 'tsk_id_paired', 'spk_id_paired']
-        df_spk_pairs = df_spk_pairs.join(
-            df_means, on=on, lsuffix='', rsuffix='_paired')
-        # compute similarity between speakers (for partners and non-partners)
-        df_spk_pairs = _compute_sims(df_spk_pairs)
+            # do not differentiate between tasks for session measure
+            keys = ['ses_type', 'ses_id', 'spk_id']
+            df_sums = df_sums.groupby(keys).sum()
+            df_cnts = df_cnts.groupby(keys).sum()
+            df_spk_pairs = df_spk_pairs_orig[df_spk_pairs_orig['tsk_id'] == 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = df_sums.values / df_cnts.values
+        # speakers and paired speakers by integer index into the means
+        idx = df_sums.index.get_indexer(pd.MultiIndex.from_arrays(
+            [df_spk_pairs[k].values for k in keys]))
+        idx_paired = df_sums.index.get_indexer(pd.MultiIndex.from_arrays(
+            [df_spk_pairs[k if k == 'ses_type' else k + '_paired'].values
+             for k in keys]))
+        # similarity between speakers (for partners and non-partners)
+        vals = _gather(means, idx)
+        sims = -abs(vals - _gather(means, idx_paired))
+        df = pd.DataFrame(
+            np.hstack([vals, sims]), columns=cfg.FEATURES + sim_cols)
+        grp_cols_pairs = ['ses_type', 'ses_id', 'p_or_x', 'tsk_id', 'spk_id']
+        for c in grp_cols_pairs:
+            df[c] = df_spk_pairs[c].values
         # compute mean partner (mean of 1 val) and non-partner sims 
         # per session, task, *and* speaker
-        grp_cols = ['ses_type', 'ses_id', 'p_or_x', 'tsk_id', 'spk_id']
-        loc_cols = grp_cols + cfg.FEATURES + [f + '_sim' for f in cfg.FEATURES]
-        df_tmp = df_spk_pairs.loc[:, loc_cols].groupby(grp_cols).mean()
+        df_tmp = df.groupby(grp_cols_pairs).mean()
         # compute mean partner (mean of 2 identical vals) and non-partner sims
         # per session and task, *without* speaker
         # (not used below but included in df_results_raw for later use)
-        grp_cols = ['ses_type', 'ses_id', 'p_or_x', 'tsk_id']
-        loc_cols = grp_cols + cfg.FEATURES + [f + '_sim' for f in cfg.FEATURES]
-        df_spk_pairs = df_spk_pairs.loc[:, loc_cols].groupby(grp_cols).mean()
-        df_spk_pairs['spk_id'] = 0
-        df_spk_pairs.set_index(['spk_id'], append=True, inplace=True)
-        # concatenate results for with and without speaker
-        df_spk_pairs = pd.concat([df_tmp, df_spk_pairs], axis=0)
+        df_tmp_all = df.groupby(grp_cols_pairs[:-1])[
+            cfg.FEATURES + sim_cols].mean()
+        df_tmp_all['spk_id'] = 0
+        df_tmp_all.set_index(['spk_id'], append=True, inplace=True)
+        df_tmp = pd.concat([df_tmp, df_tmp_all], axis=0)
         # self-join to get values for partners and non-partners in each row
-        df_spk_pairs = pd.DataFrame(df_spk_pairs.xs('p', level=2)).join( 
-             df_spk_pairs.xs('x', level=2), lsuffix='_p', rsuffix='_x')
+        df_tmp = pd.DataFrame(df_tmp.xs('p', level=2)).join(
+             df_tmp.xs('x', level=2), lsuffix='_p', rsuffix='_x')
         # compute global sim. per session type (all, games, convs) and feature
-        df_spk_pairs['spk_id'] = [v[3] for v in df_spk_pairs.index]
         if tsk_or_ses == 'ses':
+            # ignore samples without speaker
+            df_spk = df_tmp[df_tmp.index.get_level_values(3) != 0]
             for f in cfg.FEATURES: 
                 for ses_type in [0, 'GAME', 'CONV']:
-                    if ses_type and ses_type not in set(df_sub['ses_type']):
+                    if ses_type and ses_type not in ses_types:
                         continue
-                    df_sub2 = df_spk_pairs.loc[ses_type] if ses_type \
-                        else df_spk_pairs
-                    # ignore samples without speaker
-                    df_sub2 = df_sub2[df_sub2['spk_id']!=0]
+                    df_sub2 = df_spk.loc[ses_type] if ses_type else df_spk
                     # ignore samples with missing non-partner values
                     df_sub2 = df_sub2[pd.notna(df_sub2[f + '_sim_x'])]
                     results[f][ses_type] = aux.ttest_rel(df_sub2[f + '_sim_p'], 
                                                          df_sub2[f + '_sim_x'])
-        df_results_raw = pd.concat([df_results_raw, df_spk_pairs], axis=0)
+            if n_perm > 0:
+                # same samples as for the t-tests, all session types at once
+                df_ses_type = pd.DataFrame(
+                    {'ses_type': df_spk.index.get_level_values(0)})
+                for f in cfg.FEATURES:
+                    fltr = pd.notna(df_spk[f + '_sim_x']).values
+                    keys = [(ses_type,) for ses_type in results[f]]
+                    p = aux.perm_test(
+                        (df_spk[f + '_sim_p'] - df_spk[f + '_sim_x']).values[
+                            fltr],
+                        _get_grp_matrix(df_ses_type[fltr], keys, ['ses_type']),
+                        n_perm=n_perm, n_jobs=n_jobs, seed=seed)
+                    for (ses_type,), p_key in zip(keys, p):
+                        results[f][ses_type] += (p_key,)
+        dfs_raw += [df_tmp]
     # clean up columns in dataframe with intermediate columns
-    df_results_raw.drop('spk_id', axis=1, inplace=True)
+    df_results_raw = pd.concat(dfs_raw, axis=0)
     df_results_raw.drop([f + '_x' for f in cfg.FEATURES], axis=1, inplace=True)
     df_results_raw.rename(
         columns={f + '_p': f for f in cfg.FEATURES}, inplace=True)
@@ -469,8 +1133,24 @@ def gsim(df_bt, df_spk_pairs_orig):
     return aux.get_df(results, ['ses_type']), df_results_raw
 
 
+def gsim(df_bt, df_spk_pairs_orig, n_perm=0, n_jobs=None, seed=0):
+    ''' computes global similarity for given data
 
+    optionally, significance is also determined with a permutation test of
+    the mean difference between partner and non-partner similarity,
+    swapping the two at random per speaker (see aux.perm_test)
 
-
-
-
+    args:
+        df_bt: "big table" pandas dataframe as returned by load_data
+        df_spk_pairs_orig: speaker pairs dataframe as returned by 
+            spk.get_spk_pairs (or based on cfg.SQL_SP_FNAME)
+        n_perm: number of permutations (0 for no permutation test)
+        n_jobs: number of processes for the permutation test
+        seed: random seed for the permutation test
+    returns:
+        pandas dataframe with results (t-statistic, p-value, degrees of 
+        freedom, and empirical p-value if n_perm > 0) per feature, indexed by
+        session_type; second df with raw means/sims per interaction 
+    '''
+    return gsim_from_sums(*get_gsim_sums(df_bt), df_spk_pairs_orig, n_perm,
+                          n_jobs, seed)
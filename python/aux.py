@@ -1,9 +1,13 @@
+import concurrent.futures
+import functools
 import hyphenate
 import math
 import nltk
 from nltk.corpus import wordnet
+import numpy as np
 import pandas as pd
 import scipy
+import scipy.sparse
 
 import cfg
 
@@ -51,37 +55,41 @@ def preprocess_sb_token(in_token):
 
 def count_syllables(in_str):
     ''' counts the number of syllables in a given string '''
-    syll_count = 0
-    for word in in_str.split(' '):
-        ### PREPROCESSING
-        # remove whitespace and convert to lowercase for dictionary lookup
-        word = word.strip().lower()
-        # '-' marks incomplete words; remove it
-        if len(word) > 0 and word[-1] == '-':
-            word = word[:-1]
-        # remove trailing "'s" if word with it is not in dictionary
-        # (does not change syllable count) 
-        if len(word) > 1 and word[-2:] == "'s" and word not in cmu_dict:
-            word = word[:-2]
-
-        ### SPECIAL CASES
-        # there are no syllables in an empty string
-        if len(word) == 0:
-            syll_count += 0
-        # unintelligible speech transcribed as '?'; treat as one syllable
-        elif '?' in word:
-            syll_count += sum([1 if c == '?' else 0 for c in word])
-        ### STANDARD METHOD (dictionary lookup; fallback: automatic hyphenation)
-        elif word in cmu_dict:
-            # word is in the dictionary, extract number of vowels in primary
-            # pronunciation as syllable count; vowels are recognizable by their 
-            # stress markers (final digit), for example:
-            #     cmu_dict["natural"][0] = ['N', 'AE1', 'CH', 'ER0', 'AH0', 'L']
-            syll_count += sum([1 for p in cmu_dict[word][0] if p[-1].isdigit()])
-        else:
-            # fall back to the hyphenate library for a best guess (imperfect)
-            syll_count += len(hyphenate.hyphenate_word(word))
-    return syll_count
+    return sum([_count_word_syllables(word) for word in in_str.split(' ')])
+
+
+@functools.lru_cache(maxsize=None)
+def _count_word_syllables(word):
+    ''' counts the number of syllables in a given word (memoized, the same
+    words recur throughout a corpus) '''
+    ### PREPROCESSING
+    # remove whitespace and convert to lowercase for dictionary lookup
+    word = word.strip().lower()
+    # '-' marks incomplete words; remove it
+    if len(word) > 0 and word[-1] == '-':
+        word = word[:-1]
+    # remove trailing "'s" if word with it is not in dictionary
+    # (does not change syllable count) 
+    if len(word) > 1 and word[-2:] == "'s" and word not in cmu_dict:
+        word = word[:-2]
+
+    ### SPECIAL CASES
+    # there are no syllables in an empty string
+    if len(word) == 0:
+        return 0
+    # unintelligible speech transcribed as '?'; treat as one syllable
+    elif '?' in word:
+        return sum([1 if c == '?' else 0 for c in word])
+    ### STANDARD METHOD (dictionary lookup; fallback: automatic hyphenation)
+    elif word in cmu_dict:
+        # word is in the dictionary, extract number of vowels in primary
+        # pronunciation as syllable count; vowels are recognizable by their 
+        # stress markers (final digit), for example:
+        #     cmu_dict["natural"][0] = ['N', 'AE1', 'CH', 'ER0', 'AH0', 'L']
+        return sum([1 for p in cmu_dict[word][0] if p[-1].isdigit()])
+    else:
+        # fall back to the hyphenate library for a best guess (imperfect)
+        return len(hyphenate.hyphenate_word(word))
 
 
 def get_df(data, index_names):
@@ -152,6 +160,84 @@ def r2z(r):
     return 0.5 * (math.log(1 + r) - math.log(1 - r))
 
 
+def swap_signs(rng, n, d):
+    ''' null values for perm_test: differences with randomly swapped signs
+
+    (i.e., the labels of both values of a pair are swapped at random)
+    '''
+    return d * (rng.integers(0, 2, (n, len(d)), dtype=np.int8) * 2 - 1)
+
+
+def _perm_counts(null_func, null_args, grps, means, n_perm, seed_seq):
+    ''' counts group means in permutations at least/most as large as given '''
+    rng = np.random.default_rng(seed_seq)
+    cnts = grps.sum(axis=0).A1
+    ge = np.zeros(len(means), dtype=int)
+    le = np.zeros(len(means), dtype=int)
+    # permutations in blocks of limited size (block x rows values)
+    block = max(1, 2**22 // grps.shape[0])
+    for i in range(0, n_perm, block):
+        vals = null_func(rng, min(block, n_perm - i), *null_args)
+        # group means per permutation (rows) and group (columns)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means_perm = (grps.T @ vals.T).T / cnts
+            ge += (means_perm >= means - 1e-12).sum(axis=0)
+            le += (means_perm <= means + 1e-12).sum(axis=0)
+    return ge, le
+
+
+def perm_test(vals, grps, null_func=swap_signs, null_args=None, n_perm=10000,
+              n_jobs=None, seed=0):
+    ''' permutation test of mean of given values for many groups at once
+
+    null values for all rows are drawn per permutation (vectorized, in blocks
+    of permutations) and group means are computed as one sparse matrix 
+    product; permutations are distributed across processes
+
+    args:
+        vals: numpy array of observed values per row (e.g., differences
+            between paired values, as for ttest_rel)
+        grps: scipy sparse matrix, 1 if row (row) belongs to group (column),
+            rows may belong to any number of groups
+        null_func: module-level function returning a numpy array of null
+            values per permutation (rows) and row (columns), given a numpy
+            random generator, number of permutations and null_args
+        null_args: tuple of further arguments for null_func (default: vals)
+        n_perm: number of permutations
+        n_jobs: number of processes (default: number of cpus; 1 runs all
+            permutations in this process)
+        seed: random seed, same seed yields same result for any n_jobs
+    returns:
+        numpy array with two-sided empirical p-value per group (nan for
+        groups with less than two rows)
+    '''
+    grps = scipy.sparse.csc_matrix(grps, dtype=float)
+    null_args = (vals,) if null_args is None else null_args
+    cnts = grps.sum(axis=0).A1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (grps.T @ vals) / cnts
+    # fixed chunks of permutations, each with its own random stream
+    n_chunks = math.ceil(n_perm / 1000)
+    seed_seqs = np.random.SeedSequence(seed).spawn(n_chunks)
+    args = [(null_func, null_args, grps, means,
+             min(1000, n_perm - i * 1000), seed_seqs[i])
+            for i in range(n_chunks)]
+    ge = np.zeros(len(means), dtype=int)
+    le = np.zeros(len(means), dtype=int)
+    if n_jobs == 1:
+        counts = [_perm_counts(*a) for a in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+            counts = list(executor.map(_perm_counts, *zip(*args)))
+    for ge_chunk, le_chunk in counts:
+        ge += ge_chunk
+        le += le_chunk
+    # observed result counts as one permutation (no p-values of 0)
+    p = np.minimum(1.0, 2 * (np.minimum(ge, le) + 1) / (n_perm + 1))
+    p[cnts < 2] = np.nan
+    return p
+
+
 
            
 
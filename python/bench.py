@@ -0,0 +1,329 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import os
+import pandas as pd
+import resource
+import shutil
+import threading
+import time
+
+import ana
+import ap
+import aux
+import cfg
+import db
+import gen
+import jit
+import lex
+import spk
+
+# this module times all processing stages on synthetic corpora of increasing
+# size (see gen.py), recording wall time, cpu time, and peak memory per stage,
+# so that regressions and asymptotic blowups become visible in scaling curves
+#
+# all benchmark data is written below a separate path and cfg is pointed there
+# for the switchboard corpus id (cfg.CORPUS_ID_SB) while benchmarks run
+
+
+
+# kernels timed by run_kernels (see jit.py; syllables: memoized per word, see
+# aux.count_syllables)
+KERNELS = ['kld', 'turns', 'syllables']
+# all stages in the order in which they are run (later ones use the results
+# of earlier ones; stages needing srilm are skipped if it is not installed)
+STAGES = [
+    'aux_tables', 'speaker_pairs', 'spk_pairs', 'load_data', 'lsim', 'syn',
+    'lcon', 'gcon', 'gsim', 'entropy_weights', 'kld', 'hfw', 'ppl',
+    'get_samples', 'correlate_columns', 'chisquare', 'kmeans'
+]
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _get_rss():
+    ''' returns current resident set size of this process in MB '''
+    try:
+        with open('/proc/self/statm') as statm_file:
+            pages = int(statm_file.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        # no procfs, fall back to peak of the entire process (KB on linux)
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def _measure(func, interval=0.01):
+    ''' runs given function, measures time and peak memory while it runs
+
+    returns:
+        tuple of function result, wall time and cpu time in seconds, and
+        peak rss and rss increase (peak minus rss before) in MB
+    '''
+    rss_start = _get_rss()
+    rss_peak = [rss_start]
+    done = threading.Event()
+    def __sample():
+        while not done.wait(interval):
+            rss_peak[0] = max(rss_peak[0], _get_rss())
+    thread = threading.Thread(target=__sample, daemon=True)
+    thread.start()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        res = func()
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        done.set()
+        thread.join()
+    rss_peak = max(rss_peak[0], _get_rss())
+    return res, wall, cpu, rss_peak, rss_peak - rss_start
+
+
+def _set_paths(path):
+    ''' points cfg to the benchmark corpus in given path (switchboard id) '''
+    cfg.DB_FNAME_SB = path + 'bench.db'
+    cfg.LMN_PATH_SB = path + 'lm_ngrams/'
+    cfg.VOCAB_FNAME_SB = cfg.LMN_PATH_SB + 'vocab.txt'
+    cfg.DUMP_PATH_SB = path + 'dumps/'
+    for p in [cfg.LMN_PATH_SB, cfg.DUMP_PATH_SB]:
+        if os.path.isdir(p):
+            shutil.rmtree(p)
+        os.makedirs(p)
+
+
+def _get_stages(corpus_id, srilm):
+    ''' returns function per stage, operating on a dict of prior results '''
+    def __uniform_weights(res):
+        # without srilm, all non-partners of a speaker are weighted equally
+        df = res['spk_pairs'][res['spk_pairs']['tsk_id'] == 0].copy()
+        grp_cols = ['p_or_x', 'ses_id', 'tsk_id', 'spk_id']
+        df['weight'] = 1 / df.groupby(grp_cols)['spk_id'].transform('count')
+        return df
+    def __dict_df_meas(res):
+        dict_df_meas = {}
+        for mea_id, stage, i in [
+                (cfg.MEA_GSIM, 'gsim', 1), (cfg.MEA_GCON, 'gcon', 1),
+                (cfg.MEA_LSIM, 'lsim', None), (cfg.MEA_LCON, 'lcon', None),
+                (cfg.MEA_SYN, 'syn', None), (cfg.MEA_KLD, 'kld', 1),
+                (cfg.MEA_PPL, 'ppl', 1), (cfg.MEA_HFW, 'hfw', 1)]:
+            if stage in res:
+                dict_df_meas[mea_id] = \
+                    res[stage] if i is None else res[stage][i]
+        return dict_df_meas
+    grp_by = [cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK]
+    return {
+        'aux_tables': lambda res:
+            db.executescript(cfg.SQL_PATH, cfg.SQL_AT_FNAME),
+        'speaker_pairs': lambda res:
+            db.pd_read_sql_query(sql_fname=cfg.SQL_SP_FNAME),
+        'spk_pairs': lambda res: spk.get_spk_pairs(),
+        'load_data': lambda res: ap.load_data(cfg.NRM_SPK, ['gender']),
+        'lsim': lambda res: ap.lsim(res['load_data'], grp_by),
+        'syn': lambda res: ap.syn(res['load_data'], grp_by),
+        'lcon': lambda res: ap.lcon(res['load_data'], grp_by),
+        'gcon': lambda res: ap.gcon(res['load_data']),
+        'gsim': lambda res: ap.gsim(res['load_data'], res['spk_pairs']),
+        'entropy_weights': lambda res: lex.get_entropy_weights(
+            corpus_id, res['spk_pairs'][res['spk_pairs']['tsk_id'] == 0])
+            if srilm else __uniform_weights(res),
+        'kld': lambda res: lex.kld(corpus_id, res['entropy_weights']),
+        'hfw': lambda res: lex.dist_sim(
+            corpus_id, res['entropy_weights'], types_id=cfg.TYPES_ID_MF,
+            types=lex.get_mf_types(corpus_id)),
+        'ppl': lambda res: lex.ppl(corpus_id, res['entropy_weights']),
+        'get_samples': lambda res: ana.get_samples(
+            res['load_data'], __dict_df_meas(res)),
+        'correlate_columns': lambda res:
+            ana.correlate_columns(res['get_samples'][0]),
+        'chisquare': lambda res: ana.chisquare(res['get_samples'][1]),
+        'kmeans': lambda res: ana.kmeans(
+            res['get_samples'][0], min(4, len(res['get_samples'][0]) - 1), 2)
+    }
+
+
+def _get_kernel_funcs(kernel, n, rng):
+    ''' returns baseline and fast function (no args) for a kernel and size n
+
+    baseline is the fallback (numpy) version, fast the compiled version (the
+    fallback again if numba is not installed); for syllables, baseline counts
+    without, fast with memoized counts per word
+    '''
+    if kernel == 'kld':
+        args = []
+        for _ in range(2):
+            seen = rng.random(n) < 0.7
+            p = np.where(seen, rng.random(n), 0.0)
+            args += [p / p.sum(), seen]
+        epsilon = min(args[0][args[1]].min(), args[2][args[3]].min()) / 10
+        return [lambda use_jit=use_jit: jit.kld(
+                    args[0], args[2], args[1], args[3], epsilon, use_jit)
+                for use_jit in [False, True]]
+    if kernel == 'turns':
+        spk_idx = rng.integers(0, 2, n)
+        ends = np.cumsum(rng.random(n)) + 2 * rng.random(n)
+        return [lambda use_jit=use_jit: jit.turns(spk_idx, ends, 0, use_jit)
+                for use_jit in [False, True]]
+    words = list(aux.cmu_dict.keys())
+    texts = [' '.join(words[i] for i in rng.integers(0, len(words), 10))
+             for _ in range(max(n // 10, 1))]
+    func = aux._count_word_syllables
+    return [lambda: [sum(func.__wrapped__(w) for w in t.split(' '))
+                     for t in texts],
+            lambda: [aux.count_syllables(t) for t in texts]]
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def run(path, scales=[25, 50, 100, 200], stages=STAGES, gen_args={},
+        verbose=True):
+    ''' runs all given stages on synthetic corpora of all given sizes
+
+    args:
+        path: directory (with trailing "/") for benchmark data (overwritten)
+        scales: numbers of sessions of the synthetic corpora
+        stages: names of stages to run (see STAGES; prerequisites of given
+            stages are not added automatically)
+        gen_args: further arguments for gen.generate (except n_ses)
+        verbose: whether to print each measurement
+    returns:
+        pandas dataframe with one row per scale and stage: number of sessions
+        and chunks, wall and cpu time (s), peak rss and rss increase (MB),
+        and a note (e.g., why a stage was skipped)
+    '''
+    corpus_id = cfg.CORPUS_ID_SB
+    srilm = shutil.which('ngram-count') is not None
+    funcs = _get_stages(corpus_id, srilm)
+    rows = []
+    for n_ses in scales:
+        _set_paths(path)
+        counts = gen.generate(
+            cfg.DB_FNAME_SB, cfg.LMN_PATH_SB, n_ses=n_ses, **gen_args)
+        db.connect(corpus_id)
+        lex.clear_memos()
+        if srilm:
+            lex.store_lms_ngrams(corpus_id)
+        res = {}
+        for stage in stages:
+            note = ''
+            if stage == 'ppl' and not srilm:
+                rows += [(n_ses, counts['chunks'], stage) + (np.nan,) * 4
+                         + ('skipped, srilm not installed',)]
+                continue
+            if stage == 'entropy_weights' and not srilm:
+                note = 'uniform weights, srilm not installed'
+            res[stage], wall, cpu, rss_peak, rss_inc = _measure(
+                lambda: funcs[stage](res))
+            rows += [(n_ses, counts['chunks'], stage, wall, cpu, rss_peak,
+                      rss_inc, note)]
+            if verbose:
+                print('%5d sessions %-18s %8.2fs wall %8.2fs cpu %8.1fMB'
+                      % (n_ses, stage, wall, cpu, rss_peak))
+        db.close()
+    return pd.DataFrame(rows, columns=[
+        'n_ses', 'n_chunks', 'stage', 'wall', 'cpu', 'rss_peak', 'rss_inc',
+        'note'])
+
+
+def get_exponents(df_bench, col='wall'):
+    ''' estimates the scaling exponent per stage (slope in log-log space)
+
+    an exponent of 1 means linear scaling in the number of chunks, 2 means
+    quadratic etc.; based on the two largest scales, which are least affected
+    by constant overhead
+
+    args:
+        df_bench: benchmark results as returned by run
+        col: column with measurements (e.g., "wall" or "rss_inc")
+    returns:
+        pandas series with exponent per stage
+    '''
+    exps = {}
+    for stage, df in df_bench.groupby('stage', sort=False):
+        df = df[pd.notna(df[col]) & (df[col] > 0)].sort_values('n_chunks')
+        if len(df) < 2:
+            exps[stage] = np.nan
+            continue
+        x = np.log(df['n_chunks'].values[-2:])
+        y = np.log(df[col].values[-2:])
+        exps[stage] = (y[1] - y[0]) / (x[1] - x[0])
+    return pd.Series(exps, name=col + '_exponent')
+
+
+def plot(df_bench, col='wall', fname=None):
+    ''' plots scaling curves (log-log) of given measurement for all stages '''
+    y_label = {
+        'wall': 'wall time (s)', 'cpu': 'cpu time (s)',
+        'rss_peak': 'peak rss (MB)', 'rss_inc': 'rss increase (MB)'
+    }.get(col, col)
+    fig, ax = plt.subplots()
+    for stage, df in df_bench.groupby('stage', sort=False):
+        df = df[pd.notna(df[col])]
+        if len(df) > 0:
+            ax.plot(df['n_chunks'], df[col], 'o-', label=stage)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    fig.set_size_inches(8, 6)
+    plt.xlabel('number of chunks', fontsize=14)
+    plt.ylabel(y_label, fontsize=14)
+    plt.legend(prop={'size': 9}, ncol=2)
+    plt.grid()
+    plt.tight_layout()
+    if fname is None:
+        plt.show()
+    else:
+        plt.savefig(fname)
+    plt.close()
+
+
+def run_kernels(sizes=[1000, 10000, 100000], kernels=KERNELS, n_rep=5, seed=0,
+            verbose=True):
+    ''' times baseline and fast version of each kernel, checks their results
+
+    fast versions are run once before timing (compilation, memoization);
+    results of both versions must be equal (floats up to 1e-9, relative)
+
+    args:
+        sizes: input sizes (types for kld, chunks for turns, words for
+            syllables)
+        kernels: names of kernels to time (see KERNELS)
+        n_rep: number of repetitions, the fastest is reported
+        seed: random seed for the inputs
+        verbose: whether to print each measurement
+    returns:
+        pandas dataframe with one row per kernel and size: wall time (s) of
+        baseline and fast version (best of n_rep), speedup, and a note
+    '''
+    rows = []
+    for kernel in kernels:
+        assert kernel in KERNELS, 'unknown kernel'
+        note = '' if jit.is_available() or kernel == 'syllables' \
+            else 'numba not installed, fast version is the fallback'
+        for n in sizes:
+            funcs = _get_kernel_funcs(kernel, n, np.random.default_rng(seed))
+            res = [func() for func in funcs]
+            for r0, r1 in zip(*[r if isinstance(r, (tuple, list)) else [r]
+                                for r in res]):
+                assert np.allclose(r0, r1, rtol=1e-9, atol=0), \
+                    'results of baseline and fast version differ'
+            times = []
+            for func in funcs:
+                best = np.inf
+                for _ in range(n_rep):
+                    wall = time.perf_counter()
+                    func()
+                    best = min(best, time.perf_counter() - wall)
+                times += [best]
+            rows += [(kernel, n, times[0], times[1], times[0] / times[1],
+                      note)]
+            if verbose:
+                print('%-10s %8d %10.5fs base %10.5fs fast %6.1fx' % (
+                    kernel, n, times[0], times[1], times[0] / times[1]))
+    return pd.DataFrame(rows, columns=[
+        'kernel', 'n', 'wall_base', 'wall_fast', 'speedup', 'note'])
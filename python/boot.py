@@ -0,0 +1,384 @@
+import concurrent.futures
+import math
+import numpy as np
+import pandas as pd
+import scipy.stats
+
+import ap
+import aux
+import cfg
+
+# this module computes bootstrap confidence intervals (percentile and bca) for
+# all entrainment measures, per feature and grouping level
+#
+# each measure's statistic is a function of a few sums over units (e.g., chunk
+# pairs or speakers in sessions), so these sums are computed once per unit and
+# every replicate only reweights them: a replicate draws units with
+# replacement, which amounts to a weight (number of draws) per unit, and the
+# statistic follows from the weighted sums; no replicate touches raw data,
+# let alone language models (lexical measures are bootstrapped from their raw
+# results)
+#
+# statistics: mean local similarity for lsim (as used in ana.get_samples),
+# pearson's r for syn and lcon, mean difference between partner and
+# non-partner values (the effect tested by the t-tests) for gsim, gcon, kld,
+# ppl, and hfw (for gcon: first minus second half distance)
+#
+# resampling: for results of one session (or task, speaker), units within
+# that group are resampled; for results across sessions (per session type),
+# entire sessions are resampled (cluster bootstrap, units of a session are
+# not independent)
+
+
+
+# types of statistics: mean of one column, pearson's r between two columns
+STAT_MEAN = 'mean'
+STAT_R = 'r'
+STATS = [STAT_MEAN, STAT_R]
+# key columns per grouping level (others are 0 in result keys, "all");
+# GRP_BY_ALL (only used here) for results across all session types
+GRP_BY_ALL = 'all'
+GRP_COLS = dict({GRP_BY_ALL: []}, **cfg.GRP_BY_COLS)
+# number of replicates per task for worker processes
+CHUNK_SIZE = 250
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _get_stat(stat, sums):
+    ''' computes given statistic from sums (last axis, see _get_sums) '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if stat == STAT_MEAN:
+            return sums[..., 1] / sums[..., 0]
+        n, sx, sy, sxx, syy, sxy = [sums[..., j] for j in range(6)]
+        cov = sxy - sx * sy / n
+        var_x = sxx - sx**2 / n
+        var_y = syy - sy**2 / n
+        # constant values (pearson's r undefined) yield nan like in ap
+        var_x[var_x <= 1e-12 * np.maximum(sxx, 1e-300)] = np.nan
+        var_y[var_y <= 1e-12 * np.maximum(syy, 1e-300)] = np.nan
+        r = cov / np.sqrt(var_x * var_y)
+        r[n < 3] = np.nan
+        return np.clip(r, -1.0, 1.0)
+
+
+def _get_sums(stat, x, y=None):
+    ''' returns sums per unit (rows) the given statistic is based on '''
+    if stat == STAT_MEAN:
+        return np.stack([np.ones(len(x)), x], axis=1)
+    return np.stack([np.ones(len(x)), x, y, x * x, y * y, x * y], axis=1)
+
+
+def _boot_stats(stat, sums_cl, cl_start, cl_len, grp_start, n, seed_seq):
+    ''' computes statistic per group for n bootstrap replicates
+
+    args:
+        stat: type of statistic (see STATS)
+        sums_cl: numpy array with sums per cluster (rows), clusters sorted by
+            group
+        cl_start, cl_len: numpy arrays with index of first cluster and number
+            of clusters of the group of each cluster
+        grp_start: numpy array with index of first cluster per group
+        n: number of replicates
+        seed_seq: numpy seed sequence for random numbers
+    returns:
+        numpy array with statistic per replicate (rows) and group (columns)
+    '''
+    rng = np.random.default_rng(seed_seq)
+    n_cl = len(sums_cl)
+    # each cluster is replaced by a random cluster of the same group, the
+    # number of times a cluster is drawn is its weight
+    draws = cl_start + (rng.random((n, n_cl)) * cl_len).astype(int)
+    draws += (np.arange(n) * n_cl)[:, None]
+    weights = np.bincount(draws.ravel(), minlength=n * n_cl).reshape(n, n_cl)
+    sums = np.stack([
+        np.add.reduceat(weights * sums_cl[:, j], grp_start, axis=1)
+        for j in range(sums_cl.shape[1])], axis=2)
+    return _get_stat(stat, sums)
+
+
+def _get_quantiles(stats, q):
+    ''' returns quantiles per column of stats (ignoring nan), q per column '''
+    stats = np.sort(stats, axis=0)
+    # undefined quantiles (e.g., no bias correction) are set to nan by caller
+    q = np.where(np.isnan(q), 0.5, q)
+    n_valid = (~np.isnan(stats)).sum(axis=0)
+    pos = q * (n_valid - 1)
+    lo = np.clip(np.floor(pos).astype(int), 0, len(stats) - 1)
+    hi = np.clip(lo + 1, 0, np.maximum(n_valid - 1, 0))
+    v_lo = np.take_along_axis(stats, lo[None, :], axis=0)[0]
+    v_hi = np.take_along_axis(stats, hi[None, :], axis=0)[0]
+    res = v_lo + (pos - lo) * (v_hi - v_lo)
+    res[n_valid == 0] = np.nan
+    return res
+
+
+def _bootstrap(stat, sums, grps, cls, n_boot, alpha, n_jobs, seed):
+    ''' bootstraps given statistic for groups of units
+
+    args:
+        stat: type of statistic (see STATS)
+        sums: numpy array with sums per unit (see _get_sums)
+        grps: numpy array with group (0 to number of groups - 1) per unit
+        cls: numpy array with cluster per unit, units of a cluster are
+            resampled together; clusters must not span groups
+        (others see bootstrap)
+    returns:
+        numpy array with estimate, percentile interval (lower, upper) and bca
+        interval (lower, upper) per group (rows)
+    '''
+    # sums per cluster, clusters sorted by group
+    keys, cl = np.unique(
+        np.stack([grps, cls], axis=1), axis=0, return_inverse=True)
+    cl = cl.reshape(-1)
+    cl_grp = keys[:, 0]
+    sums_cl = np.zeros((len(keys), sums.shape[1]))
+    np.add.at(sums_cl, cl, sums)
+    n_grps = cl_grp.max() + 1
+    cnt = np.bincount(cl_grp, minlength=n_grps)
+    grp_start = np.concatenate([[0], np.cumsum(cnt)[:-1]])
+    cl_start = grp_start[cl_grp]
+    cl_len = cnt[cl_grp]
+    # estimates from all data
+    sums_grp = np.add.reduceat(sums_cl, grp_start, axis=0)
+    est = _get_stat(stat, sums_grp)
+    # bootstrap replicates in chunks with their own random streams
+    n_chunks = math.ceil(n_boot / CHUNK_SIZE)
+    seed_seqs = np.random.SeedSequence(seed).spawn(n_chunks)
+    args = [(stat, sums_cl, cl_start, cl_len, grp_start,
+             min(CHUNK_SIZE, n_boot - i * CHUNK_SIZE), seed_seqs[i])
+            for i in range(n_chunks)]
+    if n_jobs == 1:
+        stats = [_boot_stats(*a) for a in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+            stats = list(executor.map(_boot_stats, *zip(*args)))
+    stats = np.concatenate(stats, axis=0)
+    # percentile intervals
+    pct = np.stack([_get_quantiles(stats, np.full(n_grps, a))
+                    for a in [alpha / 2, 1 - alpha / 2]], axis=1)
+    # bca: bias correction from fraction of replicates below estimate,
+    # acceleration from jackknife (leave one cluster out)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n_valid = (~np.isnan(stats)).sum(axis=0)
+        below = ((stats < est).sum(axis=0) + 0.5 * (stats == est).sum(axis=0))
+        z0 = scipy.stats.norm.ppf(below / n_valid)
+        jack = _get_stat(stat, sums_grp[cl_grp] - sums_cl)
+        jack[cl_len < 2] = np.nan
+        dev = np.bincount(cl_grp, jack, n_grps) / cnt
+        dev = dev[cl_grp] - jack
+        acc = np.bincount(cl_grp, dev**3, n_grps) \
+            / (6 * np.bincount(cl_grp, dev**2, n_grps)**1.5)
+        acc[~np.isfinite(acc)] = 0.0
+        bca = []
+        for a in [alpha / 2, 1 - alpha / 2]:
+            z = z0 + scipy.stats.norm.ppf(a)
+            bca += [_get_quantiles(
+                stats, scipy.stats.norm.cdf(z0 + z / (1 - acc * z)))]
+    res = np.column_stack([est, pct, np.stack(bca, axis=1)])
+    # too few clusters to resample, or no finite bias correction
+    res[cnt < 2, 1:] = np.nan
+    res[~np.isfinite(z0), 3:] = np.nan
+    return res
+
+
+def _get_results(df, stat, cols, grp_by, n_boot, alpha, n_jobs, seed,
+                 key_cols):
+    ''' bootstraps statistic of given columns for all given grouping levels
+
+    args:
+        df: pandas dataframe with one row per unit and columns ses_type,
+            ses_id and those in cols and key_cols
+        cols: one (mean) or two (r) value columns
+        key_cols: index columns of results
+        (others see bootstrap)
+    returns:
+        dict with tuple of estimate and intervals (see _bootstrap) per key
+    '''
+    df = df[pd.notna(df[cols]).all(axis=1)]
+    results = {}
+    for g in grp_by:
+        if len(df) == 0:
+            break
+        grp_cols = GRP_COLS[g]
+        grps = df.groupby(grp_cols, sort=False).ngroup().values \
+            if len(grp_cols) > 0 else np.zeros(len(df), dtype=int)
+        first = ~pd.Series(grps).duplicated().values
+        # units within a session are resampled for session, task, and
+        # speaker results, sessions for results across sessions
+        cls = np.arange(len(df)) if 'ses_id' in grp_cols \
+            else pd.factorize(df['ses_id'])[0]
+        vals = [df[c].values.astype(float) for c in cols]
+        if stat == STAT_R:
+            # center per group (r is unchanged) for numerically stable sums
+            vals = [v - (np.bincount(grps, v) / np.bincount(grps))[grps]
+                    for v in vals]
+        res = _bootstrap(stat, _get_sums(stat, *vals), grps, cls, n_boot,
+                         alpha, n_jobs, seed)
+        # one key per group, 0 for all components not grouped by
+        keys = zip(*[df[c].values[first] if c in grp_cols
+                     else np.zeros(first.sum(), dtype=int) for c in key_cols])
+        for key, grp in zip(keys, grps[first]):
+            results[key if len(key) > 1 else key[0]] = tuple(res[grp])
+    return results
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def bootstrap(df, stat, cols, grp_by, n_boot=2000, alpha=0.05, n_jobs=None,
+              seed=0, key_cols=['ses_type', 'ses_id', 'tsk_id', 'spk_id']):
+    ''' bootstraps given statistic of given columns per group
+
+    args:
+        df: pandas dataframe with one row per unit and columns ses_type,
+            ses_id, and those in cols, key_cols, and GRP_COLS (as needed)
+        stat: STAT_MEAN (mean of one column) or STAT_R (pearson's r between
+            two columns)
+        cols: list of one (mean) or two (r) columns
+        grp_by: grouping levels (see GRP_COLS)
+        n_boot: number of bootstrap replicates
+        alpha: intervals cover 1 - alpha
+        n_jobs: number of processes (default: number of cpus; 1 runs all
+            replicates in this process)
+        seed: random seed, same seed yields same result for any n_jobs
+        key_cols: index columns of results
+    returns:
+        dict with tuple (estimate, percentile interval lower and upper bound,
+        bca interval lower and upper bound) per result key
+    '''
+    assert stat in STATS, 'unknown statistic'
+    assert len(cols) == (1 if stat == STAT_MEAN else 2), \
+        'wrong number of columns for statistic'
+    for g in grp_by:
+        assert g in GRP_COLS, 'unknown grp_by value found'
+    return _get_results(df, stat, cols, grp_by, n_boot, alpha, n_jobs, seed,
+                        key_cols)
+
+
+def lsim(df_bt, grp_by=cfg.GRP_BYS, **kwargs):
+    ''' bootstraps mean local similarity (see ap.lsim), units: turn exchanges
+
+    args:
+        df_bt: "big table" pandas dataframe as returned by ap.load_data
+        grp_by: list of constants from cfg.GRP_BYS
+        kwargs: further arguments for bootstrap (n_boot, alpha, n_jobs, seed)
+    returns:
+        pandas dataframe with results (estimate, percentile interval, bca
+        interval) per feature, indexed by ses_type, ses_id, tsk_id, and spk_id
+    '''
+    cfg.check_grp_by(grp_by)
+    df = ap.get_lsim_sims(df_bt).reset_index()
+    # exclude nan (NULL) feature values like ap.lsim
+    results = {
+        f: bootstrap(df[pd.notna(df[f + '_sim_p'])], STAT_MEAN, [f + '_lsim'],
+                     grp_by, **kwargs)
+        for f in cfg.FEATURES}
+    return aux.get_df(results, ['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+
+
+def syn(df_bt, grp_by=[g for g in cfg.GRP_BYS if g != cfg.GRP_BY_SES_TYPE],
+        **kwargs):
+    ''' bootstraps synchrony (see ap.syn), units: turn exchanges
+
+    args and returns: see lsim
+    '''
+    cfg.check_grp_by(grp_by, [g for g in cfg.GRP_BYS
+                              if g != cfg.GRP_BY_SES_TYPE])
+    df = df_bt[df_bt['p_or_x'] == 'p']
+    results = {f: bootstrap(df, STAT_R, [f, f + '_paired'], grp_by, **kwargs)
+               for f in cfg.FEATURES}
+    return aux.get_df(results, ['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+
+
+def lcon(df_bt, grp_by=[cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK], **kwargs):
+    ''' bootstraps local convergence (see ap.lcon), units: turn exchanges
+
+    args and returns: see lsim
+    '''
+    cfg.check_grp_by(grp_by, supported=[cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK])
+    df = df_bt[df_bt['p_or_x'] == 'p']
+    results = {
+        f: bootstrap(df, STAT_R, [f + '_sim', 'start_time'], grp_by, **kwargs)
+        for f in cfg.FEATURES}
+    return aux.get_df(results, ['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+
+
+def gsim(df_results_raw, **kwargs):
+    ''' bootstraps mean partner minus non-partner similarity (see ap.gsim)
+
+    units: speakers in sessions, resampled per session (both speakers)
+
+    args:
+        df_results_raw: raw results as returned by ap.gsim (second value)
+        kwargs: further arguments for bootstrap (n_boot, alpha, n_jobs, seed)
+    returns:
+        pandas dataframe with results (estimate, percentile interval, bca
+        interval) per feature, indexed by session type (0 for all)
+    '''
+    # same samples as the t-tests in ap.gsim
+    df = df_results_raw.reset_index()
+    df = df[(df['tsk_id'] == 0) & (df['spk_id'] != 0)]
+    results = {}
+    for f in cfg.FEATURES:
+        df_f = df.assign(_diff=df[f + '_sim_p'] - df[f + '_sim_x'])
+        results[f] = bootstrap(
+            df_f, STAT_MEAN, ['_diff'], [GRP_BY_ALL, cfg.GRP_BY_SES_TYPE],
+            key_cols=['ses_type'], **kwargs)
+    return aux.get_df(results, ['ses_type'])
+
+
+def gcon(df_results_raw, **kwargs):
+    ''' bootstraps mean first minus second half distance (see ap.gcon)
+
+    units: sessions
+
+    args:
+        df_results_raw: raw results as returned by ap.gcon (second value)
+        (others see gsim)
+    returns: see gsim
+    '''
+    # symmetric rows, one per session (same distances as in ap.gcon t-tests)
+    df = df_results_raw.reset_index()
+    df = df[df['spk_id'] == 0]
+    results = {}
+    for f in cfg.FEATURES:
+        df_f = df.assign(_diff=df[f + '_dist1'] - df[f + '_dist2'])
+        results[f] = bootstrap(
+            df_f, STAT_MEAN, ['_diff'], [GRP_BY_ALL, cfg.GRP_BY_SES_TYPE],
+            key_cols=['ses_type'], **kwargs)
+    return aux.get_df(results, ['ses_type'])
+
+
+def lex(df_results_raw, mea_col, **kwargs):
+    ''' bootstraps mean partner minus non-partner value of lexical measures
+
+    units: speakers in sessions, resampled per session (both speakers)
+
+    args:
+        df_results_raw: raw results as returned by lex.kld, lex.ppl, or
+            lex.dist_sim (second value)
+        mea_col: prefix of the measure's columns ("kld", "ppl", or "dsim")
+        (others see gsim)
+    returns:
+        pandas dataframe with results (estimate, percentile interval, bca
+        interval) for raw and weighted values, indexed by session type
+    '''
+    # same samples as the t-tests in lex.run_ttests
+    df = df_results_raw.reset_index()
+    df = df[(df['tsk_id'] == 0) & (df['spk_id'] != 0)]
+    df = df[pd.notna(df[mea_col + '_x'])]
+    results = {}
+    for raw_or_wgh, suffix in [('raw', ''), ('wgh', '_wgh')]:
+        df_r = df.assign(
+            _diff=df[mea_col + suffix + '_p'] - df[mea_col + suffix + '_x'])
+        results[raw_or_wgh] = bootstrap(
+            df_r, STAT_MEAN, ['_diff'], [GRP_BY_ALL, cfg.GRP_BY_SES_TYPE],
+            key_cols=['ses_type'], **kwargs)
+    return aux.get_df(results, ['ses_type'])
@@ -4,6 +4,8 @@ LMN_PATH_GC = '../../data/gc/lm_ngrams/'
 LMN_PATH_SB = '../../data/sb/lm_ngrams/'
 DUMP_PATH_GC = '../../data/gc/dumps/'
 DUMP_PATH_SB = '../../data/sb/dumps/'
+CONTOUR_PATH_GC = '../../data/gc/contours/'
+CONTOUR_PATH_SB = '../../data/sb/contours/'
 
 # corpus identifiers
 CORPUS_ID_GC  = 'GC'
@@ -18,19 +20,27 @@ META_PATH_SB = CORPUS_PATH_SB + 'meta/'
 # set as needed
 TMP_PATH = ''
 
+# maximum number of rows fetched from the database at once (see db.py)
+BATCH_SIZE = 10000
+
+# whether to compile hot loops with numba, if installed (see jit.py)
+USE_JIT = True
+
 # database filenames
 DB_FNAME_GC = '../../gc.db'
 DB_FNAME_SB = '../../sb.db'
 
 # praat and sql scripts
 PRAAT_SCRIPT_FNAME = '../praat/extract_features.praat'
-SQL_INIT_FNAME_GC = 'gc_init.sql'
-SQL_INIT_FNAME_SB = 'sb_init.sql'
+PRAAT_CONTOUR_FNAME = '../praat/extract_contours.praat'
+SQL_INIT_FNAME_GC = 'init_gc.sql'
+SQL_INIT_FNAME_SB = 'init_sb.sql'
 SQL_DM_FNAME = 'del_missing_ses.sql'
 SQL_CU_FNAME = 'cleanup.sql'
 SQL_AT_FNAME = 'aux_tables.sql'
 SQL_BT_FNAME = 'big_table.sql'
 SQL_SP_FNAME = 'speaker_pairs.sql'
+SQL_IX_FNAME = 'indexes.sql'
 
 # language model vocabulary filenames (contents computed in fio.store_texts)
 VOCAB_FNAME_GC = LMN_PATH_GC + 'vocab.txt'
@@ -67,6 +77,14 @@ GRP_BYS = [
     GRP_BY_TSK, 
     GRP_BY_TSK_SPK
 ]
+# key columns per grouping level (all others are 0 in results, i.e., "all")
+GRP_BY_COLS = {
+    GRP_BY_SES_TYPE: ['ses_type'],
+    GRP_BY_SES: ['ses_type', 'ses_id'],
+    GRP_BY_SES_SPK: ['ses_type', 'ses_id', 'spk_id'],
+    GRP_BY_TSK: ['ses_type', 'ses_id', 'tsk_id'],
+    GRP_BY_TSK_SPK: ['ses_type', 'ses_id', 'tsk_id', 'spk_id']
+}
 
 # IDs for memoization of token distributions (see lex.get_dist)
 TYPES_ID_MF = 'MOST_FREQUENT'
@@ -97,6 +115,22 @@ FEATURES = [
 #    'nhr',
     'rate_syl'
 ]
+# name of each feature in the output of fio.extract_features
+FEATURE_KEYS = {
+    'intensity_mean': 'int_mean',
+    'intensity_std': 'int_std',
+    'intensity_min': 'int_min',
+    'intensity_max': 'int_max',
+    'pitch_mean': 'f0_mean',
+    'pitch_std': 'f0_std',
+    'pitch_min': 'f0_min',
+    'pitch_max': 'f0_max',
+    'jitter': 'jitter',
+    'shimmer': 'shimmer',
+    'nhr': 'nhr',
+    'rate_syl': 'rate_syl',
+    'rate_vcd': 'vcd2tot_frames'
+}
 
 
 def check_corpus_id(corpus_id):
@@ -127,6 +161,11 @@ def get_lmn_path(corpus_id):
     return LMN_PATH_GC if corpus_id == CORPUS_ID_GC else LMN_PATH_SB
 
 
+def get_contour_path(corpus_id):
+    check_corpus_id(corpus_id)
+    return CONTOUR_PATH_GC if corpus_id == CORPUS_ID_GC else CONTOUR_PATH_SB
+
+
 def get_vocab_fname(corpus_id):
     check_corpus_id(corpus_id)
     return VOCAB_FNAME_GC if corpus_id == CORPUS_ID_GC else VOCAB_FNAME_SB
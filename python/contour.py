@@ -0,0 +1,272 @@
+import numpy as np
+import os
+import pandas as pd
+import subprocess
+
+import aux
+import cfg
+import db
+
+# this module caches frame-level contours (pitch, with unvoiced frames, and
+# intensity) of entire session channels, so that chunk features can be
+# recomputed from them (e.g., after the chunks are re-segmented, or for new
+# statistics) without cutting audio and running praat per chunk again
+#
+# contours are computed once per channel with cfg.PRAAT_CONTOUR_FNAME (same
+# settings as cfg.PRAAT_SCRIPT_FNAME) and stored as npy files of 16-bit
+# integers (values quantized, see _SCALES), a quarter of the size of floats,
+# which are memory-mapped when loaded, plus time of first frame and time step
+# per contour; chunk statistics are aggregated from the frames of all chunks
+# of a channel at once (see _segment_stats)
+#
+# jitter, shimmer, and nhr need the waveform (point processes) and are not
+# covered; they can still be extracted per chunk (see sb.extract_features with
+# features=['jitter', 'shimmer', 'nhr'])
+
+
+
+# contours stored per channel
+CONTOURS = ['pitch', 'intensity']
+# features that can be computed from contours (rate_syl from the transcript)
+FEATURES = [
+    'intensity_mean',
+    'intensity_std',
+    'intensity_min',
+    'intensity_max',
+    'pitch_mean',
+    'pitch_std',
+    'pitch_min',
+    'pitch_max',
+    'rate_syl',
+    'rate_vcd'
+]
+# quantiles that can be computed additionally (names as in earlier versions
+# of cfg.PRAAT_SCRIPT_FNAME, e.g., "f0_q1", "int_pct99")
+QUANTILES = {'pct1': 0.01, 'q1': 0.25, 'q2': 0.5, 'q3': 0.75, 'pct99': 0.99}
+# quantization of stored contours (value * scale, rounded), marker for
+# undefined frames (e.g., unvoiced)
+_SCALES = {'pitch': 10, 'intensity': 100}
+_UNDEF = np.iinfo(np.int16).min
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _get_pfn(corpus_id, ses_id, a_or_b):
+    ''' returns path and file name prefix for contour files of a channel '''
+    return cfg.get_contour_path(corpus_id), 'ses_%d_%s' % (ses_id, a_or_b)
+
+
+def _get_audio_fname(corpus_id, ses_id, a_or_b):
+    ''' returns name of the audio file of a channel (in corpus path) '''
+    cfg.check_corpus_id(corpus_id)
+    if corpus_id == cfg.CORPUS_ID_GC:
+        return 's%02d.objects.1.%s.wav' % (ses_id, a_or_b)
+    return 'sw%05d.%s.wav' % (ses_id, a_or_b)
+
+
+def _get_segments(t0, dt, n, starts, ends):
+    ''' returns first and last (exclusive) frame of each section
+
+    frames belong to a section if their time is within [start, end)
+    '''
+    lo = np.clip(np.ceil((np.asarray(starts) - t0) / dt - 1e-9), 0, n)
+    hi = np.clip(np.ceil((np.asarray(ends) - t0) / dt - 1e-9), 0, n)
+    return lo.astype(int), np.maximum(hi, lo).astype(int)
+
+
+def _segment_stats(vals, lo, hi, quantiles=[]):
+    ''' computes statistics of the values in each segment, vectorized
+
+    values of all segments are gathered, sorted by segment and value once,
+    and reduced per segment (undefined values are ignored)
+
+    args:
+        vals: numpy array with values per frame (nan if undefined)
+        lo, hi: numpy arrays with first and last (exclusive) frame per segment
+        quantiles: quantiles to compute (values between 0 and 1)
+    returns:
+        dict with numpy array per statistic: "n_frames" (all frames),
+        "n" (defined frames), "mean", "std", "min", "max", and per quantile
+    '''
+    n_seg = len(lo)
+    lens = hi - lo
+    seg = np.repeat(np.arange(n_seg), lens)
+    # frame indices of all segments (segments may overlap)
+    idx = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens) \
+        + np.repeat(lo, lens)
+    v = vals[idx]
+    fltr = ~np.isnan(v)
+    seg, v = seg[fltr], v[fltr]
+    order = np.lexsort((v, seg))
+    seg, v = seg[order], v[order]
+    n = np.bincount(seg, minlength=n_seg)
+    offsets = np.cumsum(n) - n
+    stats = {'n_frames': lens, 'n': n}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stats['mean'] = np.bincount(seg, v, minlength=n_seg) / n
+        stats['std'] = np.sqrt(np.bincount(
+            seg, (v - stats['mean'][seg])**2, minlength=n_seg) / (n - 1))
+    for name, q in [('min', 0.0), ('max', 1.0)] \
+            + [(q, q) for q in quantiles]:
+        # linear interpolation between closest ranks (as numpy.quantile)
+        pos = q * np.maximum(n - 1, 0)
+        below = np.floor(pos).astype(int)
+        above = np.minimum(below + 1, np.maximum(n - 1, 0))
+        i_below = np.minimum(offsets + below, max(len(v) - 1, 0))
+        i_above = np.minimum(offsets + above, max(len(v) - 1, 0))
+        res = np.full(n_seg, np.nan)
+        if len(v) > 0:
+            res = v[i_below] + (pos - below) * (v[i_above] - v[i_below])
+        stats[name] = np.where(n > 0, res, np.nan)
+    stats['std'][n < 2] = np.nan
+    return stats
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def store_contours(corpus_id, ses_id, overwrite=False):
+    ''' computes and stores contours of both channels of given session
+
+    args:
+        corpus_id: one of the corpus ids in cfg.CORPUS_IDS
+        ses_id: session to process
+        overwrite: whether to recompute contours that are already stored
+    returns:
+        number of channels processed
+    '''
+    in_path = cfg.get_corpus_path(corpus_id)
+    cnt = 0
+    for a_or_b in ['A', 'B']:
+        path, fname = _get_pfn(corpus_id, ses_id, a_or_b)
+        if not overwrite and os.path.isfile(path + fname + '_times.npy'):
+            continue
+        subprocess.check_call([
+            'praat', '--run', cfg.PRAAT_CONTOUR_FNAME,
+            in_path + _get_audio_fname(corpus_id, ses_id, a_or_b),
+            cfg.TMP_PATH + fname])
+        times = {}
+        for line in open(cfg.TMP_PATH + fname + '_times.txt'):
+            contour, t0, dt = line.strip().split(',')
+            times[contour] = [float(t0), float(dt)]
+        for contour in CONTOURS:
+            tmp_fname = cfg.TMP_PATH + fname + '_' + contour + '.txt'
+            vals = np.loadtxt(tmp_fname, ndmin=1).ravel()
+            # unvoiced frames have pitch 0
+            undef = ~np.isfinite(vals) | ((vals <= 0) & (contour == 'pitch'))
+            vals = np.round(np.clip(
+                np.where(undef, 0, vals) * _SCALES[contour],
+                _UNDEF + 1, np.iinfo(np.int16).max)).astype(np.int16)
+            vals[undef] = _UNDEF
+            np.save(path + fname + '_' + contour + '.npy', vals)
+            os.remove(tmp_fname)
+        # times last, marks channel as complete
+        np.save(path + fname + '_times.npy',
+                np.array([times[c] for c in CONTOURS]))
+        os.remove(cfg.TMP_PATH + fname + '_times.txt')
+        cnt += 1
+    return cnt
+
+
+def load_contours(corpus_id, ses_id, a_or_b):
+    ''' returns contours of given channel (see store_contours)
+
+    returns:
+        dict with tuple (time of first frame, time step, memory-mapped numpy
+        array of quantized values) per contour; see get_values
+    '''
+    path, fname = _get_pfn(corpus_id, ses_id, a_or_b)
+    times = np.load(path + fname + '_times.npy')
+    return {c: (times[i, 0], times[i, 1],
+                np.load(path + fname + '_' + c + '.npy', mmap_mode='r'))
+            for i, c in enumerate(CONTOURS)}
+
+
+def get_values(contour, vals):
+    ''' returns quantized contour values as floats (nan if undefined) '''
+    vals = np.asarray(vals)
+    return np.where(vals == _UNDEF, np.nan, vals / _SCALES[contour])
+
+
+def get_chunk_features(corpus_id, ses_id, a_or_b, starts, ends, quantiles=[]):
+    ''' computes features of sections of a channel from its stored contours
+
+    statistics as in cfg.PRAAT_SCRIPT_FNAME: pitch over voiced frames (Hz),
+    mean intensity as mean energy (dB), voiced over all pitch frames
+
+    args:
+        corpus_id: one of the corpus ids in cfg.CORPUS_IDS
+        ses_id, a_or_b: channel
+        starts, ends: start and end time of each section (e.g., chunk)
+        quantiles: names of additional quantiles of pitch and intensity (see
+            QUANTILES)
+    returns:
+        pandas dataframe with one row per section, columns keyed as returned
+        by fio.extract_features (see cfg.FEATURE_KEYS), e.g., "f0_mean", plus
+        quantiles (e.g., "f0_q1", "int_q1"); nan if undefined
+    '''
+    for q in quantiles:
+        assert q in QUANTILES, 'unknown quantile'
+    contours = load_contours(corpus_id, ses_id, a_or_b)
+    cols = {}
+    for contour, prefix in [('pitch', 'f0'), ('intensity', 'int')]:
+        t0, dt, vals = contours[contour]
+        lo, hi = _get_segments(t0, dt, len(vals), starts, ends)
+        vals = get_values(contour, vals)
+        stats = _segment_stats(
+            vals, lo, hi, [QUANTILES[q] for q in quantiles])
+        if contour == 'intensity':
+            # mean energy, i.e., mean of power converted back to dB
+            with np.errstate(divide='ignore'):
+                stats['mean'] = 10 * np.log10(_segment_stats(
+                    10**(vals / 10), lo, hi)['mean'])
+        for stat in ['mean', 'std', 'min', 'max']:
+            cols[prefix + '_' + stat] = stats[stat]
+        for q in quantiles:
+            cols[prefix + '_' + q] = stats[QUANTILES[q]]
+        if contour == 'pitch':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cols['vcd2tot_frames'] = stats['n'] / stats['n_frames']
+    return pd.DataFrame(cols)
+
+
+def set_features(corpus_id, ses_id, features=FEATURES, min_dur=0.04):
+    ''' sets features of all chunks in given session from stored contours
+
+    replaces per-chunk extraction (sb.extract_features) for the features in
+    FEATURES; uses the global connection
+
+    args:
+        corpus_id: one of the corpus ids in cfg.CORPUS_IDS
+        ses_id: session to process
+        features: features to set (subset of FEATURES)
+        min_dur: minimum chunk duration, shorter chunks are skipped
+    returns:
+        number of chunks updated
+    '''
+    for f in features:
+        assert f in FEATURES, 'feature not computable from contours'
+    keys = [cfg.FEATURE_KEYS[f] for f in features]
+    cnt = 0
+    for a_or_b in ['A', 'B']:
+        chunks = [c for c in db.find_chunks(ses_id, a_or_b)
+                  if c[3] - c[2] >= min_dur]
+        if len(chunks) == 0:
+            continue
+        chu_ids, words, starts, ends = [np.array(c) for c in zip(*chunks)]
+        df = get_chunk_features(corpus_id, ses_id, a_or_b, starts, ends)
+        if 'rate_syl' in features:
+            df['rate_syl'] = [aux.count_syllables(w) / (e - s)
+                              for w, s, e in zip(words, starts, ends)]
+        df = df[keys].astype(object).where(pd.notna(df[keys]), None)
+        db.set_features(dict(zip(
+            [int(chu_id) for chu_id in chu_ids], df.to_dict('records'))))
+        cnt += len(chunks)
+    db.commit()
+    return cnt
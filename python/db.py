@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import sqlite3
 
@@ -27,6 +28,9 @@ class DatabaseConnection(object):
     def executescript(self, sql_script):
         return self._c.executescript(sql_script)
 
+    def cursor(self):
+        return self._conn.cursor()
+
     def getrowcount(self):
         return self._c.rowcount
 
@@ -105,13 +109,15 @@ def ins_tsk(tsk_id, ses_id, task_index, a_or_b):
     dbc.execute(sql_stmt, (tsk_id, ses_id, task_index, a_or_b))
 
 
-def ins_tur(tur_id, tsk_id, turn_index, turn_index_ses, speaker_role):
+def ins_tur(tur_id, tsk_id, turn_index, turn_index_ses, speaker_role, 
+            speaker_a_or_b):
     ''' inserts individual turn in turns table '''
     sql_stmt = \
         'INSERT INTO turns (tur_id, tsk_id, turn_index, turn_index_ses, ' \
-            'speaker_role)\n' \
-        'VALUES (?,?,?,?,?);'
-    params = (tur_id, tsk_id, turn_index, turn_index_ses, speaker_role)
+            'speaker_role, speaker_a_or_b)\n' \
+        'VALUES (?,?,?,?,?,?);'
+    params = (tur_id, tsk_id, turn_index, turn_index_ses, speaker_role, 
+              speaker_a_or_b)
     dbc.execute(sql_stmt, params)
 
 
@@ -152,39 +158,87 @@ def upd_tsk(
     dbc.execute(sql_stmt, params)
 
 
-def set_features(chu_id, features):
-    ''' sets features of given chunk '''
-    sql_stmt = \
-        'UPDATE chunks\n' \
-        'SET    pitch_min = ?,\n' \
-        '       pitch_max = ?,\n' \
-        '       pitch_mean = ?,\n' \
-        '       pitch_std = ?,\n' \
-        '       rate_syl = ?,\n' \
-        '       rate_vcd = ?,\n' \
-        '       intensity_min = ?,\n' \
-        '       intensity_max = ?,\n' \
-        '       intensity_mean = ?,\n' \
-        '       intensity_std = ?,\n' \
-        '       jitter = ?,\n' \
-        '       shimmer = ?,\n' \
-        '       nhr = ?\n' \
-        'WHERE  chu_id == ?;'
-    dbc.execute(sql_stmt, 
-                (features['f0_min'],
-                 features['f0_max'],
-                 features['f0_mean'],
-                 features['f0_std'],
-                 features['rate_syl'],
-                 features['vcd2tot_frames'],
-                 features['int_min'],
-                 features['int_max'],
-                 features['int_mean'],
-                 features['int_std'],
-                 features['jitter'],
-                 features['shimmer'],
-                 features['nhr'],
-                 chu_id))
+def set_features(chu_features):
+    ''' sets features of given chunks in table chunk_features, in bulk
+
+    only the features in the given dicts (keyed as returned by 
+    fio.extract_features) are set, all other columns are left as they are; 
+    rows are inserted (or updated if they exist) with one statement per set
+    of features, together with the flag whether a chunk has all analyzed 
+    features (cfg.FEATURES, see set_complete)
+
+    args:
+        chu_features: dict mapping chu_id to dict of feature values
+    '''
+    rows = {}
+    for chu_id, features in chu_features.items():
+        cols = tuple(
+            f for f in cfg.FEATURES_ALL if cfg.FEATURE_KEYS[f] in features)
+        if len(cols) == 0:
+            continue
+        vals = tuple(features[cfg.FEATURE_KEYS[c]] for c in cols)
+        # complete if new row with all analyzed features (updated: see stmt)
+        complete = all(
+            features.get(cfg.FEATURE_KEYS[f]) is not None for f in cfg.FEATURES)
+        rows.setdefault(cols, []).append((chu_id,) + vals + (int(complete),))
+    for cols, params in rows.items():
+        dbc.executemany(_set_features_stmt(cols), params)
+
+
+def set_complete(features=cfg.FEATURES, force=False):
+    ''' flags chunks that have all given features (chunk_features.complete)
+
+    only complete chunks are analyzed ("all or nothing", see big_table.sql 
+    and aux_tables.sql), so completeness refers to the analyzed features, not
+    to all features praat can extract (cfg.FEATURES_ALL); flags are set with
+    the features (see set_features), this recomputes them if the analyzed 
+    features changed since they were last computed (stored in table 
+    complete_features) or if forced (e.g., for rows whose features were 
+    changed otherwise, see cfg.SQL_CU_FNAME)
+
+    args:
+        features: features that complete chunks have
+        force: whether to recompute flags even if features are unchanged
+    returns:
+        sorted list of sessions with chunks whose flag changed (their chunk 
+        pairs and feature moments depend on the flags)
+    '''
+    dbc.execute(
+        'CREATE TABLE IF NOT EXISTS complete_features (\n'
+        '    feature  TEXT NOT NULL,\n'
+        '    PRIMARY KEY (feature)\n'
+        ');')
+    features_old = [row[0] for row in dbc.execute(
+        'SELECT feature FROM complete_features;').fetchall()]
+    if not force and sorted(features_old) == sorted(features):
+        return []
+    complete = '\n       AND '.join('chf.%s IS NOT NULL' % f for f in features)
+    ses_ids = [int(row[0]) for row in dbc.execute(
+        'SELECT DISTINCT tsk.ses_id\n'
+        'FROM   chunk_features chf\n'
+        'JOIN   chunks chu\n'
+        'ON     chf.chu_id == chu.chu_id\n'
+        'JOIN   turns tur\n'
+        'ON     chu.tur_id == tur.tur_id\n'
+        'JOIN   tasks tsk\n'
+        'ON     tur.tsk_id == tsk.tsk_id\n'
+        'WHERE  chf.complete != (\n'
+        '           %s\n'
+        '       )\n'
+        'ORDER BY tsk.ses_id;' % complete).fetchall()]
+    complete = complete.replace('chf.', '')
+    dbc.execute(
+        'UPDATE chunk_features\n'
+        'SET    complete = (\n'
+        '           %s\n'
+        '       )\n'
+        'WHERE  complete != (\n'
+        '           %s\n'
+        '       );' % (complete, complete))
+    dbc.execute('DELETE FROM complete_features;')
+    dbc.executemany('INSERT INTO complete_features (feature) VALUES (?);',
+                    [(f,) for f in features])
+    return ses_ids
 
 
 
@@ -219,9 +273,32 @@ def get_ses_ids():
     return [int(v[0]) for v in dbc.execute(sql_stmt).fetchall()]
 
 
-def get_tsk_ses_ids(tsk_or_ses):
-    ''' returns task or session id's as needed '''
-    return get_tsk_ids() if tsk_or_ses == 'tsk' else get_ses_ids()
+def get_tsk_ses_ids(tsk_or_ses, ses_ids=None):
+    ''' returns task or session id's as needed 
+
+    if ses_ids are given, only those sessions or their tasks are returned (in
+    order; sessions that do not exist in the database are still returned, so
+    their files can be found and removed, see inc.py) '''
+    if ses_ids is None:
+        return get_tsk_ids() if tsk_or_ses == 'tsk' else get_ses_ids()
+    if tsk_or_ses == 'ses':
+        return sorted(set(ses_ids))
+    sql_stmt = \
+        'SELECT tsk_id\n' \
+        'FROM   tasks\n' \
+        'WHERE  ses_id == ?;'
+    tsk_ids = []
+    for ses_id in set(ses_ids):
+        tsk_ids += [int(v[0]) for v in dbc.execute(sql_stmt, (ses_id,))]
+    return sorted(tsk_ids)
+
+
+def get_task_index_count():
+    ''' returns number of distinct task indices (1 if one task per session) '''
+    sql_stmt = \
+        'SELECT COUNT(DISTINCT task_index)\n' \
+        'FROM   tasks;'
+    return int(dbc.execute(sql_stmt).fetchall()[0][0])
 
 
 def get_a_or_b(tsk_or_ses, tsk_ses_id, spk_id):
@@ -250,30 +327,27 @@ def get_role(tsk_id, spk_a_or_b):
     return 'd' if spk_a_or_b == dsc_a_or_b else 'f'
 
 
-def get_words(tsk_or_ses, tsk_ses_id):
-    ''' gets words for all chunks of given task/session in order '''
+def get_words(tsk_or_ses, tsk_ses_id, batch_size=cfg.BATCH_SIZE):
+    ''' yields words for all chunks of given task/session in order '''
     assert tsk_or_ses in ['tsk', 'ses'], 'unknown tsk_or_ses value'
-    sql_stmt = \
-        'SELECT tur.tur_id,\n' \
-        '       CASE\n' \
-        '           WHEN tsk.a_or_b == "A" AND tur.speaker_role == "d"\n' \
-        '           THEN "A"\n' \
-        '           WHEN tsk.a_or_b == "B" AND tur.speaker_role == "f"\n' \
-        '           THEN "A"\n' \
-        '           ELSE "B"\n' \
-        '       END a_or_b,\n' \
-        '       chu.words\n' \
-        'FROM   chunks chu\n' \
-        'JOIN   turns tur\n' \
-        'ON     chu.tur_id == tur.tur_id\n' \
-        'JOIN   tasks tsk\n' \
-        'ON     tur.tsk_id == tsk.tsk_id\n' \
-        'WHERE  tsk.' + tsk_or_ses + '_id == ?\n' \
-        'ORDER BY tsk.ses_id,\n' \
-        '         tsk.task_index,\n' \
-        '         tur.turn_index,\n' \
-        '         chu.chunk_index;'
-    return dbc.execute(sql_stmt, (tsk_ses_id,)).fetchall()
+    for _, rows in _fetch_batches(
+            _get_words_stmt(tsk_or_ses), (tsk_ses_id,), batch_size):
+        for row in rows:
+            yield(row)
+
+
+def get_chunk_pairs(ses_id):
+    ''' returns chunk pairs (see cfg.SQL_AT_FNAME) of given session
+
+    returns:
+        pandas dataframe with p_or_x, chu_id1, chu_id2, and rid per pair
+        (of turn-initial chunks of the session, chu_id2)
+    '''
+    dfs = list(iter_batches(_get_chunk_pairs_stmt(), params=(int(ses_id),)))
+    if len(dfs) == 0:
+        return pd.DataFrame(
+            {c: [] for c in ['p_or_x', 'chu_id1', 'chu_id2', 'rid']})
+    return pd.concat(dfs, ignore_index=True)
 
 
 
@@ -288,50 +362,408 @@ def executescript(path, fname):
     dbc.executescript(''.join(fio.readlines(path, fname)))
 
 
-def pd_read_sql_query(sql_stmt='', sql_fname=''):
+def _load_stmt(sql_stmt='', sql_fname=''):
+    ''' returns given sql statement or the one in given file (cfg.SQL_PATH) '''
+    assert len(sql_stmt) > 0 or len(sql_fname) > 0, 'need sql query or filename'
+    if len(sql_fname) > 0:
+        sql_stmt = ''.join(fio.readlines(cfg.SQL_PATH, sql_fname))
+    return sql_stmt
+
+
+def _fetch_batches(sql_stmt, params=tuple(), batch_size=cfg.BATCH_SIZE):
+    ''' yields (column names, rows) for given statement, batch_size rows each
+
+    uses a separate cursor, so other statements can be executed through the 
+    global connection while iterating (e.g., updates per chunk while iterating
+    over chunks; updates must not change the columns used to select rows)
+    '''
+    cursor = dbc.cursor()
+    try:
+        cursor.execute(sql_stmt, params)
+        cols = [d[0] for d in cursor.description]
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            yield cols, rows
+    finally:
+        cursor.close()
+
+
+def iter_batches(sql_stmt='', sql_fname='', params=tuple(), 
+                 batch_size=cfg.BATCH_SIZE, as_records=False):
+    ''' yields result set of given query in batches of bounded size
+
+    args:
+        sql_stmt: sql statement to execute (only run if no filename given)
+        sql_fname: filename (in cfg.SQL_PATH) from where to load sql statement
+        params: parameters for the sql statement
+        batch_size: maximum number of rows per batch
+        as_records: whether to yield numpy record arrays instead of dataframes
+    returns:
+        generator of pandas dataframes (or numpy record arrays) with at most 
+        batch_size rows each, all with the same columns
+    '''
+    sql_stmt = _load_stmt(sql_stmt, sql_fname)
+    for cols, rows in _fetch_batches(sql_stmt, params, batch_size):
+        if as_records:
+            yield np.rec.fromrecords(rows, names=cols)
+        else:
+            yield pd.DataFrame.from_records(
+                rows, columns=cols, coerce_float=True)
+
+
+def iter_sessions(sql_stmt='', sql_fname='', params=tuple(), 
+                  batch_size=cfg.BATCH_SIZE):
+    ''' yields result set of given query per session 
+
+    query must return a ses_id column and be ordered by it (as, for example, 
+    cfg.SQL_BT_FNAME); only the current session and one batch are in memory
+
+    args:
+        see iter_batches
+    returns:
+        generator of tuples (ses_id, pandas dataframe with all rows of session)
+    '''
+    def __concat(parts):
+        df_ses = pd.concat(parts).infer_objects().reset_index(drop=True)
+        return df_ses['ses_id'].iloc[0], df_ses
+    # parts of current session (sessions can span several batches)
+    parts = []
+    for df in iter_batches(sql_stmt, sql_fname, params, batch_size):
+        for ses_id, df_ses in df.groupby('ses_id', sort=False):
+            if len(parts) > 0 and parts[0]['ses_id'].iloc[0] != ses_id:
+                yield __concat(parts)
+                parts = []
+            parts += [df_ses]
+    if len(parts) > 0:
+        yield __concat(parts)
+
+
+def pd_read_sql_query(sql_stmt='', sql_fname='', chunksize=None):
     ''' runs given sql query and returns pandas dataframe of result 
 
-    establishes and closes db connection for each call
+    result set is fetched and converted in batches (cfg.BATCH_SIZE), so it is
+    never held in memory as python objects all at once
 
     args:
         sql_stmt: sql statement to execute (only run if no filename given)
         sql_fname: filename (in cfg.SQL_PATH) from where to load sql statement
+        chunksize: if given, a generator of dataframes with at most chunksize
+            rows each is returned instead (see iter_batches)
     returns:
         pandas dataframe with query result set 
     '''
-    assert len(sql_stmt) > 0 or len(sql_fname) > 0, 'need sql query or filename'
-    if len(sql_fname) > 0:
-        sql_stmt = '\n'.join(fio.readlines(cfg.SQL_PATH, sql_fname))
-    df = pd.read_sql_query(sql_stmt, get_conn())
-    return df
+    if chunksize is not None:
+        return iter_batches(sql_stmt, sql_fname, batch_size=chunksize)
+    dfs = list(iter_batches(sql_stmt, sql_fname))
+    if len(dfs) == 0:
+        # empty result set, run again for column names
+        return pd.read_sql_query(_load_stmt(sql_stmt, sql_fname), get_conn())
+    # batches consisting only of NULL values for some column have object dtype
+    return pd.concat(dfs, ignore_index=True).infer_objects()
 
 
-def find_chunks(ses_id, a_or_b):
+def find_chunks(ses_id, a_or_b, batch_size=cfg.BATCH_SIZE):
     ''' yields all chunks for given speaker (A or B) in given session ''' 
-    sql_stmt = \
+    params = (ses_id, a_or_b)
+    for _, rows in _fetch_batches(_find_chunks_stmt(), params, batch_size):
+        for chu_id, words, start, end in rows:
+            yield(chu_id, words, start, end)
+
+
+def find_missing_features(
+        ses_id, a_or_b, features, batch_size=cfg.BATCH_SIZE):
+    ''' yields chunks for given speaker (A or B) in given session that lack
+    any of the given features, with the list of features they lack '''
+    params = (ses_id, a_or_b)
+    for _, rows in _fetch_batches(
+            _find_chunks_stmt(features), params, batch_size):
+        for chu_id, words, start, end, *vals in rows:
+            yield(chu_id, words, start, end, 
+                  [f for f, v in zip(features, vals) if v is None])
+
+
+
+################################################################################
+#                                 QUERY PLANS                                  #
+################################################################################
+# statements shared between the getters above and the query plan checks below,
+# plus a check that every query uses the indexes created in cfg.SQL_IX_FNAME
+
+# full scans accepted in the scripts checked by check_query_plans, per script 
+# and statement index (see _split_script): tables (or aliases) that may be 
+# scanned, only as the outer loop of a (sub)query (see find_full_scans), and
+# why; each of these statements processes all (selected) sessions, so every 
+# row is visited once anyway; any other scan is a violation
+FULL_SCANS_ALLOWED = {
+    (cfg.SQL_IX_FNAME, 0): (['turns'],
+        'backfill of turns.speaker_a_or_b updates every turn once'),
+    (cfg.SQL_AT_FNAME, 7): (['sessions', 'ses_todo'],
+        'session selection reads all session ids (or ses_todo) once'),
+    (cfg.SQL_AT_FNAME, 12): (['chunk_pairs', 'chu'],
+        'every stored pair is checked once against the chunk ids of the kept '
+        'sessions, collected once'),
+    (cfg.SQL_AT_FNAME, 13): (['chu2'],
+        'one pass over the chunks of the selected sessions, each joined with '
+        'its predecessor through an index'),
+    (cfg.SQL_AT_FNAME, 16): (['con1'],
+        'one pass over consecutive_2_chunks, joined through con_uk1'),
+    (cfg.SQL_AT_FNAME, 17): (['con'],
+        'adjacent pairs filtered in one pass over consecutive_2_chunks'),
+    (cfg.SQL_AT_FNAME, 18): (['chu_p'],
+        'one pass over the adjacent pairs, candidates of the same session, '
+        'speaker, and role joined through an index'),
+    (cfg.SQL_AT_FNAME, 19): (['tmp'],
+        'copies all candidates (with their rowid) in one pass'),
+    (cfg.SQL_AT_FNAME, 22): (['tmp2'],
+        'rowid span per turn-initial chunk in one pass'),
+    (cfg.SQL_AT_FNAME, 24): (['ids'],
+        'one pass over the spans, candidates searched through an index'),
+    (cfg.SQL_BT_FNAME, 0): (['chu', 'tur', 'hlf_tsk'],
+        'the big table has a row per chunk; halfway points aggregate all '
+        'chunks once, the outer loop visits each task once'),
+    (cfg.SQL_SP_FNAME, 0): (['tsk', 'tasks', 'tgt', 'sub'],
+        'speaker pairs of all sessions: tasks read once per part of the '
+        'union, speakers per task once per part, paired through an index'),
+    (cfg.SQL_CU_FNAME, 0): (['chunk_features'],
+        'every row is checked once against the chunk ids'),
+}
+
+def _get_words_stmt(tsk_or_ses):
+    ''' returns select statement for get_words '''
+    return \
+        'SELECT tur.tur_id,\n' \
+        '       tur.speaker_a_or_b a_or_b,\n' \
+        '       chu.words\n' \
+        'FROM   tasks tsk\n' \
+        'JOIN   turns tur\n' \
+        'ON     tsk.tsk_id == tur.tsk_id\n' \
+        'JOIN   chunks chu\n' \
+        'ON     tur.tur_id == chu.tur_id\n' \
+        'WHERE  tsk.' + tsk_or_ses + '_id == ?\n' \
+        'ORDER BY tsk.ses_id,\n' \
+        '         tsk.task_index,\n' \
+        '         tur.turn_index,\n' \
+        '         chu.chunk_index;'
+
+
+def _get_chunk_pairs_stmt():
+    ''' returns select statement for get_chunk_pairs '''
+    return \
+        'SELECT chp.p_or_x,\n' \
+        '       chp.chu_id1,\n' \
+        '       chp.chu_id2,\n' \
+        '       chp.rid\n' \
+        'FROM   tasks tsk\n' \
+        'JOIN   turns tur\n' \
+        'ON     tsk.tsk_id == tur.tsk_id\n' \
+        'JOIN   chunks chu\n' \
+        'ON     tur.tur_id == chu.tur_id\n' \
+        'JOIN   chunk_pairs chp\n' \
+        'ON     chu.chu_id == chp.chu_id2\n' \
+        'WHERE  tsk.ses_id == ?;'
+
+
+def _find_chunks_stmt(features=[]):
+    ''' returns select statement for find_chunks (find_missing_features if
+    features are given) '''
+    return \
         'SELECT chu.chu_id,\n' \
         '       chu.words,\n' \
         '       chu.start_time,\n' \
-        '       chu.end_time\n' \
-        'FROM   chunks chu\n' \
+        '       chu.end_time%s\n' \
+        'FROM   tasks tsk\n' \
         'JOIN   turns tur\n' \
-        'ON     chu.tur_id == tur.tur_id\n' \
-        'JOIN   tasks tsk\n' \
-        'ON     tur.tsk_id == tsk.tsk_id\n' \
+        'ON     tsk.tsk_id == tur.tsk_id\n' \
+        'JOIN   chunks chu\n' \
+        'ON     tur.tur_id == chu.tur_id\n%s' \
         'WHERE  tsk.ses_id == ?\n' \
-        'AND    CASE\n' \
-        '           WHEN tur.speaker_role == "d" AND tsk.a_or_b == "A"\n' \
-        '           THEN "A"\n' \
-        '           WHEN tur.speaker_role == "f" AND tsk.a_or_b == "B"\n' \
-        '           THEN "A"\n' \
-        '           ELSE "B"\n' \
-        '       END == ?\n'
-    res = dbc.execute(sql_stmt, (ses_id, a_or_b)).fetchall()
-    for chu_id, words, start, end in res:
-        yield(chu_id, words, start, end)
-
+        'AND    tur.speaker_a_or_b == ?\n%s' % (
+            ''.join(',\n       chf.' + f for f in features),
+            '' if len(features) == 0 else 
+                'LEFT JOIN chunk_features chf\n'
+                'ON     chu.chu_id == chf.chu_id\n',
+            '' if len(features) == 0 else 'AND    (%s)\n' % 
+                '\n        OR '.join('chf.%s IS NULL' % f for f in features))
 
 
+def _set_features_stmt(cols):
+    ''' returns insert statement for set_features (given feature columns)
 
+    existing rows keep the features not given; their flag is recomputed from
+    the given (excluded.*) and the kept analyzed features (cfg.FEATURES)
+    '''
+    complete = '\n       AND '.join(
+        ('excluded.' if f in cols else '') + f + ' IS NOT NULL'
+        for f in cfg.FEATURES)
+    return \
+        'INSERT INTO chunk_features (chu_id, %s, complete)\n' \
+        'VALUES (?, %s, ?)\n' \
+        'ON CONFLICT (chu_id) DO UPDATE\n' \
+        'SET    %s,\n' \
+        '       complete = (\n' \
+        '           %s\n' \
+        '       );' % (
+            ', '.join(cols), ', '.join(['?'] * len(cols)),
+            ',\n       '.join('%s = excluded.%s' % (c, c) for c in cols),
+            complete)
+
+
+def _split_script(sql_script):
+    ''' splits given sql script into its individual statements '''
+    stmts = []
+    stmt = ''
+    for line in sql_script.split('\n'):
+        stmt += line + '\n'
+        if sqlite3.complete_statement(stmt):
+            stmts += [stmt.strip()]
+            stmt = ''
+    # last statement is not necessarily terminated by a semicolon
+    lines = [l.strip() for l in stmt.split('\n')]
+    if any([len(l) > 0 and not l.startswith('--') for l in lines]):
+        stmts += [stmt.strip()]
+    return stmts
+
+
+def add_chunk_features():
+    ''' adds table chunk_features to databases initialized before it existed
+
+    the table is created as in the init scripts (e.g., cfg.SQL_INIT_FNAME_SB)
+    and filled with the features stored in the columns of chunks (chunks
+    with at least one feature), which are not used anymore afterwards, and
+    chunks with all analyzed features are flagged (see set_complete); 
+    no-op if the table exists '''
+    tables = [row[0] for row in dbc.execute(
+        'SELECT name FROM sqlite_master WHERE type == "table";')]
+    if 'chunk_features' in tables:
+        return
+    dbc.execute(
+        'CREATE TABLE chunk_features (\n'
+        '    chu_id            INTEGER NOT NULL,\n%s'
+        '    complete          INTEGER NOT NULL DEFAULT 0,\n'
+        '    PRIMARY KEY (chu_id),\n'
+        '    FOREIGN KEY (chu_id) REFERENCES chunks (chu_id)\n'
+        ');' % ''.join('    %-18sNUMERIC,\n' % f for f in cfg.FEATURES_ALL))
+    dbc.execute('CREATE UNIQUE INDEX chf_pk ON chunk_features (chu_id);')
+    dbc.execute(
+        'INSERT INTO chunk_features (chu_id, %s)\n'
+        'SELECT chu_id, %s\n'
+        'FROM   chunks\n'
+        'WHERE  %s;' % (
+            ', '.join(cfg.FEATURES_ALL), ', '.join(cfg.FEATURES_ALL),
+            ' OR '.join(f + ' IS NOT NULL' for f in cfg.FEATURES_ALL)))
+    set_complete(force=True)
+    commit()
+
+
+def add_speaker_a_or_b():
+    ''' adds turns.speaker_a_or_b to databases initialized before it existed 
+
+    the column is populated by cfg.SQL_IX_FNAME, which also creates all
+    covering indexes; run that script after this function '''
+    cols = [row[1] for row in dbc.execute('PRAGMA table_info(turns);')]
+    if 'speaker_a_or_b' not in cols:
+        dbc.execute('ALTER TABLE turns ADD COLUMN speaker_a_or_b TEXT;')
+
+
+def get_query_plan(sql_stmt, params=tuple()):
+    ''' returns query plan for given statement as (id, parent, step) tuples '''
+    res = dbc.execute('EXPLAIN QUERY PLAN\n' + sql_stmt, params).fetchall()
+    return [(row[0], row[1], row[3]) for row in res]
+
+
+def find_full_scans(sql_stmt, params=tuple(), allowed=[]):
+    ''' returns all steps of query plan that scan a table entirely
+
+    a scan is the outer loop of a (sub)query if it is the first loop among the
+    steps with the same parent; any other scan is nested in a join, i.e., the
+    table is scanned once per row of the outer loop (quadratic runtime)
 
+    args:
+        sql_stmt: sql statement to check
+        params: parameters for the statement (values do not matter)
+        allowed: tables (or aliases) that may be scanned as outer loops (see
+            FULL_SCANS_ALLOWED); nested scans are never acceptable
+    returns:
+        list of plan steps with unexpected full scans
+    '''
+    scans = []
+    parents_seen = set()
+    for _, parent, step in get_query_plan(sql_stmt, params):
+        if not step.startswith('SCAN') and not step.startswith('SEARCH'):
+            continue
+        is_outer = parent not in parents_seen
+        parents_seen.add(parent)
+        if step.startswith('SCAN') and step != 'SCAN CONSTANT ROW' \
+        and (not is_outer or step.split()[1] not in allowed):
+            scans += [step]
+    return scans
+
+
+def check_query_plans(verbose=False):
+    ''' checks query plans of all queries in db.py and sql/ for full scans 
+
+    runs against a synthetic, empty in-memory database initialized with 
+    cfg.SQL_INIT_FNAME_SB (plans do not depend on the corpus); queries must
+    not scan at all, except for the outer loops listed in FULL_SCANS_ALLOWED
+    (statements of scripts that process the entire corpus); scripts are 
+    checked statement by statement, each statement is executed after the
+    check so that tables created by it exist for subsequent statements;
+    uses its own connection, the global connection is not modified
 
+    args:
+        verbose: whether to print the full plan for every statement
+    returns:
+        list of tuples (query name, statement index, unexpected full scans),
+        empty if all queries use indexes as intended
+    '''
+    global dbc
+    def __check(queries):
+        violations = []
+        for name, sql_stmt, params in queries:
+            if verbose:
+                print(name, get_query_plan(sql_stmt, params))
+            scans = find_full_scans(sql_stmt, params)
+            if len(scans) > 0:
+                violations += [(name, 0, scans)]
+        return violations
+    # queries in this module, with example parameters
+    queries = [
+        ('find_chunks', _find_chunks_stmt(), (1, 'A')),
+        ('find_missing_features', _find_chunks_stmt(cfg.FEATURES_ALL), 
+         (1, 'A')),
+        ('get_words_tsk', _get_words_stmt('tsk'), (1,)),
+        ('get_words_ses', _get_words_stmt('ses'), (1,)),
+    ]
+    # queries on tables created by the scripts below, checked after them
+    queries_after = [
+        ('get_chunk_pairs', _get_chunk_pairs_stmt(), (1,)),
+    ]
+    # scripts, in order of execution (later scripts need tables created before)
+    scripts = [
+        cfg.SQL_IX_FNAME, 
+        cfg.SQL_AT_FNAME, 
+        cfg.SQL_BT_FNAME, 
+        cfg.SQL_SP_FNAME, 
+        cfg.SQL_CU_FNAME
+    ]
+    dbc_orig = dbc
+    dbc = DatabaseConnection(':memory:')
+    try:
+        executescript(cfg.SQL_PATH, cfg.SQL_INIT_FNAME_SB)
+        violations = __check(queries)
+        for fname in scripts:
+            sql_script = ''.join(fio.readlines(cfg.SQL_PATH, fname))
+            for i, sql_stmt in enumerate(_split_script(sql_script)):
+                if verbose:
+                    print(fname, i, get_query_plan(sql_stmt))
+                allowed, _ = FULL_SCANS_ALLOWED.get((fname, i), ([], ''))
+                scans = find_full_scans(sql_stmt, allowed=allowed)
+                if len(scans) > 0:
+                    violations += [(fname, i, scans)]
+                dbc.execute(sql_stmt)
+        violations += __check(queries_after)
+    finally:
+        dbc = dbc_orig
+    return violations
@@ -1,5 +1,4 @@
 import csv
-import nltk
 import os
 import pickle
 import subprocess
@@ -9,6 +8,24 @@ import aux
 import cfg
 import db
 
+# praat analyses (flags of cfg.PRAAT_SCRIPT_FNAME, in order) and the one each
+# feature needs (rate_syl is computed from the transcript, see aux)
+PRAAT_ANALYSES = ['pitch', 'intensity', 'voicing', 'jitter_shimmer', 'nhr']
+_FEATURE_ANALYSES = {
+    'intensity_mean': 'intensity',
+    'intensity_std': 'intensity',
+    'intensity_min': 'intensity',
+    'intensity_max': 'intensity',
+    'pitch_mean': 'pitch',
+    'pitch_std': 'pitch',
+    'pitch_min': 'pitch',
+    'pitch_max': 'pitch',
+    'jitter': 'jitter_shimmer',
+    'shimmer': 'jitter_shimmer',
+    'nhr': 'nhr',
+    'rate_syl': None,
+    'rate_vcd': 'voicing'
+}
 
 
 ################################################################################
@@ -35,14 +52,21 @@ def get_dump_pfn(corpus_id, mea_id):
 #                                 WRITE FILES                                  #
 ################################################################################
 
-def remove_lmn_files(corpus_id, tsk_or_ses=None, extension='txt'):
-    ''' removes lm/ngram files with given extension for tasks/sessions/both '''
+def remove_lmn_files(
+        corpus_id, tsk_or_ses=None, extension='txt', tsk_ses_ids=None):
+    ''' removes lm/ngram files with given extension for tasks/sessions/both 
+
+    files of all tasks/sessions in the database are removed unless specific
+    tsk_ses_ids are given (only possible if tsk_or_ses is given as well) '''
     if tsk_or_ses is None:
         # if tsk_or_ses not specified, do both
+        assert tsk_ses_ids is None, 'ids are only unambiguous with tsk_or_ses'
         remove_lmn_files(corpus_id, 'tsk', extension)
         remove_lmn_files(corpus_id, 'ses', extension)
     else:
-        for tsk_ses_id in db.get_tsk_ses_ids(tsk_or_ses):
+        if tsk_ses_ids is None:
+            tsk_ses_ids = db.get_tsk_ses_ids(tsk_or_ses)
+        for tsk_ses_id in tsk_ses_ids:
             for a_or_b in ['A', 'B']:
                 path, fname = get_lmn_pfn(
                     corpus_id, tsk_or_ses, tsk_ses_id, a_or_b) 
@@ -51,39 +75,57 @@ def remove_lmn_files(corpus_id, tsk_or_ses=None, extension='txt'):
                     os.remove(fname)
 
 
-def store_tokens(corpus_id, tsk_or_ses=None, lem=aux.default_lem):
-    ''' writes tokens per speaker to txt file for each task/session '''
+def store_tokens(
+        corpus_id, tsk_or_ses=None, lem=aux.default_lem, ses_ids=None):
+    ''' writes tokens per speaker to txt file for each task/session 
+
+    chunks are streamed from the database (db.get_words), only the files of
+    the current task/session and the vocabulary are held at any time; if 
+    ses_ids are given, only the files of those sessions (or their tasks) are
+    rewritten and the vocabulary is collected from the files of all others '''
     if tsk_or_ses is None:
-        store_tokens(corpus_id, 'tsk', lem)
-        store_tokens(corpus_id, 'ses', lem)
+        store_tokens(corpus_id, 'tsk', lem, ses_ids)
+        store_tokens(corpus_id, 'ses', lem, ses_ids)
     else:
-        remove_lmn_files(corpus_id, tsk_or_ses, extension='txt')
-        all_lemmata = []
-        # iterate over all tasks/sessions
-        for tsk_ses_id in db.get_tsk_ses_ids(tsk_or_ses):
+        tsk_ses_ids = db.get_tsk_ses_ids(tsk_or_ses, ses_ids)
+        remove_lmn_files(corpus_id, tsk_or_ses, 'txt', tsk_ses_ids)
+        vocab = set()
+        if ses_ids is not None:
+            # tokens of tasks/sessions that are not rewritten
+            for tsk_ses_id in set(db.get_tsk_ses_ids(tsk_or_ses)) \
+                    - set(tsk_ses_ids):
+                for a_or_b in ['A', 'B']:
+                    vocab.update(load_tokens(
+                        corpus_id, tsk_or_ses, tsk_ses_id, a_or_b))
+        # iterate over all (given) tasks/sessions
+        for tsk_ses_id in tsk_ses_ids:
             tur_id_prev = -1
-            cnts = {'A': 0, 'B': 0}
-            # iterate over all chunks in current task/session
-            for tur_id, a_or_b, words in db.get_words(tsk_or_ses, tsk_ses_id):
-                path, fname = get_lmn_pfn(
-                    corpus_id, tsk_or_ses, tsk_ses_id, a_or_b) 
-                with open(path + fname + '.txt', 'a') as txt_file:
-                    if cnts[a_or_b] > 0:
-                        if tur_id_prev != tur_id:
-                            # new turn, start new line (if not very first turn)
-                            txt_file.write('\n')
-                        else:
-                            txt_file.write(' ')
+            # txt files per speaker, opened with first chunk of that speaker
+            txt_files = {}
+            try:
+                # iterate over all chunks in current task/session
+                for tur_id, a_or_b, words \
+                in db.get_words(tsk_or_ses, tsk_ses_id):
+                    if a_or_b not in txt_files:
+                        path, fname = get_lmn_pfn(
+                            corpus_id, tsk_or_ses, tsk_ses_id, a_or_b) 
+                        txt_files[a_or_b] = open(path + fname + '.txt', 'a')
+                    elif tur_id_prev != tur_id:
+                        # new turn, start new line (if not very first turn)
+                        txt_files[a_or_b].write('\n')
+                    else:
+                        txt_files[a_or_b].write(' ')
                     # lemmatize and write words of current chunk to file
                     words_lem = lem(words)
-                    all_lemmata += words_lem
-                    txt_file.write(' '.join(words_lem))
-                cnts[a_or_b] += 1
-                tur_id_prev = tur_id
+                    vocab.update(words_lem)
+                    txt_files[a_or_b].write(' '.join(words_lem))
+                    tur_id_prev = tur_id
+            finally:
+                for txt_file in txt_files.values():
+                    txt_file.close()
         # store sorted vocabulary, i.e., distinct lemmata across all transcripts
-        vocab = sorted(list(nltk.FreqDist(all_lemmata).keys()))
         with open(cfg.get_vocab_fname(corpus_id), 'w') as vocab_file:
-            vocab_file.write('\n'.join(vocab))
+            vocab_file.write('\n'.join(sorted(vocab)))
 
 
 def write_pickle_dumps(corpus_id, mea_id, data_main, data_raw=None):
@@ -167,35 +209,54 @@ def load_pickle_dumps(corpus_id, mea_id):
 #                                     OTHER                                    #
 ################################################################################
 
-def extract_features(in_path, in_fname, ses_id, chu_id, words, start, end):
-    ''' runs feature extraction for given chunk section, returns features '''
-    # determine tmp filenames
-    cut_fname = '%d_%d.wav' % (ses_id, chu_id)
-    out_fname = '%d_%d.txt' % (ses_id, chu_id)
-    # extract audio and features
-    subprocess.check_call(['sox', 
-                           in_path + in_fname, 
-                           cfg.TMP_PATH + cut_fname, 
-                           'trim', str(start), '=' + str(end)])
-    subprocess.check_call(['praat', '--run', 
-                           cfg.PRAAT_SCRIPT_FNAME,
-                           cfg.TMP_PATH + cut_fname, 
-                           cfg.TMP_PATH + out_fname])
-    # read output
-    features = {}
-    for line in readlines(cfg.TMP_PATH, out_fname):
-        key, val = line.replace('\n', '').split(',')
-        try:
-            val = float(val)
-        except:
-            val = None
-        features[key] = val
-    features['rate_syl'] = aux.count_syllables(words) / (end - start)
-    # clean up
-    os.remove(cfg.TMP_PATH + cut_fname)
-    os.remove(cfg.TMP_PATH + out_fname)
-    
-    return features
+def extract_features(in_path, in_fname, ses_id, chu_id, words, start, end,
+                     features=cfg.FEATURES_ALL):
+    ''' runs feature extraction for given chunk section, returns features 
+
+    only the praat analyses needed for the given features are run (none, and
+    no audio is cut, if only rate_syl is requested)
+
+    args:
+        in_path, in_fname: audio file of the speaker
+        ses_id, chu_id: session and chunk (for tmp filenames)
+        words, start, end: transcript and section of the chunk
+        features: features to extract (see cfg.FEATURES_ALL)
+    returns:
+        dict with value (None if undefined) per requested feature, keyed as in
+        cfg.FEATURE_KEYS (see db.set_features)
+    '''
+    analyses = set(_FEATURE_ANALYSES[f] for f in features)
+    values = {}
+    if len(analyses - set([None])) > 0:
+        # determine tmp filenames
+        cut_fname = '%d_%d.wav' % (ses_id, chu_id)
+        out_fname = '%d_%d.txt' % (ses_id, chu_id)
+        # extract audio and features
+        subprocess.check_call(['sox', 
+                               in_path + in_fname, 
+                               cfg.TMP_PATH + cut_fname, 
+                               'trim', str(start), '=' + str(end)])
+        subprocess.check_call(['praat', '--run', 
+                               cfg.PRAAT_SCRIPT_FNAME,
+                               cfg.TMP_PATH + cut_fname, 
+                               cfg.TMP_PATH + out_fname] + 
+                              [str(int(a in analyses)) for a in PRAAT_ANALYSES])
+        # read output
+        for line in readlines(cfg.TMP_PATH, out_fname):
+            key, val = line.replace('\n', '').split(',')
+            try:
+                val = float(val)
+            except:
+                val = None
+            values[key] = val
+        # clean up
+        os.remove(cfg.TMP_PATH + cut_fname)
+        os.remove(cfg.TMP_PATH + out_fname)
+    if 'rate_syl' in features:
+        values['rate_syl'] = aux.count_syllables(words) / (end - start)
+    # only requested features (praat outputs all of an analysis)
+    return {cfg.FEATURE_KEYS[f]: values.get(cfg.FEATURE_KEYS[f]) 
+            for f in features}
 
 
 
@@ -0,0 +1,225 @@
+import numpy as np
+import os
+import sqlite3
+
+import cfg
+
+# this module generates synthetic corpora in the same format as the real ones
+# (database following cfg.SQL_INIT_FNAME_SB and token files as written by
+# fio.store_tokens), e.g., for benchmarks (see bench.py) without the licensed
+# corpus data; entrainment effects can be planted for all types of measures
+
+
+
+# mean, standard deviation across speakers, and standard deviation across
+# chunks of one speaker, per feature (roughly as in switchboard)
+FEATURE_DISTS = {
+    'intensity_mean': (60.0, 4.0, 3.0),
+    'intensity_std': (6.0, 1.0, 1.0),
+    'intensity_min': (40.0, 4.0, 3.0),
+    'intensity_max': (75.0, 4.0, 3.0),
+    'pitch_mean': (165.0, 20.0, 15.0),
+    'pitch_std': (25.0, 5.0, 5.0),
+    'pitch_min': (100.0, 15.0, 10.0),
+    'pitch_max': (250.0, 25.0, 20.0),
+    'jitter': (0.02, 0.005, 0.005),
+    'shimmer': (0.08, 0.02, 0.02),
+    'nhr': (0.15, 0.05, 0.05),
+    'rate_syl': (4.5, 0.5, 0.8),
+    'rate_vcd': (0.5, 0.05, 0.1)
+}
+# offset from the mean per gender for gender-dependent features
+GENDER_OFFSETS = {'pitch_mean': 40.0, 'pitch_min': 30.0, 'pitch_max': 50.0}
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _draw_speakers(rng, n_spk, dists):
+    ''' draws gender and baseline feature values for each speaker '''
+    genders = rng.choice(['f', 'm'], n_spk)
+    base = {}
+    for f, (mean, spk_std, _) in dists.items():
+        sign = np.where(genders == 'f', 1.0, -1.0)
+        base[f] = rng.normal(mean, spk_std, n_spk) \
+            + sign * GENDER_OFFSETS.get(f, 0.0)
+    return genders, base
+
+
+def _draw_words(rng, n, vocab_size, zipf, words_prev, lex_ent):
+    ''' draws n word ids, repeating words of the partner's previous turn '''
+    # zipfian word ids, redrawn until all are within the vocabulary
+    ids = rng.zipf(zipf, n)
+    while (ids > vocab_size).any():
+        fltr = ids > vocab_size
+        ids[fltr] = rng.zipf(zipf, fltr.sum())
+    if len(words_prev) > 0 and lex_ent > 0:
+        # lexical entrainment: reuse some of the partner's words
+        fltr = rng.random(n) < lex_ent
+        ids[fltr] = rng.choice(words_prev, fltr.sum())
+    return ids
+
+
+def _write_tokens(path, tsk_or_ses, tsk_ses_id, lines):
+    ''' writes tokens of both speakers like fio.store_tokens (one turn/line) '''
+    for a_or_b in ['A', 'B']:
+        if len(lines[a_or_b]) == 0:
+            continue
+        # same file names as fio.get_lmn_pfn
+        fname = '%s_%d_%s.txt' % (tsk_or_ses, tsk_ses_id, a_or_b)
+        with open(path + fname, 'w') as txt_file:
+            txt_file.write('\n'.join(lines[a_or_b]))
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def generate(db_fname, lmn_path=None, n_ses=100, n_spk=None, n_top=None,
+             n_tsk=1, turns=(20, 60), chunks=(1, 3), words=(1, 8),
+             vocab_size=1000, zipf=1.3, dists=FEATURE_DISTS, lsim=0.3,
+             gcon=0.3, lex_ent=0.2, seed=0):
+    ''' generates a synthetic corpus database (and token files)
+
+    speakers have individual baseline values per feature around the corpus
+    mean; planted entrainment effects (all 0 for none):
+    - lsim: turn-initial chunks move this fraction of the way towards the
+      partner's preceding turn-final chunk (local similarity, synchrony)
+    - gcon: speakers move this fraction of the way towards their partner's
+      baseline over the course of a session (global convergence)
+    - lex_ent: probability with which a word is taken from the partner's
+      preceding turn (lexical entrainment)
+
+    args:
+        db_fname: database file to create (overwritten if it exists)
+        lmn_path: path (with trailing "/") for token files and vocabulary, no
+            token files are written if None
+        n_ses: number of sessions
+        n_spk: number of speakers (default: half as many as sessions)
+        n_top: number of topics (default: one per 35 sessions, as in 
+            switchboard, so that there are non-partners with the same topic)
+        n_tsk: number of tasks per session (1 as in switchboard)
+        turns, chunks, words: (min, max) number of turns per task, chunks per
+            turn, and words per chunk, drawn uniformly
+        vocab_size: number of distinct words
+        zipf: parameter of the zipfian word distribution
+        dists: mean, speaker std, and chunk std per feature (FEATURE_DISTS)
+        lsim, gcon, lex_ent: planted entrainment effects, see above
+        seed: random seed, the same seed always yields the same corpus
+    returns:
+        dict with number of rows per table
+    '''
+    rng = np.random.default_rng(seed)
+    n_spk = max(4, n_ses // 2) if n_spk is None else n_spk
+    n_top = max(1, n_ses // 35) if n_top is None else n_top
+    assert n_spk >= 4, 'need at least 4 speakers for non-partners'
+    if os.path.isfile(db_fname):
+        os.remove(db_fname)
+    conn = sqlite3.connect(db_fname)
+    with open(cfg.SQL_PATH + cfg.SQL_INIT_FNAME_SB) as sql_file:
+        conn.executescript(sql_file.read())
+    feats = list(dists.keys())
+    genders, base = _draw_speakers(rng, n_spk, dists)
+    conn.executemany(
+        'INSERT INTO topics (top_id, title, details) VALUES (?, ?, ?);',
+        [(t, 'topic %d' % t, '') for t in range(1, n_top + 1)])
+    conn.executemany(
+        'INSERT INTO speakers (spk_id, gender) VALUES (?, ?);',
+        [(s + 1, genders[s]) for s in range(n_spk)])
+    vocab = set()
+    tsk_id = tur_id = chu_id = 0
+    rows_tur = []
+    rows_chu = []
+    rows_chf = []
+    for ses_id in range(1, n_ses + 1):
+        spk_ids = rng.choice(n_spk, 2, replace=False)
+        conn.execute(
+            'INSERT INTO sessions (ses_id, spk_id_a, spk_id_b, top_id, status)'
+            '\nVALUES (?, ?, ?, ?, 2);',
+            (ses_id, int(spk_ids[0]) + 1, int(spk_ids[1]) + 1,
+             int(rng.integers(1, n_top + 1))))
+        # feature levels per speaker (0: A, 1: B) at start and end of session
+        lvl_start = np.array([[base[f][s] for f in feats] for s in spk_ids])
+        lvl_end = lvl_start + gcon * (lvl_start[::-1] - lvl_start)
+        chu_std = np.array([dists[f][2] for f in feats])
+        n_turs = rng.integers(turns[0], turns[1] + 1, n_tsk)
+        n_turs_ses = n_turs.sum()
+        lines_ses = {'A': [], 'B': []}
+        t = 0.0
+        turn_index_ses = 0
+        # values of the last chunk and words of the previous turn
+        prev_vals = None
+        prev_words = np.array([], dtype=int)
+        for task_index in range(1, n_tsk + 1):
+            tsk_id += 1
+            dsc = 'A' if task_index % 2 == 1 else 'B'
+            conn.execute(
+                'INSERT INTO tasks (tsk_id, ses_id, task_index, a_or_b)\n'
+                'VALUES (?, ?, ?, ?);', (tsk_id, ses_id, task_index, dsc))
+            lines_tsk = {'A': [], 'B': []}
+            s = int(rng.integers(0, 2))
+            for turn_index in range(1, n_turs[task_index - 1] + 1):
+                tur_id += 1
+                turn_index_ses += 1
+                a_or_b = 'AB'[s]
+                rows_tur += [(tur_id, tsk_id, turn_index, turn_index_ses,
+                              'd' if a_or_b == dsc else 'f', a_or_b)]
+                # current level, linear in progress through the session
+                prog = turn_index_ses / n_turs_ses
+                lvl = (1 - prog) * lvl_start[s] + prog * lvl_end[s]
+                n_chu = int(rng.integers(chunks[0], chunks[1] + 1))
+                vals = lvl + rng.normal(0.0, 1.0, (n_chu, len(feats))) * chu_std
+                if prev_vals is not None:
+                    # local entrainment of the turn-initial chunk
+                    vals[0] += lsim * (prev_vals - vals[0])
+                tokens = []
+                for chunk_index in range(1, n_chu + 1):
+                    chu_id += 1
+                    dur = rng.uniform(0.3, 2.5)
+                    ids = _draw_words(
+                        rng, int(rng.integers(words[0], words[1] + 1)),
+                        vocab_size, zipf, prev_words, lex_ent)
+                    chu_words = ['w%d' % i for i in ids]
+                    tokens += chu_words
+                    rows_chu += [(chu_id, tur_id, chunk_index, t, t + dur,
+                                  dur, ' '.join(chu_words))]
+                    rows_chf += [
+                        (chu_id,)
+                        + tuple(float(v) for v in vals[chunk_index - 1])
+                        + (int(all(f in feats for f in cfg.FEATURES)),)]
+                    # pause of at least 50ms between chunks
+                    t += dur + rng.uniform(0.05, 0.5)
+                vocab.update(tokens)
+                lines_tsk[a_or_b] += [' '.join(tokens)]
+                lines_ses[a_or_b] += [' '.join(tokens)]
+                prev_vals = vals[-1]
+                prev_words = np.array([int(w[1:]) for w in tokens])
+                s = 1 - s
+            if lmn_path is not None:
+                _write_tokens(lmn_path, 'tsk', tsk_id, lines_tsk)
+        if lmn_path is not None:
+            _write_tokens(lmn_path, 'ses', ses_id, lines_ses)
+    conn.executemany(
+        'INSERT INTO turns (tur_id, tsk_id, turn_index, turn_index_ses,\n'
+        '                   speaker_role, speaker_a_or_b)\n'
+        'VALUES (?, ?, ?, ?, ?, ?);', rows_tur)
+    conn.executemany(
+        'INSERT INTO chunks (chu_id, tur_id, chunk_index, start_time,\n'
+        '                    end_time, duration, words)\n'
+        'VALUES (?, ?, ?, ?, ?, ?, ?);', rows_chu)
+    conn.executemany(
+        'INSERT INTO chunk_features (chu_id, %s, complete)\n'
+        'VALUES (%s);' % (', '.join(feats), ', '.join(['?'] * (2+len(feats)))),
+        rows_chf)
+    conn.execute('ANALYZE;')
+    conn.commit()
+    conn.close()
+    if lmn_path is not None:
+        with open(lmn_path + 'vocab.txt', 'w') as vocab_file:
+            vocab_file.write('\n'.join(sorted(vocab)))
+    return {'speakers': n_spk, 'sessions': n_ses, 'tasks': tsk_id,
+            'turns': tur_id, 'chunks': chu_id}
@@ -0,0 +1,501 @@
+import hashlib
+import os
+import pandas as pd
+
+import ap
+import cfg
+import db
+import fio
+import lex
+
+# this module supports incremental recomputation after sessions were added to,
+# removed from, or changed in a database that was analyzed before: each
+# session's content is summarized by a signature and the speaker pairs (which
+# sessions serve as partner/non-partner baseline for which others) are stored
+# with the results; the next run then only recomputes what depends on sessions
+# whose signature changed and reuses everything else
+#
+# typical order of calls (after new sessions were inserted/old ones deleted):
+#     plan = inc.get_plan()
+#     inc.update_chunk_pairs(plan)
+#     inc.update_tokens_lms(corpus_id, plan)
+#     inc.update_feature_stats(plan)
+#     df_bt = ap.load_data(..., stored_stats=True)
+#     df_spk_pairs = spk.get_spk_pairs()
+#     inc.update_ap_measure(corpus_id, plan, cfg.MEA_LSIM, df_bt, ...)
+#     inc.update_lex_measure(corpus_id, plan, cfg.MEA_KLD, df_spk_pairs_ses)
+#     ap.gcon(df_bt), ap.gsim(df_bt, df_spk_pairs) (cheap, always recomputed)
+#     inc.store_state(plan, df_spk_pairs)
+# (the very first run simply computes everything, no previous state exists)
+
+# columns of the lexical measures' raw results, per measure
+_LEX_COLS = {cfg.MEA_PPL: 'ppl', cfg.MEA_KLD: 'kld', cfg.MEA_HFW: 'dsim'}
+# columns identifying speaker pairs
+_PAIR_COLS = ['p_or_x', 'ses_id', 'tsk_id', 'spk_id',
+              'ses_id_paired', 'tsk_id_paired', 'spk_id_paired']
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _create_tables():
+    ''' creates the tables holding the state of the last run, if needed '''
+    db.dbc.executescript(
+        'CREATE TABLE IF NOT EXISTS inc_sessions (\n'
+        '    ses_id     INTEGER NOT NULL,\n'
+        '    spk_id_a   INTEGER NOT NULL,\n'
+        '    spk_id_b   INTEGER NOT NULL,\n'
+        '    signature  TEXT NOT NULL,\n'
+        '    PRIMARY KEY (ses_id)\n'
+        ');\n'
+        'CREATE TABLE IF NOT EXISTS inc_pairs (\n'
+        '    p_or_x         TEXT NOT NULL,\n'
+        '    ses_id         INTEGER NOT NULL,\n'
+        '    tsk_id         INTEGER NOT NULL,\n'
+        '    spk_id         INTEGER NOT NULL,\n'
+        '    ses_id_paired  INTEGER NOT NULL,\n'
+        '    tsk_id_paired  INTEGER NOT NULL,\n'
+        '    spk_id_paired  INTEGER NOT NULL\n'
+        ');\n'
+        'CREATE TABLE IF NOT EXISTS inc_values (\n'
+        '    key    TEXT NOT NULL,\n'
+        '    value  TEXT NOT NULL,\n'
+        '    PRIMARY KEY (key)\n'
+        ');\n')
+
+
+def _get_value(key):
+    ''' returns value stored for given key in the last run (or None) '''
+    _create_tables()
+    rows = db.dbc.execute(
+        'SELECT value FROM inc_values WHERE key == ?;', (key,)).fetchall()
+    return rows[0][0] if len(rows) > 0 else None
+
+
+def _set_value(key, value):
+    ''' stores given value for given key (committed with the next commit) '''
+    _create_tables()
+    db.dbc.execute(
+        'INSERT OR REPLACE INTO inc_values (key, value) VALUES (?, ?);',
+        (key, value))
+
+
+def _load_pairs():
+    ''' returns speaker pairs stored in the last run (see store_state) '''
+    _create_tables()
+    return db.pd_read_sql_query('SELECT * FROM inc_pairs;')
+
+
+def _hash_file(fname):
+    ''' returns md5 hash of given file's content (None if it does not exist) '''
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, 'rb') as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+
+def _tsk_ses_keys(df, suffix=''):
+    ''' returns (ses_id, tsk_id) index for all rows in given dataframe '''
+    return pd.MultiIndex.from_arrays(
+        [df['ses_id' + suffix], df['tsk_id' + suffix]])
+
+
+def _removed_tsk_ids(plan):
+    ''' returns tsk_ids of removed sessions (from stored speaker pairs) '''
+    df_old = _load_pairs()
+    df_old = df_old[df_old['ses_id'].isin(plan['removed'])]
+    return sorted(set(df_old['tsk_id']) - set([0]))
+
+
+
+################################################################################
+#                                CHANGE TRACKING                               #
+################################################################################
+
+def get_signatures(batch_size=cfg.BATCH_SIZE):
+    ''' computes a signature for each session, summarizing all its content
+
+    the signature is a hash over all rows of the session's tasks, turns, and
+    chunks (ids, order, speakers, timestamps, words, and features), streamed
+    from the database one session at a time
+
+    returns:
+        dict mapping each ses_id to tuple (spk_id_a, spk_id_b, signature)
+    '''
+    df_ses = db.pd_read_sql_query(
+        'SELECT ses_id, spk_id_a, spk_id_b, top_id FROM sessions;')
+    sigs = {}
+    for ses_id, spk_id_a, spk_id_b, top_id in df_ses.itertuples(index=False):
+        # sessions without chunks only depend on their meta-data
+        sig = hashlib.md5(repr((spk_id_a, spk_id_b, top_id)).encode())
+        sigs[int(ses_id)] = (int(spk_id_a), int(spk_id_b), sig.hexdigest())
+    sql_stmt = \
+        'SELECT tsk.ses_id,\n' \
+        '       ses.spk_id_a,\n' \
+        '       ses.spk_id_b,\n' \
+        '       ses.top_id,\n' \
+        '       tsk.tsk_id,\n' \
+        '       tsk.task_index,\n' \
+        '       tsk.a_or_b,\n' \
+        '       tur.tur_id,\n' \
+        '       tur.turn_index,\n' \
+        '       tur.speaker_role,\n' \
+        '       chu.*,\n' \
+        '       chf.*\n' \
+        'FROM   sessions ses\n' \
+        'JOIN   tasks tsk\n' \
+        'ON     ses.ses_id == tsk.ses_id\n' \
+        'JOIN   turns tur\n' \
+        'ON     tsk.tsk_id == tur.tsk_id\n' \
+        'JOIN   chunks chu\n' \
+        'ON     tur.tur_id == chu.tur_id\n' \
+        'LEFT JOIN chunk_features chf\n' \
+        'ON     chu.chu_id == chf.chu_id\n' \
+        'ORDER BY tsk.ses_id,\n' \
+        '         tsk.task_index,\n' \
+        '         tur.turn_index,\n' \
+        '         chu.chunk_index;'
+    for ses_id, df in db.iter_sessions(sql_stmt, batch_size=batch_size):
+        # csv representation: NULL and NaN identical, floats at full precision
+        sig = hashlib.md5(df.to_csv(index=False, header=False).encode())
+        sigs[int(ses_id)] = sigs[int(ses_id)][:2] + (sig.hexdigest(),)
+    return sigs
+
+
+def get_plan():
+    ''' determines which sessions changed since the last run (store_state)
+
+    returns:
+        dict with sorted lists of ses_ids "added", "removed", "modified",
+        "changed" (added or modified), and "unchanged", plus the current and
+        previous "signatures" (see get_signatures) and whether the vocabulary
+        changed (set by update_tokens_lms)
+    '''
+    _create_tables()
+    # flags of complete chunks are part of the signatures; if the analyzed 
+    # features changed, sessions whose flags change count as modified
+    db.set_complete()
+    db.commit()
+    sigs = get_signatures()
+    sigs_old = {
+        int(ses_id): (int(spk_id_a), int(spk_id_b), sig)
+        for ses_id, spk_id_a, spk_id_b, sig
+        in db.dbc.execute('SELECT * FROM inc_sessions;').fetchall()
+    }
+    added = sorted(set(sigs) - set(sigs_old))
+    removed = sorted(set(sigs_old) - set(sigs))
+    both = set(sigs) & set(sigs_old)
+    modified = sorted(s for s in both if sigs[s] != sigs_old[s])
+    unchanged = sorted(s for s in both if sigs[s] == sigs_old[s])
+    print('sessions: %d added, %d removed, %d modified, %d unchanged' % (
+        len(added), len(removed), len(modified), len(unchanged)))
+    return {
+        'added': added,
+        'removed': removed,
+        'modified': modified,
+        'changed': sorted(added + modified),
+        'unchanged': unchanged,
+        'signatures': sigs,
+        'signatures_old': sigs_old,
+        'vocab_changed': False
+    }
+
+
+def store_state(plan, df_spk_pairs):
+    ''' stores session signatures and speaker pairs for the next run
+
+    call only once all results are updated, sessions are considered processed
+    from then on
+
+    args:
+        plan: dict as returned by get_plan
+        df_spk_pairs: all speaker pairs, as returned by spk.get_spk_pairs
+    '''
+    _create_tables()
+    db.dbc.execute('DELETE FROM inc_sessions;')
+    db.dbc.executemany(
+        'INSERT INTO inc_sessions (ses_id, spk_id_a, spk_id_b, signature)\n'
+        'VALUES (?, ?, ?, ?);',
+        [(ses_id,) + sig for ses_id, sig in plan['signatures'].items()])
+    db.dbc.execute('DELETE FROM inc_pairs;')
+    db.dbc.executemany(
+        'INSERT INTO inc_pairs (%s)\nVALUES (%s);' % (
+            ', '.join(_PAIR_COLS), ', '.join(['?'] * len(_PAIR_COLS))),
+        [(r[0],) + tuple(int(v) for v in r[1:])
+         for r in df_spk_pairs.loc[:, _PAIR_COLS].itertuples(index=False)])
+    db.commit()
+
+
+
+################################################################################
+#                                DEPENDENCIES                                  #
+################################################################################
+
+def get_lex_targets(plan, df_spk_pairs):
+    ''' determines tasks/sessions whose lexical measures must be recomputed
+
+    these are all tasks/sessions that changed themselves, that have a changed
+    partner or non-partner (baseline) task/session, or whose set of speaker
+    pairs differs from the last run (e.g., non-partners from removed sessions,
+    or speakers that interacted with each other in an added session)
+
+    args:
+        plan: dict as returned by get_plan
+        df_spk_pairs: current speaker pairs, as passed to the measure
+    returns:
+        set of (ses_id, tsk_id) tuples (tsk_id 0 for sessions)
+    '''
+    df_new = df_spk_pairs.loc[:, _PAIR_COLS]
+    # own or paired task/session changed
+    fltr = df_new['ses_id'].isin(plan['changed']) \
+        | df_new['ses_id_paired'].isin(plan['changed'])
+    targets = set(_tsk_ses_keys(df_new[fltr]))
+    # speaker pairs added or removed since the last run (only compare the
+    # same kind of rows, tasks and/or sessions, as currently given)
+    df_old = _load_pairs()
+    tsk_ses = set(df_new['tsk_id'] == 0)
+    df_old = df_old[(df_old['tsk_id'] == 0).isin(tsk_ses)]
+    df_diff = df_new.merge(df_old, how='outer', indicator=True)
+    df_diff = df_diff[df_diff['_merge'] != 'both']
+    targets |= set(_tsk_ses_keys(df_diff))
+    # only tasks/sessions that (still) exist
+    return targets & set(_tsk_ses_keys(df_new))
+
+
+def get_ap_sessions(plan, nrm_type):
+    ''' determines sessions whose acoustic-prosodic features might change
+
+    normalized features of a session change if the session itself changed or
+    the statistics used for normalization did: those of either speaker (for
+    cfg.NRM_SPK, any other session of the speaker changed) or of a gender
+    (for cfg.NRM_GND, any session changed)
+
+    args:
+        plan: dict as returned by get_plan
+        nrm_type: how features are normalized (see cfg.NRM_TYPES)
+    returns:
+        sorted list of ses_ids
+    '''
+    assert nrm_type in cfg.NRM_TYPES, 'unknown normalization type'
+    if nrm_type == cfg.NRM_RAW:
+        return plan['changed']
+    if len(plan['changed']) + len(plan['removed']) == 0:
+        return []
+    if nrm_type == cfg.NRM_GND:
+        return sorted(plan['signatures'])
+    # speakers of changed and removed sessions
+    spk_ids = set()
+    for ses_id in plan['changed']:
+        spk_ids.update(plan['signatures'][ses_id][:2])
+    for ses_id in plan['removed']:
+        spk_ids.update(plan['signatures_old'][ses_id][:2])
+    return sorted(ses_id for ses_id, sig in plan['signatures'].items()
+                  if sig[0] in spk_ids or sig[1] in spk_ids)
+
+
+
+################################################################################
+#                                    STAGES                                    #
+################################################################################
+
+def update_chunk_pairs(plan):
+    ''' recomputes chunk pairs (cfg.SQL_AT_FNAME) only for changed sessions '''
+    db.dbc.execute(
+        'CREATE TABLE IF NOT EXISTS ses_todo (\n'
+        '    ses_id    INTEGER NOT NULL,\n'
+        '    PRIMARY KEY (ses_id)\n'
+        ');')
+    if len(plan['changed']) > 0:
+        db.dbc.executemany(
+            'INSERT OR IGNORE INTO ses_todo (ses_id) VALUES (?);',
+            [(ses_id,) for ses_id in plan['changed']])
+        db.executescript(cfg.SQL_PATH, cfg.SQL_AT_FNAME)
+    else:
+        # aux table script would process all sessions; only remove pairs of
+        # removed sessions (chunks of both pair members are always the same
+        # session's, checking the turn-initial one is enough)
+        db.dbc.execute(
+            'DELETE\n'
+            'FROM   chunk_pairs\n'
+            'WHERE  chu_id2 NOT IN (SELECT chu_id FROM chunks);')
+    db.commit()
+    print('chunk pairs: recomputed %d sessions, reused %d' % (
+        len(plan['changed']), len(plan['unchanged'])))
+
+
+def update_feature_stats(plan):
+    ''' recomputes stored feature moments (see ap.store_feature_stats)
+
+    only for changed sessions (moments of removed ones are dropped) and
+    unchanged sessions without stored moments (e.g., in the first run)
+    '''
+    ap.store_feature_stats([])
+    stored = set(v[0] for v in db.dbc.execute(
+        'SELECT DISTINCT ses_id FROM feature_moments;'))
+    ses_ids = sorted(set(plan['changed'])
+                     | (set(plan['unchanged']) - stored))
+    ap.store_feature_stats(ses_ids)
+    print('feature moments: recomputed %d sessions, reused %d' % (
+        len(ses_ids), len(plan['signatures']) - len(ses_ids)))
+
+
+def update_tokens_lms(corpus_id, plan, lms=True):
+    ''' rewrites token files and lms/ngrams only for changed sessions
+
+    lms and ngram counts depend on the vocabulary of the entire corpus, all of
+    them are recomputed if it changed (plan["vocab_changed"] is set for later
+    stages); memoized lexical results of changed tasks/sessions are cleared
+
+    args:
+        corpus_id: one of the constants defined in cfg, identifying the corpus
+        plan: dict as returned by get_plan
+        lms: whether to (re)compute lm and ngram files as well (needs srilm)
+    '''
+    # remove files of removed sessions and their tasks
+    tsk_ids = _removed_tsk_ids(plan)
+    for ext in ['txt', 'lm', 'cnt']:
+        fio.remove_lmn_files(corpus_id, 'ses', ext, plan['removed'])
+        fio.remove_lmn_files(corpus_id, 'tsk', ext, tsk_ids)
+    if len(plan['changed']) + len(plan['removed']) == 0:
+        print('tokens, lms: nothing to recompute')
+        return
+    vocab_hash = _hash_file(cfg.get_vocab_fname(corpus_id))
+    fio.store_tokens(corpus_id, ses_ids=plan['changed'])
+    plan['vocab_changed'] = \
+        vocab_hash != _hash_file(cfg.get_vocab_fname(corpus_id))
+    # clear memoized results of changed and removed tasks/sessions
+    ses_ids = plan['changed'] + plan['removed']
+    lex.clear_memos('ses', ses_ids)
+    lex.clear_memos('tsk', db.get_tsk_ses_ids('tsk', ses_ids) + tsk_ids)
+    print('tokens: rewrote %d sessions, reused %d; vocabulary %s' % (
+        len(plan['changed']), len(plan['unchanged']),
+        'changed' if plan['vocab_changed'] else 'unchanged'))
+    if not lms:
+        return
+    if plan['vocab_changed']:
+        lex.store_lms_ngrams(corpus_id)
+        lex.clear_memos()
+        print('lms: recomputed all sessions (vocabulary changed)')
+    else:
+        lex.store_lms_ngrams(corpus_id, ses_ids=plan['changed'])
+        print('lms: recomputed %d sessions, reused %d' % (
+            len(plan['changed']), len(plan['unchanged'])))
+
+
+def update_lex_measure(corpus_id, plan, mea_id, df_spk_pairs, **kwargs):
+    ''' recomputes a lexical measure only for affected tasks/sessions
+
+    entropy weights are computed for the affected speaker pairs only, raw
+    results of all other tasks/sessions are taken from the pickle dumps of the
+    last run, and the t-tests are rerun on the merged raw results; everything
+    is recomputed if there are no dumps yet, the vocabulary changed, or the
+    given types differ from the last run
+
+    args:
+        corpus_id: one of the constants defined in cfg, identifying the corpus
+        plan: dict as returned by get_plan
+        mea_id: cfg.MEA_PPL, cfg.MEA_KLD, or cfg.MEA_HFW (lex.dist_sim)
+        df_spk_pairs: speaker pairs as returned by spk.get_spk_pairs (or the
+            subset for sessions/tasks only), without entropy weights
+        kwargs: further arguments for lex.dist_sim (types_id, types, ...)
+    returns:
+        tuple of dataframes with test results and raw results, as returned by
+        the measure (both are also written to the pickle dumps)
+    '''
+    assert mea_id in _LEX_COLS, 'not a lexical measure'
+    func = {
+        cfg.MEA_PPL: lex.ppl, cfg.MEA_KLD: lex.kld, cfg.MEA_HFW: lex.dist_sim
+    }[mea_id]
+    _, df_raw_old = fio.load_pickle_dumps(corpus_id, mea_id)
+    types = repr(list(kwargs.get('types', [])))
+    keys = _tsk_ses_keys(df_spk_pairs)
+    if df_raw_old is None or plan['vocab_changed'] \
+    or _get_value(mea_id + '_types') != types:
+        targets = set(keys)
+    else:
+        targets = get_lex_targets(plan, df_spk_pairs)
+    fltr = keys.isin(list(targets))
+    # partner rows of paired speakers are needed for their entropies
+    fltr_p = (df_spk_pairs['p_or_x'] == 'p') & keys.isin(
+        list(set(_tsk_ses_keys(df_spk_pairs[fltr], '_paired'))))
+    df_sub = df_spk_pairs[fltr | fltr_p]
+    dfs_raw = []
+    if len(targets) > 0:
+        df_sub = lex.get_entropy_weights(corpus_id, df_sub)
+        df_sub = df_sub[_tsk_ses_keys(df_sub).isin(list(targets))]
+        dfs_raw += [func(corpus_id, df_sub, **kwargs)[1]]
+    if len(targets) < len(set(keys)):
+        # reuse raw results of all other, still existing tasks/sessions
+        keys_old = pd.MultiIndex.from_arrays([
+            df_raw_old.index.get_level_values(1),
+            df_raw_old.index.get_level_values(2)])
+        reuse = set(keys) - targets
+        dfs_raw += [df_raw_old[keys_old.isin(list(reuse))]]
+    df_raw = pd.concat(dfs_raw, axis=0)
+    # same order as in the measure: per speaker first, then symmetric (spk 0)
+    spk0 = df_raw.index.get_level_values(3) == 0
+    df_raw = pd.concat(
+        [df_raw[~spk0].sort_index(), df_raw[spk0].sort_index()], axis=0)
+    df_res = lex.run_ttests(df_raw, _LEX_COLS[mea_id])
+    fio.write_pickle_dumps(corpus_id, mea_id, df_res, df_raw)
+    _set_value(mea_id + '_types', types)
+    db.commit()
+    print('%s: recomputed %d tasks/sessions, reused %d' % (
+        mea_id, len(targets), len(set(keys)) - len(targets)))
+    return df_res, df_raw
+
+
+def update_ap_measure(
+        corpus_id, plan, mea_id, df_bt, nrm_type, grp_by, func=None):
+    ''' recomputes a local acoustic-prosodic measure for affected sessions
+
+    results per session, task, and speaker of all other sessions are taken
+    from the pickle dump of the last run; results per session type are always
+    recomputed (they depend on all sessions); everything is recomputed if
+    there is no dump yet or normalization, grouping, or features changed
+
+    args:
+        corpus_id: one of the constants defined in cfg, identifying the corpus
+        plan: dict as returned by get_plan
+        mea_id: cfg.MEA_LSIM, cfg.MEA_SYN, or cfg.MEA_LCON
+        df_bt: "big table" pandas dataframe as returned by ap.load_data
+        nrm_type: normalization used for df_bt (see cfg.NRM_TYPES)
+        grp_by: list of constants from cfg.GRP_BYS, as for the measure
+        func: measure function, default ap.lsim, ap.syn, or ap.lcon
+    returns:
+        dataframe with results, as returned by the measure (also written to
+        the pickle dump)
+    '''
+    if func is None:
+        func = {
+            cfg.MEA_LSIM: ap.lsim, cfg.MEA_SYN: ap.syn, cfg.MEA_LCON: ap.lcon
+        }[mea_id]
+    df_old, _ = fio.load_pickle_dumps(corpus_id, mea_id)
+    params = repr((nrm_type, sorted(grp_by), cfg.FEATURES))
+    ses_ids_all = sorted(set(df_bt['ses_id']))
+    if df_old is None or _get_value(mea_id + '_params') != params:
+        ses_ids = ses_ids_all
+    else:
+        ses_ids = get_ap_sessions(plan, nrm_type)
+    dfs = []
+    if len(ses_ids) < len(ses_ids_all):
+        # reuse results of all other sessions (not those per session type)
+        ses_ids_old = df_old.index.get_level_values(1)
+        reuse = set(ses_ids_all) - set(ses_ids)
+        dfs += [df_old[ses_ids_old.isin(list(reuse))]]
+    grp_by_ses = [g for g in grp_by if g != cfg.GRP_BY_SES_TYPE]
+    df_sub = df_bt[df_bt['ses_id'].isin(ses_ids)]
+    if len(df_sub) > 0 and len(grp_by_ses) > 0:
+        dfs += [func(df_sub, grp_by_ses)]
+    if cfg.GRP_BY_SES_TYPE in grp_by:
+        dfs += [func(df_bt, [cfg.GRP_BY_SES_TYPE])]
+    df_res = pd.concat(dfs, axis=0).sort_index()
+    fio.write_pickle_dumps(corpus_id, mea_id, df_res)
+    _set_value(mea_id + '_params', params)
+    db.commit()
+    print('%s: recomputed %d sessions, reused %d' % (
+        mea_id, len(ses_ids), len(ses_ids_all) - len(ses_ids)))
+    return df_res
@@ -0,0 +1,161 @@
+import numpy as np
+
+import cfg
+
+try:
+    import numba
+except ImportError:
+    # optional dependency, all kernels fall back to numpy
+    numba = None
+
+# this module provides kernels for hot loops that do not vectorize cleanly
+# with pandas, compiled with numba if it is installed and cfg.USE_JIT is set
+# (the single switch for all kernels), pure numpy/python otherwise
+#
+# each kernel has a fallback (vectorized with numpy where possible) and a loop
+# version that numba compiles (on first use, cached per process); both give
+# the same results, integers exactly and floats up to the order of summation
+# (see bench.run_kernels, which checks and times both per kernel)
+
+
+
+# kernels by name, see KERNELS below; compiled loop versions per kernel
+_compiled = {}
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _kld_np(p, q, seen_p, seen_q, epsilon):
+    ''' kld with backoff for unseen types, vectorized (see kld) '''
+    n = len(p)
+    p = np.where(seen_p, (1 - (n - np.sum(seen_p)) * epsilon) * p, epsilon)
+    q = np.where(seen_q, (1 - (n - np.sum(seen_q)) * epsilon) * q, epsilon)
+    return float(np.sum(p * np.log(p / q)))
+
+
+def _kld_loop(p, q, seen_p, seen_q, epsilon):
+    ''' kld with backoff for unseen types, as loop for numba (see kld) '''
+    n = len(p)
+    n_p = 0
+    n_q = 0
+    for i in range(n):
+        n_p += seen_p[i]
+        n_q += seen_q[i]
+    coeff_p = 1 - (n - n_p) * epsilon
+    coeff_q = 1 - (n - n_q) * epsilon
+    res = 0.0
+    for i in range(n):
+        p_i = coeff_p * p[i] if seen_p[i] else epsilon
+        q_i = coeff_q * q[i] if seen_q[i] else epsilon
+        res += p_i * np.log(p_i / q_i)
+    return res
+
+
+def _turns_loop(spk_idx, ends, tur_id):
+    ''' assigns chunks to turns, as loop (see turns) '''
+    n = len(spk_idx)
+    new_turn = np.zeros(n, dtype=np.bool_)
+    tur_ids = np.zeros(n, dtype=np.int64)
+    tur_idx = np.zeros(n, dtype=np.int64)
+    chu_idx = np.zeros(n, dtype=np.int64)
+    # end of last chunk, turn id, turn index, and chunk index per speaker
+    spk_ends = np.zeros(2)
+    spk_tur_ids = np.zeros(2, dtype=np.int64)
+    spk_tur_idx = np.zeros(2, dtype=np.int64)
+    spk_chu_idx = np.zeros(2, dtype=np.int64)
+    for i in range(n):
+        s = spk_idx[i]
+        o = 1 - s
+        if spk_ends[o] > spk_ends[s] or spk_tur_idx[o] > spk_tur_idx[s] \
+                or spk_tur_idx[s] == 0:
+            # new turn
+            spk_tur_idx[s] = max(spk_tur_idx[0], spk_tur_idx[1]) + 1
+            tur_id += 1
+            spk_tur_ids[s] = tur_id
+            spk_chu_idx[s] = 1
+            new_turn[i] = True
+        else:
+            # continuation of the speaker's last turn
+            spk_chu_idx[s] += 1
+        spk_ends[s] = ends[i]
+        tur_ids[i] = spk_tur_ids[s]
+        tur_idx[i] = spk_tur_idx[s]
+        chu_idx[i] = spk_chu_idx[s]
+    return new_turn, tur_ids, tur_idx, chu_idx
+
+
+# fallback and loop version (compiled with numba) per kernel
+KERNELS = {
+    'kld': (_kld_np, _kld_loop),
+    'turns': (_turns_loop, _turns_loop)
+}
+
+
+def _get_kernel(name, use_jit=None):
+    ''' returns compiled or fallback version of given kernel
+
+    args:
+        name: kernel name (see KERNELS)
+        use_jit: whether to use the compiled version (default: cfg.USE_JIT);
+            fallback if numba is not installed
+    '''
+    use_jit = cfg.USE_JIT if use_jit is None else use_jit
+    if not use_jit or numba is None:
+        return KERNELS[name][0]
+    if name not in _compiled:
+        _compiled[name] = numba.njit(KERNELS[name][1])
+    return _compiled[name]
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def is_available():
+    ''' returns whether compiled kernels can be used (numba installed) '''
+    return numba is not None
+
+
+def kld(p, q, seen_p, seen_q, epsilon, use_jit=None):
+    ''' computes kld of two distributions with backoff for unseen types
+
+    probabilities of seen types are scaled so that each distribution sums to
+    1 with epsilon for all unseen types (see lex.compute_kld)
+
+    args:
+        p, q: numpy float arrays with probability per type (aligned over the
+            vocabulary of both)
+        seen_p, seen_q: numpy bool arrays, whether type is in p or q, resp.
+        epsilon: probability for unseen types
+        use_jit: see _get_kernel
+    returns:
+        kld of p from q
+    '''
+    return _get_kernel('kld', use_jit)(p, q, seen_p, seen_q, epsilon)
+
+
+def turns(spk_idx, ends, tur_id=0, use_jit=None):
+    ''' assigns chunks of a session to turns
+
+    a chunk starts a new turn if the other speaker's last chunk ended later,
+    the other speaker had a later turn, or the speaker had no turn yet (see
+    sb.populate_turns_and_chunks)
+
+    args:
+        spk_idx: numpy int array with speaker (0 for A, 1 for B) per chunk,
+            chunks sorted by start time
+        ends: numpy float array with end time per chunk
+        tur_id: last turn id assigned before the session (ids are global)
+        use_jit: see _get_kernel
+    returns:
+        tuple of numpy arrays per chunk: whether it starts a new turn, its
+        turn id, turn index (in session), and chunk index (in turn)
+    '''
+    return _get_kernel('turns', use_jit)(
+        np.asarray(spk_idx, dtype=np.int64), np.asarray(ends, dtype=float),
+        tur_id)
@@ -1,40 +1,91 @@
-import collections
+import concurrent.futures
+import hashlib
 import math
 import nltk
+import numpy as np
 import os
 import pandas as pd
 import subprocess
+import time
 
 import aux
 import cfg
 import db
 import fio
+import jit
 
 
-def store_lms_ngrams(corpus_id, tsk_or_ses=None):
+def _train_lm(path, fname, vocab_fname, sig):
+    ''' computes lm and ngram counts for one txt file in one srilm pass
+
+    the signature of the inputs is stored alongside (see store_lms_ngrams),
+    only after both files were written
+
+    returns:
+        size of the txt file (bytes)
+    '''
+    if os.path.isfile(path + fname + '.sig'):
+        os.remove(path + fname + '.sig')
+    subprocess.check_call(
+        ['ngram-count', 
+         '-text', path + fname + '.txt', 
+         '-vocab', vocab_fname,
+         '-lm', path + fname + '.lm', 
+         '-write', path + fname + '.cnt'])
+    with open(path + fname + '.sig', 'w') as sig_file:
+        sig_file.write(sig)
+    return os.path.getsize(path + fname + '.txt')
+
+
+def store_lms_ngrams(
+        corpus_id, tsk_or_ses=None, ses_ids=None, n_jobs=None, force=False):
     ''' computes lm and ngram files for all tasks/sessions using srilm
 
-    based on txt file per session/task stored beforehand (fio.store_tokens)'''
-    if tsk_or_ses is None:
-        store_lms_ngrams(corpus_id, 'tsk')
-        store_lms_ngrams(corpus_id, 'ses')
-    else:
-        fio.remove_lmn_files(corpus_id, tsk_or_ses, 'lm')
-        fio.remove_lmn_files(corpus_id, tsk_or_ses, 'cnt')
-        for tsk_ses_id in db.get_tsk_ses_ids(tsk_or_ses):
+    based on txt file per session/task stored beforehand (fio.store_tokens);
+    lm and counts of a file are written by one ngram-count run, all files are
+    processed in parallel; files whose inputs (txt file and vocabulary) did
+    not change since they were computed are skipped, based on a signature
+    stored with them (sig file); if ses_ids are given, only files of those 
+    sessions (or their tasks) are considered
+
+    args:
+        corpus_id: one of the constants defined in cfg, identifying the corpus
+        tsk_or_ses: "tsk" or "ses" files, both if None
+        ses_ids: sessions to consider, all if None
+        n_jobs: number of processes (default: number of cpus; 1 runs all in
+            this process)
+        force: whether to recompute files with unchanged inputs as well
+    '''
+    vocab_fname = cfg.get_vocab_fname(corpus_id)
+    with open(vocab_fname, 'rb') as vocab_file:
+        vocab_hash = hashlib.md5(vocab_file.read()).hexdigest()
+    args = []
+    n_skipped = 0
+    for t_or_s in ['tsk', 'ses'] if tsk_or_ses is None else [tsk_or_ses]:
+        for tsk_ses_id in db.get_tsk_ses_ids(t_or_s, ses_ids):
             for a_or_b in ['A', 'B']:
                 path, fname = fio.get_lmn_pfn(
-                    corpus_id, tsk_or_ses, tsk_ses_id, a_or_b)
-                subprocess.check_call(
-                    ['ngram-count', 
-                     '-lm', path + fname + '.lm', 
-                     '-text', path + fname + '.txt', 
-                     '-vocab', cfg.get_vocab_fname(corpus_id)])
-                subprocess.check_call(
-                    ['ngram-count', 
-                     '-text', path + fname + '.txt', 
-                     '-write', path + fname + '.cnt', 
-                     '-vocab', cfg.get_vocab_fname(corpus_id)])
+                    corpus_id, t_or_s, tsk_ses_id, a_or_b)
+                with open(path + fname + '.txt', 'rb') as txt_file:
+                    sig = vocab_hash + ' ' \
+                        + hashlib.md5(txt_file.read()).hexdigest()
+                if not force and os.path.isfile(path + fname + '.lm') \
+                and os.path.isfile(path + fname + '.cnt') \
+                and os.path.isfile(path + fname + '.sig'):
+                    with open(path + fname + '.sig') as sig_file:
+                        if sig_file.read() == sig:
+                            n_skipped += 1
+                            continue
+                args += [(path, fname, vocab_fname, sig)]
+    start = time.time()
+    if n_jobs == 1 or len(args) == 0:
+        sizes = [_train_lm(*a) for a in args]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+            sizes = list(executor.map(_train_lm, *zip(*args)))
+    secs = max(time.time() - start, 1e-9)
+    print('lms: computed %d, skipped %d (unchanged); %.1f lms/s, %.2f MB/s'
+          % (len(args), n_skipped, len(args) / secs, sum(sizes) / secs / 1e6))
 
 
 def mem_entropy(f):
@@ -45,6 +96,7 @@ def mem_entropy(f):
         if params not in memo:
             memo[params] = f(*params)
         return memo[params]
+    helper.memo = memo
     return helper
 
 
@@ -124,7 +176,7 @@ def get_entropy_weights(corpus_id, df_spk_pairs):
     args:
         corpus_id: one of the constants defined in cfg, identifying the corpus
         df_spk_pairs: pandas dataframe with columns identifying speaker pairs
-            (partners and non-partners), loaded through cfg.SQL_SP_FNAME script
+            (partners and non-partners), as returned by spk.get_spk_pairs
     '''
     # get entropies of speaker, partner, and (non)-partner in each row
     df_ent3 = get_entropy_triplets(corpus_id, df_spk_pairs)
@@ -165,6 +217,7 @@ def mem_perplexity(f):
         if params not in memo:
             memo[params] = f(*params)
         return memo[params]
+    helper.memo = memo
     return helper
 
 
@@ -215,6 +268,7 @@ def mem_token_count(f):
         if params not in memo:
             memo[params] = f(*params)
         return memo[params]
+    helper.memo = memo
     return helper
 
 
@@ -241,6 +295,7 @@ def mem_dist(f):
         if params not in memo:
             memo[params] = f(*params, types, excl)
         return memo[params]
+    helper.memo = memo
     return helper
 
 
@@ -300,6 +355,7 @@ def mem_dist_comp(f):
         # at this point, either params1 or params2 is in memo
         params = params1 if params1 in memo else params2
         return memo[params]
+    helper.memo = memo
     return helper
 
 
@@ -323,6 +379,36 @@ def compare_dists(
                 for t in types])
 
 
+def run_ttests(df_results_raw, mea_col):
+    ''' runs paired t-tests of partner vs. non-partner values per ses_type
+
+    args:
+        df_results_raw: raw results as returned by ppl, dist_sim, and kld
+            (or merged from several runs, see inc.py), indexed by ses_type, 
+            ses_id, tsk_id, and spk_id
+        mea_col: prefix of the measure's columns ("ppl", "dsim", or "kld")
+    returns:
+        pandas dataframe with results (t-statistic, p-value, degrees of 
+        freedom) for raw and weighted values, indexed by session type
+    '''
+    # exclude symmetric version of the measure (spk_id 0)
+    df = df_results_raw[df_results_raw.index.get_level_values(3) != 0]
+    results = {'raw': {}, 'wgh': {}}
+    for ses_type in [0, 'GAME', 'CONV']:
+        if ses_type and ses_type not in set(df.index.get_level_values(0)):
+            continue
+        df_sub = df.xs(ses_type, drop_level=False) if ses_type else df
+        # filter for sessions, i.e., tsk_id == 0
+        df_sub = df_sub.xs(0, level=2)
+        # exclude rows with missing non-partner values
+        df_sub = df_sub[pd.notna(df_sub[mea_col + '_x'])]
+        results['raw'][ses_type] = aux.ttest_rel(df_sub[mea_col + '_p'], 
+                                                 df_sub[mea_col + '_x'])
+        results['wgh'][ses_type] = aux.ttest_rel(df_sub[mea_col + '_wgh_p'], 
+                                                 df_sub[mea_col + '_wgh_x'])
+    return aux.get_df(results, ['ses_type'])
+
+
 def ppl(corpus_id, df_spk_pairs):
     ''' perplexity of predicting partner's utterances from speaker lm '''
     df_spk_pairs = df_spk_pairs.copy()
@@ -380,20 +466,7 @@ def ppl(corpus_id, df_spk_pairs):
     df_ppl2.set_index('spk_id', append=True, inplace=True)
     df_results_raw = pd.concat([df_ppl, df_ppl2], axis=0)
     # run statistical tests
-    results = {'raw': {}, 'wgh': {}}
-    for ses_type in [0, 'GAME', 'CONV']:
-        if ses_type and ses_type not in set(df_spk_pairs['ses_type']):
-            continue
-        df_sub = df_ppl.xs(ses_type, drop_level=False) if ses_type else df_ppl
-        # filter for sessions, i.e., tsk_id == 0
-        df_sub = df_sub.xs(0, level=2)
-        # exclude rows with missing non-partner values
-        df_sub = df_sub[pd.notna(df_sub['ppl_x'])]
-        results['raw'][ses_type] = aux.ttest_rel(df_sub['ppl_p'], 
-                                                 df_sub['ppl_x'])
-        results['wgh'][ses_type] = aux.ttest_rel(df_sub['ppl_wgh_p'], 
-                                                 df_sub['ppl_wgh_x'])
-    return aux.get_df(results, ['ses_type']), df_results_raw
+    return run_ttests(df_results_raw, 'ppl'), df_results_raw
 
 
 def dist_sim(corpus_id, df_spk_pairs, types_id=None, excl_id=None, 
@@ -437,20 +510,7 @@ def dist_sim(corpus_id, df_spk_pairs, types_id=None, excl_id=None,
     df_dsim2.set_index('spk_id', append=True, inplace=True)
     df_results_raw = pd.concat([df_dsim, df_dsim2], axis=0)
     # run statistical tests
-    results = {'raw': {}, 'wgh': {}}
-    for ses_type in [0, 'GAME', 'CONV']:
-        if ses_type and ses_type not in set(df_spk_pairs['ses_type']):
-            continue
-        df_sub = df_dsim.xs(ses_type, drop_level=False) if ses_type else df_dsim
-        # filter for sessions, i.e., tsk_id == 0
-        df_sub = df_sub.xs(0, level=2)
-        # exclude rows with missing non-partner values
-        df_sub = df_sub[pd.notna(df_sub['dsim_x'])]
-        results['raw'][ses_type] = aux.ttest_rel(df_sub['dsim_p'], 
-                                                 df_sub['dsim_x'])
-        results['wgh'][ses_type] = aux.ttest_rel(df_sub['dsim_wgh_p'], 
-                                                 df_sub['dsim_wgh_x'])
-    return aux.get_df(results, ['ses_type']), df_results_raw
+    return run_ttests(df_results_raw, 'dsim'), df_results_raw
 
 
 def mem_kld(f):
@@ -464,6 +524,7 @@ def mem_kld(f):
         if params not in memo:
             memo[params] = f(*params)
         return memo[params]
+    helper.memo = memo
     return helper
 
 
@@ -476,15 +537,15 @@ def compute_kld(
     
     # shorthand for whether info for second speaker given
     two_given = tsk_ses_id2 and a_or_b2
-    # P: type probabilities for both speakers
+    # P: type probabilities for both speakers (none for empty document)
     P = [
         get_dist(corpus_id, tsk_or_ses, tsk_ses_id1, a_or_b1),
-        get_dist(corpus_id, tsk_or_ses, tsk_ses_id2, a_or_b2) if two_given
-            else collections.defaultdict(float)
+        get_dist(corpus_id, tsk_or_ses, tsk_ses_id2, a_or_b2) 
+            if two_given else {}
     ]
     
     # V: overall vocabulary
-    V = set(P[0].keys()).union(set(P[1].keys()))
+    V = list(set(P[0].keys()).union(set(P[1].keys())))
     # epsilon: prob. for unseen types (lowest prob. in either list / 10)
     # (paper does not specify denominator 10, just says epsilon has to 
     #  be "smaller" than the minima and empirically determined)
@@ -492,20 +553,14 @@ def compute_kld(
         epsilon = min(min(P[0].values()), min(P[1].values())) / 10.0
     else:
         epsilon = min(P[0].values()) / 10.0
-    # apply backoff scheme 
-    for i in [0, 1]:
-        # compute and apply normalization coefficient (beta/gamma in paper)
-        coeff = 1 - (len(V) - len(P[i].keys())) * epsilon
-        for key, val in P[i].items():
-            P[i][key] = coeff * val
-        # set probabilities for unseen types
-        for t in V:
-            if t not in P[i]:
-                P[i][t] = epsilon
-    # actually compute kld
-    kld = 0.0
-    for t in V:
-        kld += (P[0][t]) * math.log(P[0][t] / P[1][t])
+    # apply backoff scheme (normalization coefficient, beta/gamma in paper, 
+    # for seen types, epsilon for unseen types) and compute kld (see jit.py)
+    kld = jit.kld(
+        np.array([P[0].get(t, 0.0) for t in V]),
+        np.array([P[1].get(t, 0.0) for t in V]),
+        np.array([t in P[0] for t in V], dtype=bool),
+        np.array([t in P[1] for t in V], dtype=bool),
+        epsilon)
     
     # normalize by kld with empty document (defaultdict with 0.0 for all keys)
     if two_given:
@@ -553,25 +608,30 @@ def kld(corpus_id, df_spk_pairs):
     df_kld2.set_index('spk_id', append=True, inplace=True)
     df_results_raw = pd.concat([df_kld, df_kld2], axis=0)
     # run statistical tests
-    results = {'raw': {}, 'wgh': {}}
-    for ses_type in [0, 'GAME', 'CONV']:
-        if ses_type and ses_type not in set(df_spk_pairs['ses_type']):
-            continue
-        df_sub = df_kld.xs(ses_type, drop_level=False) if ses_type else df_kld
-        # filter for sessions, i.e., tsk_id == 0
-        df_sub = df_sub.xs(0, level=2)
-        # exclude rows with missing non-partner values
-        df_sub = df_sub[pd.notna(df_sub['kld_x'])]
-        results['raw'][ses_type] = aux.ttest_rel(df_sub['kld_p'], 
-                                                 df_sub['kld_x'])
-        results['wgh'][ses_type] = aux.ttest_rel(df_sub['kld_wgh_p'], 
-                                                 df_sub['kld_wgh_x'])
-    return aux.get_df(results, ['ses_type']), df_results_raw
-
-
-
-
-
+    return run_ttests(df_results_raw, 'kld'), df_results_raw
 
 
+def clear_memos(tsk_or_ses=None, tsk_ses_ids=None):
+    ''' clears memoized results, all or those involving given tasks/sessions
 
+    memoized results are stale once the txt/lm/cnt files of a task/session 
+    were rewritten within the same python session (see inc.py)
+    '''
+    # memoized functions, with positions of tsk_ses_ids in memoization keys
+    funcs = [
+        (get_entropy, [2]),
+        (get_perplexity, [2, 4]),
+        (get_token_count, [2]),
+        (get_dist, [2]),
+        (compare_dists, [2, 4]),
+        (compute_kld, [2, 4])
+    ]
+    for func, positions in funcs:
+        if tsk_ses_ids is None:
+            func.memo.clear()
+            continue
+        tsk_ses_ids = set(tsk_ses_ids)
+        for params in list(func.memo.keys()):
+            if params[1] == tsk_or_ses \
+            and any(params[i] in tsk_ses_ids for i in positions):
+                del func.memo[params]
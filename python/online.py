@@ -0,0 +1,349 @@
+import numpy as np
+import pandas as pd
+
+import ap
+import cfg
+import db
+
+# this module measures local entrainment (lsim, syn, lcon) while a session is
+# still in progress: chunks arrive one at a time as events, turn exchanges are
+# detected and non-adjacent turn-final chunks are drawn as data arrives, and
+# only the sums the measures are based on (see ap.get_lsim_sums and
+# ap.get_corr_sums) are kept per task and speaker; each event updates these
+# sums in constant time and results can be queried at any moment, in the same
+# format as the batch versions in ap
+#
+# turn exchanges are determined as in aux_tables.sql (consecutive chunks by
+# different speakers without overlap, both with all analyzed features, see
+# db.set_complete); non-adjacent chunks of a turn-initial chunk are 
+# turn-final chunks of other exchanges by the same speaker in the same role;
+# online, these can only be drawn from the exchanges seen so far 
+# (turn-initial chunks with fewer than N_X are topped up as further exchanges
+# arrive), so lsim values differ by chance from those of the batch version; 
+# a replay of a stored session (see replay) can use the stored non-adjacent
+# pairs instead, so that final results equal those of ap
+#
+# typical use:
+#     ses = online.Session(ses_id, df_stats=ap.get_feature_stats(cfg.NRM_SPK))
+#     for each new chunk: ses.add_chunk(spk_id, start, end, features, ...)
+#     at any time: ses.lsim(), ses.syn(), ses.lcon()
+
+
+
+# number of non-adjacent chunks drawn per turn-initial chunk (as the minimum
+# number in aux_tables.sql)
+N_X = 10
+# measures for which sums are kept
+MEASURES = [cfg.MEA_LSIM, cfg.MEA_SYN, cfg.MEA_LCON]
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _sample(rng, n, k):
+    ''' returns k distinct random integers in [0, n) 
+
+    floyd's algorithm, with k draws instead of a permutation of all n values
+    (as rng.choice without replacement), so that its cost does not grow with
+    the number of candidates
+    '''
+    drawn = []
+    drawn_set = set()
+    # j-th draw from [0, j] for j = n-k..n-1, all at once
+    for j, t in zip(range(n - k, n), rng.integers(0, np.arange(n - k, n) + 1)):
+        t = j if t in drawn_set else int(t)
+        drawn += [t]
+        drawn_set.add(t)
+    return drawn
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+class Session(object):
+    ''' incremental measurement of local entrainment for one session '''
+
+    def __init__(self, ses_id=0, ses_type='CONV', df_stats=None, x_pairs=None,
+                 n_x=N_X, seed=0):
+        '''
+        args:
+            ses_id, ses_type: session id and type (for keys of results)
+            df_stats: feature means and standard deviations per speaker or
+                gender to normalize features with, as returned by
+                ap.get_feature_stats; features are not normalized if None
+            x_pairs: dict with list of non-adjacent turn-final chunk ids per
+                turn-initial chunk id (for replays, see replay); non-adjacent
+                chunks are drawn online if None
+            n_x: number of non-adjacent chunks drawn per turn-initial chunk
+            seed: random seed for drawing non-adjacent chunks
+        '''
+        self.ses_id = ses_id
+        self.ses_type = ses_type
+        self.df_stats = df_stats
+        self.x_pairs = x_pairs
+        self.n_x = n_x
+        self.rng = np.random.default_rng(seed)
+        # normalization means and standard deviations per speaker or gender
+        self.stats = {}
+        # last chunk (candidate turn-final chunk of the next exchange)
+        self.prev = None
+        self.n_chunks = 0
+        # normalized features per turn-final chunk of any exchange
+        self.vals = {}
+        # turn-final chunk ids per speaker and role (non-adjacent candidates)
+        self.cands = {}
+        # state per exchange, indexed by turn-initial chunk id
+        self.exchanges = {}
+        # turn-initial chunk ids with fewer than n_x non-adjacent chunks per
+        # speaker and role (online) or waiting per turn-final chunk (x_pairs)
+        self.waiting = {}
+        # sums per measure and key (ses_type, ses_id, tsk_id, spk_id), and
+        # shifts of the values for numerically stable sums (see ap)
+        self.sums = {m: {} for m in MEASURES}
+        self.shifts = {}
+
+    def _normalize(self, vals, spk_id, gender):
+        ''' returns normalized values of cfg.FEATURES '''
+        if self.df_stats is None:
+            return vals
+        key = spk_id if self.df_stats.index.name == 'spk_id' else gender
+        if key not in self.stats:
+            if key in self.df_stats.index:
+                row = self.df_stats.loc[key]
+                self.stats[key] = (
+                    row[[f + '_mean' for f in cfg.FEATURES]].values.astype(
+                        float),
+                    row[[f + '_std' for f in cfg.FEATURES]].values.astype(
+                        float))
+            else:
+                # unknown speaker or gender, all features missing
+                self.stats[key] = (np.full(len(cfg.FEATURES), np.nan),) * 2
+        means, stds = self.stats[key]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (vals - means) / stds
+
+    def _add_sums(self, mea_id, key, sums):
+        ''' adds given sums (or subtracts negated ones) for given key '''
+        if key in self.sums[mea_id]:
+            self.sums[mea_id][key] += sums
+        else:
+            self.sums[mea_id][key] = sums.copy()
+
+    def _add_x(self, chu_id, chu_id_x):
+        ''' adds non-adjacent turn-final chunk to exchange of given chunk '''
+        exc = self.exchanges[chu_id]
+        sims = -abs(exc['vals'] - self.vals[chu_id_x])
+        valid = ~np.isnan(sims)
+        # replace contribution of this exchange to lsim sums
+        self._add_sums(cfg.MEA_LSIM, exc['key'], -exc['sums'])
+        exc['x_sum'] += np.where(valid, sims, 0.0)
+        exc['x_cnt'] += valid
+        exc['n_x'] += 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sims_x = exc['x_sum'] / exc['x_cnt']
+        exc['sums'] = ap.get_lsim_sums(exc['sims_p'][None], sims_x[None])[0]
+        self._add_sums(cfg.MEA_LSIM, exc['key'], exc['sums'])
+
+    def _add_exchange(self, prev, cur):
+        ''' adds turn exchange between given turn-final and -initial chunk '''
+        key = (self.ses_type, self.ses_id, cur['tsk_id'], cur['spk_id'])
+        sims_p = -abs(cur['vals'] - prev['vals'])
+        n_feat = len(cfg.FEATURES)
+        exc = {'key': key, 'vals': cur['vals'], 'sims_p': sims_p,
+               'x_sum': np.zeros(n_feat), 'x_cnt': np.zeros(n_feat),
+               'n_x': 0}
+        # without non-adjacent chunks, lsim is undefined (t-test is nan)
+        exc['sums'] = ap.get_lsim_sums(
+            sims_p[None], np.full((1, n_feat), np.nan))[0]
+        self.exchanges[cur['chu_id']] = exc
+        self._add_sums(cfg.MEA_LSIM, key, exc['sums'])
+        # sums for synchrony and convergence never change, shifted by values
+        # of the first exchange
+        times = np.full(n_feat, cur['start_time'])
+        if len(self.shifts) == 0:
+            self.shifts = {
+                cfg.MEA_SYN: (np.nan_to_num(cur['vals']),
+                              np.nan_to_num(prev['vals'])),
+                cfg.MEA_LCON: (np.nan_to_num(sims_p), times)}
+        self._add_sums(cfg.MEA_SYN, key, ap.get_corr_sums(
+            cur['vals'][None], prev['vals'][None],
+            *self.shifts[cfg.MEA_SYN])[0])
+        self._add_sums(cfg.MEA_LCON, key, ap.get_corr_sums(
+            sims_p[None], times[None], *self.shifts[cfg.MEA_LCON])[0])
+        # non-adjacent chunks: turn-final chunks of other exchanges by the
+        # same speaker in the same role
+        cands_key = (prev['spk_id'], prev['role'])
+        cands = self.cands.setdefault(cands_key, [])
+        if self.x_pairs is None:
+            # top up earlier exchanges that have too few non-adjacent chunks,
+            # draw those of this exchange from all earlier ones
+            self.vals[prev['chu_id']] = prev['vals']
+            waiting = self.waiting.setdefault(cands_key, [])
+            for chu_id in waiting:
+                self._add_x(chu_id, prev['chu_id'])
+            waiting[:] = [chu_id for chu_id in waiting
+                          if self.exchanges[chu_id]['n_x'] < self.n_x]
+            for i in _sample(self.rng, len(cands), min(self.n_x, len(cands))):
+                self._add_x(cur['chu_id'], cands[i])
+            if exc['n_x'] < self.n_x:
+                waiting += [cur['chu_id']]
+        else:
+            # given non-adjacent chunks, those not seen yet are added later
+            for chu_id_x in self.x_pairs.get(cur['chu_id'], []):
+                if chu_id_x in self.vals:
+                    self._add_x(cur['chu_id'], chu_id_x)
+                else:
+                    self.waiting.setdefault(chu_id_x, []).append(
+                        cur['chu_id'])
+            self.vals[prev['chu_id']] = prev['vals']
+            for chu_id in self.waiting.pop(prev['chu_id'], []):
+                self._add_x(chu_id, prev['chu_id'])
+        cands += [prev['chu_id']]
+
+    def _get_sums(self, mea_id):
+        ''' returns keys (as dataframe) and sums of given measure '''
+        df_keys = pd.DataFrame(
+            list(self.sums[mea_id].keys()),
+            columns=['ses_type', 'ses_id', 'tsk_id', 'spk_id'])
+        return df_keys, np.vstack(list(self.sums[mea_id].values()))
+
+    def add_chunk(self, spk_id, start_time, end_time, features, tsk_id=0,
+                  role=None, gender=None, chu_id=None):
+        ''' adds the next chunk of the session (in chronological order)
+
+        args:
+            spk_id: speaker of the chunk
+            start_time, end_time: start and end time of the chunk
+            features: raw feature values in the order of cfg.FEATURES_ALL
+                (nan or None if missing)
+            tsk_id: task the chunk belongs to (for results per task)
+            role: speaker role (non-adjacent chunks are drawn from turn-final
+                chunks of the same speaker in the same role)
+            gender: speaker's gender (needed to normalize per gender)
+            chu_id: chunk id (needed for given non-adjacent pairs), running
+                number if None
+        returns:
+            True if the chunk is the turn-initial chunk of a turn exchange
+        '''
+        self.n_chunks += 1
+        raw = np.array(features, dtype=float)
+        assert len(raw) == len(cfg.FEATURES_ALL), 'one value per feature needed'
+        vals = raw[[cfg.FEATURES_ALL.index(f) for f in cfg.FEATURES]]
+        cur = {
+            'chu_id': self.n_chunks if chu_id is None else chu_id,
+            'spk_id': spk_id, 'start_time': start_time, 'end_time': end_time,
+            'tsk_id': tsk_id, 'role': role, 'has_all': not np.isnan(vals).any(),
+            'vals': self._normalize(vals, spk_id, gender)}
+        prev = self.prev
+        self.prev = cur
+        # change in speaker without overlap, both with all analyzed features
+        if prev is None or prev['spk_id'] == spk_id \
+        or prev['end_time'] > start_time \
+        or not (prev['has_all'] and cur['has_all']):
+            return False
+        self._add_exchange(prev, cur)
+        return True
+
+    def lsim(self, grp_by=cfg.GRP_BYS):
+        ''' returns local similarity so far, see ap.lsim (no permutations) '''
+        cfg.check_grp_by(grp_by)
+        if len(self.exchanges) == 0:
+            return pd.DataFrame(columns=cfg.FEATURES)
+        return ap.lsim_from_sums(*self._get_sums(cfg.MEA_LSIM), grp_by)
+
+    def syn(self, grp_by=[g for g in cfg.GRP_BYS if g != cfg.GRP_BY_SES_TYPE]):
+        ''' returns synchrony so far, see ap.syn '''
+        supported = [g for g in cfg.GRP_BYS if g != cfg.GRP_BY_SES_TYPE]
+        cfg.check_grp_by(grp_by, supported)
+        if len(self.exchanges) == 0:
+            return pd.DataFrame(columns=cfg.FEATURES)
+        return ap.corr_from_sums(*self._get_sums(cfg.MEA_SYN), grp_by)
+
+    def lcon(self, grp_by=[cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK]):
+        ''' returns local convergence so far, see ap.lcon '''
+        cfg.check_grp_by(grp_by, supported=[cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK])
+        if len(self.exchanges) == 0:
+            return pd.DataFrame(columns=cfg.FEATURES)
+        return ap.corr_from_sums(*self._get_sums(cfg.MEA_LCON), grp_by)
+
+
+def replay(ses_id, nrm_type=cfg.NRM_SPK, stored_pairs=True, callback=None,
+           **kwargs):
+    ''' feeds a stored session chunk by chunk through a Session, for testing
+
+    with the stored non-adjacent pairs, the final results equal those of
+    ap.lsim, ap.syn, and ap.lcon for this session (with the data loaded by
+    ap.load_data(nrm_type, stored_stats=True))
+
+    args:
+        ses_id: session to replay
+        nrm_type: how to normalize features (see cfg.NRM_TYPES; statistics
+            from ap.get_feature_stats, see ap.store_feature_stats)
+        stored_pairs: whether to use the non-adjacent pairs in table
+            chunk_pairs (see aux_tables.sql) or draw them online
+        callback: function called with the Session after each chunk (e.g.,
+            to query intermediate results)
+        kwargs: further arguments for Session (n_x, seed)
+    returns:
+        Session with all chunks of the given session added
+    '''
+    assert nrm_type in cfg.NRM_TYPES, 'unknown normalization type'
+    df_chu = db.pd_read_sql_query(
+        'SELECT chu.chu_id,\n'
+        '       tsk.tsk_id,\n'
+        '       ses.type ses_type,\n'
+        '       CASE\n'
+        '           WHEN tur.speaker_a_or_b == "A"\n'
+        '           THEN ses.spk_id_a\n'
+        '           ELSE ses.spk_id_b\n'
+        '       END spk_id,\n'
+        '       spk.gender,\n'
+        '       tur.speaker_role,\n'
+        '       chu.start_time,\n'
+        '       chu.end_time,\n'
+        '       %s\n'
+        'FROM   chunks chu\n'
+        'JOIN   turns tur\n'
+        'ON     chu.tur_id == tur.tur_id\n'
+        'JOIN   tasks tsk\n'
+        'ON     tur.tsk_id == tsk.tsk_id\n'
+        'JOIN   sessions ses\n'
+        'ON     tsk.ses_id == ses.ses_id\n'
+        'JOIN   speakers spk\n'
+        'ON     spk.spk_id == CASE\n'
+        '                         WHEN tur.speaker_a_or_b == "A"\n'
+        '                         THEN ses.spk_id_a\n'
+        '                         ELSE ses.spk_id_b\n'
+        '                     END\n'
+        'LEFT JOIN chunk_features chf\n'
+        'ON     chu.chu_id == chf.chu_id\n'
+        'AND    chf.complete\n'
+        'WHERE  ses.ses_id == %d\n'
+        'ORDER BY tsk.task_index, tur.turn_index, chu.chunk_index;'
+        % (',\n       '.join('chf.' + f for f in cfg.FEATURES_ALL), ses_id))
+    assert len(df_chu) > 0, 'session not found'
+    x_pairs = None
+    if stored_pairs:
+        df_x = db.pd_read_sql_query(
+            'SELECT chu_id1, chu_id2\n'
+            'FROM   chunk_pairs\n'
+            'WHERE  p_or_x == "x"\n'
+            'AND    chu_id2 IN (%s);'
+            % ', '.join(str(c) for c in df_chu['chu_id']))
+        x_pairs = df_x.groupby('chu_id2')['chu_id1'].apply(list).to_dict()
+    df_stats = None if nrm_type == cfg.NRM_RAW \
+        else ap.get_feature_stats(nrm_type)
+    ses = Session(ses_id, df_chu['ses_type'].iloc[0], df_stats, x_pairs,
+                  **kwargs)
+    feats = df_chu[cfg.FEATURES_ALL].values.astype(float)
+    for i, row in enumerate(df_chu.itertuples(index=False)):
+        ses.add_chunk(row.spk_id, row.start_time, row.end_time, feats[i],
+                      row.tsk_id, row.speaker_role, row.gender, row.chu_id)
+        if callback is not None:
+            callback(ses)
+    return ses
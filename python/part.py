@@ -0,0 +1,137 @@
+import pandas as pd
+
+import ap
+import cfg
+import spk
+
+# this module computes the acoustic-prosodic measures out of core, one
+# partition of sessions at a time, so that memory stays bounded by the size of
+# a partition (see ap.iter_data) instead of growing with the corpus (as with
+# ap.load_data, which holds the data of all sessions, with a row per chunk
+# pair, at once)
+#
+# execution has three parts:
+# - feature statistics per speaker (or gender) of all sessions are merged
+#   from raw feature moments, computed in one streaming pass over the
+#   database (see ap.store_feature_stats and ap.get_feature_stats)
+# - the data of each partition are streamed from the database and normalized
+#   with these statistics (see ap.iter_data), and each measure computes only
+#   small intermediate results from them: sums per task and speaker for the
+#   local measures (see ap.get_local_sums), distances per speaker for gcon
+#   (see ap.get_gcon_dists), and feature sums per task and speaker for gsim
+#   (see ap.get_gsim_sums; non-partners are compared across sessions, but
+#   only through these per-speaker values)
+# - the intermediate results of all partitions are merged and the measures
+#   are computed from them, for all grouping levels
+#
+# partitions consist of whole sessions, since all intermediate results only
+# depend on the data of one session; several sessions per partition save the
+# (pandas) overhead per partition, which dominates for single sessions
+#
+# results are the same as those of ap.lsim, ap.syn, ap.lcon, ap.gcon, and
+# ap.gsim on ap.load_data(nrm_type, stored_stats=True) (local measures up to
+# floating point error, as their sums are not shifted), without permutation
+# tests (gsim permutation tests can be run on the merged sums, see
+# ap.gsim_from_sums)
+#
+# typical use (with an open database connection):
+#     results = part.run(cfg.NRM_SPK)
+#     df_lsim = results[cfg.MEA_LSIM]; df_gcon, df_gcon_raw = results['gcon']
+
+
+
+# measures computed per partition, and grouping levels of the local measures
+# (defaults of ap.lsim, ap.syn, ap.lcon)
+MEASURES = [cfg.MEA_LSIM, cfg.MEA_SYN, cfg.MEA_LCON, cfg.MEA_GCON, cfg.MEA_GSIM]
+GRP_BYS = {
+    cfg.MEA_LSIM: cfg.GRP_BYS,
+    cfg.MEA_SYN: [g for g in cfg.GRP_BYS if g != cfg.GRP_BY_SES_TYPE],
+    cfg.MEA_LCON: [cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK]
+}
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _measure_partition(df_bt, measures):
+    ''' computes intermediate results of given measures for one partition
+
+    returns:
+        dict with intermediate results per measure (see module comment)
+    '''
+    res = {}
+    if any(mea_id in GRP_BYS for mea_id in measures):
+        sums = ap.get_local_sums(df_bt)
+        res = {mea_id: sums[mea_id] for mea_id in measures if mea_id in sums}
+    if cfg.MEA_GCON in measures:
+        res[cfg.MEA_GCON] = ap.get_gcon_dists(df_bt)
+    if cfg.MEA_GSIM in measures:
+        res[cfg.MEA_GSIM] = ap.get_gsim_sums(df_bt)
+    return res
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def run(nrm_type=cfg.NRM_SPK, measures=MEASURES, update_stats=True,
+        df_spk_pairs=None, min_chunks=cfg.BATCH_SIZE):
+    ''' computes given measures partition by partition (see module comment)
+
+    args:
+        nrm_type: how to normalize features (see cfg.NRM_TYPES)
+        measures: measures to compute (see MEASURES)
+        update_stats: whether to (re)compute the raw feature moments first
+            (see ap.store_feature_stats); the stored moments are used if False
+        df_spk_pairs: speaker pairs for gsim, as returned by spk.get_spk_pairs
+            (determined if None)
+        min_chunks: minimum number of chunks per partition (see ap.iter_data)
+    returns:
+        dict with results per measure, as returned by the measure's function
+        in ap (dataframe for lsim, syn, and lcon, with results for all
+        grouping levels in GRP_BYS; tuple of results and raw results for gcon
+        and gsim)
+    '''
+    assert nrm_type in cfg.NRM_TYPES, 'unknown normalization type'
+    for mea_id in measures:
+        assert mea_id in MEASURES, 'unsupported measure'
+    df_stats = None
+    if nrm_type != cfg.NRM_RAW:
+        if update_stats:
+            ap.store_feature_stats()
+        df_stats = ap.get_feature_stats(nrm_type)
+    # intermediate results per measure and partition, session types seen
+    parts = {mea_id: [] for mea_id in measures}
+    ses_types = set()
+    n_ses = 0
+    for ses_ids, df_bt in ap.iter_data(
+            nrm_type, df_stats=df_stats, min_chunks=min_chunks):
+        ses_types |= set(df_bt['ses_type'])
+        for mea_id, res in _measure_partition(df_bt, measures).items():
+            parts[mea_id] += [res]
+        n_ses += len(ses_ids)
+    print('measured %d sessions in %d partitions' % (
+        n_ses, len(parts[measures[0]])))
+    results = {}
+    for mea_id in measures:
+        if mea_id in GRP_BYS:
+            df = pd.concat(parts[mea_id])
+            from_sums = ap.lsim_from_sums if mea_id == cfg.MEA_LSIM \
+                else ap.corr_from_sums
+            results[mea_id] = from_sums(
+                df.index.to_frame(index=False), df.values, GRP_BYS[mea_id])
+        elif mea_id == cfg.MEA_GCON:
+            df_results_raw = pd.concat(parts[mea_id])
+            results[mea_id] = (
+                ap.gcon_from_dists(df_results_raw, ses_types), df_results_raw)
+        else:
+            if df_spk_pairs is None:
+                df_spk_pairs = spk.get_spk_pairs()
+            results[mea_id] = ap.gsim_from_sums(
+                pd.concat([s for s, _ in parts[mea_id]]),
+                pd.concat([c for _, c in parts[mea_id]]), df_spk_pairs)
+    return results
@@ -0,0 +1,368 @@
+import functools
+import importlib
+import inspect
+import json
+import os
+import pandas as pd
+import resource
+import subprocess
+import threading
+import time
+
+# this module implements opt-in instrumentation of the processing code: while
+# enabled, all public functions of the given modules, external processes
+# (sox, praat, ngram, ngram-count), sql statements, and pandas apply/join/merge
+# calls are timed, and hits/misses of the memoized functions (lex.mem_*) are
+# counted; every call can be written to a trace file (json lines or chrome
+# trace format, the latter can be opened in chrome://tracing or perfetto)
+#
+# usage:
+#     prof.enable('trace.jsonl')
+#     ... (run analysis as usual)
+#     df_summary, df_memo = prof.disable()
+#     df_summary = prof.summarize('trace.jsonl')  (later, from the file)
+#
+# times are inclusive ("total") and exclusive ("self", excluding instrumented
+# calls made from within); cpu time is that of the calling thread, for
+# external processes that of the (waited for) child processes
+
+
+
+# modules whose public functions are instrumented by default
+MODULES = ['ap', 'lex', 'fio', 'db', 'ana']
+# functions of the subprocess module that are instrumented
+SUBPROCESS_FUNCS = ['run', 'call', 'check_call', 'check_output']
+# pandas methods that are instrumented
+PANDAS_METHODS = [
+    (pd.DataFrame, 'apply'),
+    (pd.Series, 'apply'),
+    (pd.DataFrame, 'join'),
+    (pd.DataFrame, 'merge')
+]
+# trace file formats
+FMT_JSONL = 'jsonl'
+FMT_CHROME = 'chrome'
+
+# state while enabled: start time, trace file, aggregated stats, and original
+# functions/methods (to restore them when disabled)
+_t0 = None
+_trace_file = None
+_fmt = None
+_min_dur = 0.0
+_stats = {}
+_memo_stats = {}
+_originals = []
+_lock = threading.Lock()
+# stack of running instrumented calls per thread (for exclusive times)
+_local = threading.local()
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _write(event):
+    ''' writes given event to the trace file in the configured format '''
+    if _fmt == FMT_CHROME:
+        line = json.dumps(event) + ',\n'
+    else:
+        line = json.dumps(event) + '\n'
+    _trace_file.write(line)
+
+
+def _record(cat, name, start, dur, self_dur, cpu):
+    ''' adds given call to the aggregated stats and the trace file '''
+    with _lock:
+        stats = _stats.setdefault((cat, name), [0, 0.0, 0.0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += dur
+        stats[2] += self_dur
+        stats[3] += cpu
+        stats[4] = max(stats[4], dur)
+        if _trace_file is None or dur < _min_dur:
+            return
+        if _fmt == FMT_CHROME:
+            # complete event, times in microseconds
+            _write({
+                'name': name, 'cat': cat, 'ph': 'X',
+                'ts': (start - _t0) * 1e6, 'dur': dur * 1e6,
+                'pid': os.getpid(), 'tid': threading.get_ident(),
+                'args': {'self': self_dur * 1e6, 'cpu': cpu * 1e6}})
+        else:
+            _write({
+                'cat': cat, 'name': name, 'ts': start - _t0, 'dur': dur,
+                'self': self_dur, 'cpu': cpu, 'pid': os.getpid(),
+                'tid': threading.get_ident()})
+
+
+def _call(cat, name, func, args, kwargs, child_cpu=False):
+    ''' runs given function as one instrumented call, returns its result '''
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    # frame: accumulated duration of instrumented calls made from within
+    frame = [0.0]
+    _local.stack.append(frame)
+    if child_cpu:
+        ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu = ru.ru_utime + ru.ru_stime
+    else:
+        cpu = time.thread_time()
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        dur = time.perf_counter() - start
+        if child_cpu:
+            ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+            cpu = ru.ru_utime + ru.ru_stime - cpu
+        else:
+            cpu = time.thread_time() - cpu
+        _local.stack.pop()
+        if len(_local.stack) > 0:
+            _local.stack[-1][0] += dur
+        _record(cat, name, start, dur, dur - frame[0], cpu)
+
+
+def _iterate(cat, name, gen):
+    ''' yields from given generator, all steps recorded as one call '''
+    start = time.perf_counter()
+    totals = [0.0, 0.0, 0.0]
+    try:
+        while True:
+            frame = [0.0]
+            _local.stack = getattr(_local, 'stack', [])
+            _local.stack.append(frame)
+            cpu = time.thread_time()
+            step = time.perf_counter()
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+            finally:
+                dur = time.perf_counter() - step
+                _local.stack.pop()
+                if len(_local.stack) > 0:
+                    _local.stack[-1][0] += dur
+                totals[0] += dur
+                totals[1] += dur - frame[0]
+                totals[2] += time.thread_time() - cpu
+            yield item
+    finally:
+        gen.close()
+        _record(cat, name, start, totals[0], totals[1], totals[2])
+
+
+def _instrument(cat, name, func, child_cpu=False):
+    ''' returns instrumented version of given function '''
+    memo = getattr(func, 'memo', None)
+    is_gen = inspect.isgeneratorfunction(func)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if is_gen:
+            return _iterate(cat, name, func(*args, **kwargs))
+        if memo is None:
+            return _call(cat, name, func, args, kwargs, child_cpu)
+        # memoized function (lex.mem_*): miss iff the memo grew
+        size = len(memo)
+        res = _call(cat, name, func, args, kwargs, child_cpu)
+        with _lock:
+            memo_stats = _memo_stats.setdefault(name, [0, 0])
+            memo_stats[0 if len(memo) == size else 1] += 1
+        return res
+    return wrapper
+
+
+def _patch(obj, attr, wrapper):
+    ''' replaces given attribute, remembering the original '''
+    _originals.append((obj, attr, getattr(obj, attr)))
+    setattr(obj, attr, wrapper)
+
+
+def _sql_name(sql_stmt):
+    ''' returns short name for given sql statement (first 60 characters) '''
+    return ' '.join(str(sql_stmt).split())[:60]
+
+
+def _patch_sql(db):
+    ''' instruments sql statements executed through db.py '''
+    def __method(method):
+        @functools.wraps(method)
+        def wrapper(self, sql_stmt, *args, **kwargs):
+            return _call('sql', _sql_name(sql_stmt), method,
+                         (self, sql_stmt) + args, kwargs)
+        return wrapper
+    for attr in ['execute', 'executemany', 'executescript']:
+        method = getattr(db.DatabaseConnection, attr)
+        _patch(db.DatabaseConnection, attr, __method(method))
+    # streamed queries (all steps of one query are recorded as one call)
+    fetch_batches = db._fetch_batches
+    @functools.wraps(fetch_batches)
+    def wrapper(sql_stmt, *args, **kwargs):
+        return _iterate('sql', _sql_name(sql_stmt),
+                        fetch_batches(sql_stmt, *args, **kwargs))
+    _patch(db, '_fetch_batches', wrapper)
+
+
+def _patch_subprocess():
+    ''' instruments external processes started through the subprocess module '''
+    def __func(func):
+        @functools.wraps(func)
+        def wrapper(cmd, *args, **kwargs):
+            name = os.path.basename(cmd[0] if isinstance(cmd, list) else cmd)
+            return _call('subprocess', name, func, (cmd,) + args, kwargs,
+                         child_cpu=True)
+        return wrapper
+    for attr in SUBPROCESS_FUNCS:
+        _patch(subprocess, attr, __func(getattr(subprocess, attr)))
+
+
+def _to_df(stats):
+    ''' converts aggregated stats to a summary dataframe '''
+    df = pd.DataFrame(
+        [k + tuple(v) for k, v in stats.items()],
+        columns=['cat', 'name', 'calls', 'total', 'self', 'cpu', 'max'])
+    df['mean'] = df['total'] / df['calls']
+    df.set_index(['cat', 'name'], inplace=True)
+    return df.sort_values('self', ascending=False)
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def enable(fname=None, fmt=FMT_JSONL, modules=MODULES, sql=True,
+           subprocesses=True, pandas=True, min_dur=0.0):
+    ''' enables instrumentation until disable is called
+
+    args:
+        fname: trace file to write (overwritten), only aggregated stats are
+            kept if None
+        fmt: trace file format, FMT_JSONL or FMT_CHROME
+        modules: names of modules whose public functions are instrumented
+        sql: whether to time sql statements executed through db.py
+        subprocesses: whether to time external processes
+        pandas: whether to time pandas apply/join/merge calls
+        min_dur: calls shorter than this (in seconds) are only aggregated,
+            not written to the trace file (keeps the file small)
+    '''
+    global _t0, _trace_file, _fmt, _min_dur, _stats, _memo_stats
+    assert _t0 is None, 'instrumentation already enabled'
+    assert fmt in [FMT_JSONL, FMT_CHROME], 'unknown trace file format'
+    _t0 = time.perf_counter()
+    _fmt = fmt
+    _min_dur = min_dur
+    _stats = {}
+    _memo_stats = {}
+    if fname is not None:
+        _trace_file = open(fname, 'w')
+        if fmt == FMT_CHROME:
+            _trace_file.write('[\n')
+    for mod_name in modules:
+        mod = importlib.import_module(mod_name)
+        for name, func in list(vars(mod).items()):
+            if name.startswith('_') or not inspect.isfunction(func) \
+            or func.__module__ != mod_name:
+                continue
+            _patch(mod, name, _instrument('func', mod_name + '.' + name, func))
+    if sql:
+        _patch_sql(importlib.import_module('db'))
+    if subprocesses:
+        _patch_subprocess()
+    if pandas:
+        for cls, attr in PANDAS_METHODS:
+            name = 'pandas.%s.%s' % (cls.__name__, attr)
+            _patch(cls, attr, _instrument('pandas', name, getattr(cls, attr)))
+
+
+def disable():
+    ''' disables instrumentation, restores all functions, closes trace file
+
+    returns:
+        tuple of dataframes as returned by get_summary and get_memo_summary
+    '''
+    global _t0, _trace_file
+    assert _t0 is not None, 'instrumentation not enabled'
+    while len(_originals) > 0:
+        obj, attr, orig = _originals.pop()
+        setattr(obj, attr, orig)
+    if _trace_file is not None:
+        # memo hits and misses once at the end
+        for name, (hits, misses) in _memo_stats.items():
+            if _fmt == FMT_CHROME:
+                _write({'name': name, 'cat': 'memo', 'ph': 'C',
+                        'ts': (time.perf_counter() - _t0) * 1e6,
+                        'pid': os.getpid(),
+                        'args': {'hits': hits, 'misses': misses}})
+            else:
+                _write({'cat': 'memo', 'name': name, 'hits': hits,
+                        'misses': misses})
+        if _fmt == FMT_CHROME:
+            _trace_file.write('{}]\n')
+        _trace_file.close()
+        _trace_file = None
+    _t0 = None
+    return get_summary(), get_memo_summary()
+
+
+def get_summary():
+    ''' returns aggregated stats of the current/last instrumented run
+
+    returns:
+        pandas dataframe indexed by category ("func", "sql", "subprocess",
+        "pandas") and name, with number of calls, total (inclusive), self
+        (exclusive), cpu, maximum, and mean time in seconds, sorted by self
+    '''
+    with _lock:
+        return _to_df(_stats)
+
+
+def get_memo_summary():
+    ''' returns memo hits, misses, and hit rate per memoized function '''
+    with _lock:
+        df = pd.DataFrame(
+            [(k,) + tuple(v) for k, v in _memo_stats.items()],
+            columns=['name', 'hits', 'misses'])
+    df['hit_rate'] = df['hits'] / (df['hits'] + df['misses'])
+    return df.set_index('name')
+
+
+def summarize(fname):
+    ''' summarizes given trace file (either format), see get_summary
+
+    only calls written to the file are included (see min_dur in enable)
+
+    returns:
+        tuple of dataframes as returned by get_summary and get_memo_summary
+    '''
+    stats = {}
+    memo_stats = {}
+    with open(fname) as trace_file:
+        content = trace_file.read()
+    if content.startswith('['):
+        events = [e for e in json.loads(content) if len(e) > 0]
+        scale = 1e-6
+    else:
+        events = [json.loads(line) for line in content.splitlines()]
+        scale = 1.0
+    for e in events:
+        if e['cat'] == 'memo':
+            hits = e['args']['hits'] if 'args' in e else e['hits']
+            misses = e['args']['misses'] if 'args' in e else e['misses']
+            memo_stats[e['name']] = [hits, misses]
+            continue
+        self_dur = e['args']['self'] if 'args' in e else e['self']
+        cpu = e['args']['cpu'] if 'args' in e else e['cpu']
+        s = stats.setdefault((e['cat'], e['name']), [0, 0.0, 0.0, 0.0, 0.0])
+        s[0] += 1
+        s[1] += e['dur'] * scale
+        s[2] += self_dur * scale
+        s[3] += cpu * scale
+        s[4] = max(s[4], e['dur'] * scale)
+    df_memo = pd.DataFrame(
+        [(k,) + tuple(v) for k, v in memo_stats.items()],
+        columns=['name', 'hits', 'misses'])
+    df_memo['hit_rate'] = df_memo['hits'] / (df_memo['hits']+df_memo['misses'])
+    return _to_df(stats), df_memo.set_index('name')
@@ -4,6 +4,7 @@ import aux
 import cfg
 import db
 import fio
+import jit
 
 
 
@@ -81,8 +82,8 @@ def populate_turns_and_chunks():
 
     turn indices in transcripts are insufficient '''
 
-    # global ids for turns and chunks (one tur_id per speaker, see below)
-    tur_ids = [0, 0]
+    # global ids for turns and chunks (last ones assigned)
+    tur_id = 0
     chu_id = 0
 
     for ses_cnt, ses_id in enumerate(db.get_ses_ids()):
@@ -90,61 +91,63 @@ def populate_turns_and_chunks():
         intervalsA = _get_intervals(ses_id, 'A')
         intervalsB = _get_intervals(ses_id, 'B')
         intervals = sorted(intervalsA + intervalsB, key=lambda x: x[2])
-
-        # end of last chunk, turn index, and chunk index markers per speaker
-        ends = [0.0, 0.0]
-        tur_cnts = [0, 0] 
-        chu_cnts = [0, 0]
-
-        # iterate intervals, create a chunk for each entry and turns as needed 
-        for _, a_or_b, start, end, words in intervals:
-            tsk_id = ses_id
-            role = db.get_role(ses_id, a_or_b)
-            idx = 0 if a_or_b == 'A' else 1
-            
-            # check whether this is a new turn
-            if ends[1-idx] > ends[idx] \
-            or tur_cnts[1-idx] > tur_cnts[idx] \
-            or tur_cnts[idx] == 0:
-                # new turn, update index and count
-                tur_cnts[idx] = max(tur_cnts) + 1
-                tur_ids[idx] = max(tur_ids) + 1
-                chu_cnts[idx] = 1
-            else:
-                # continuation of old turn
-                chu_cnts[idx] += 1
-            ends[idx] = end
-
-            if chu_cnts[idx] == 1:
-                # first chunk in turn; insert turn first
-                db.ins_tur(
-                    tur_ids[idx], tsk_id, tur_cnts[idx], tur_cnts[idx], role)
+        tsk_id = ses_id
+        roles = {a_or_b: db.get_role(ses_id, a_or_b) for a_or_b in ['A', 'B']}
+
+        # assign each interval to a turn, new turns as needed (see jit.turns)
+        new_turn, tur_ids, tur_idx, chu_idx = jit.turns(
+            [0 if i[1] == 'A' else 1 for i in intervals],
+            [i[3] for i in intervals], tur_id)
+
+        # create a chunk for each entry, preceded by its turn if new
+        for i, (_, a_or_b, start, end, words) in enumerate(intervals):
+            if new_turn[i]:
+                db.ins_tur(int(tur_ids[i]), tsk_id, int(tur_idx[i]), 
+                           int(tur_idx[i]), roles[a_or_b], a_or_b)
             chu_id += 1
-            db.ins_chu(chu_id, tur_ids[idx], chu_cnts[idx], 
+            db.ins_chu(chu_id, int(tur_ids[i]), int(chu_idx[i]), 
                        start, end, end-start, words)
+        tur_id += int(new_turn.sum())
         db.commit()
         if (ses_cnt + 1) % 100 == 0:
             print('%d sessions done' % (ses_cnt+1))
 
 
-def extract_features(ses_id):
-    ''' runs feature extraction for all chunks in given session, updates db '''
+def extract_features(ses_id, features=cfg.FEATURES_ALL, missing_only=False):
+    ''' runs feature extraction for all chunks in given session, updates db 
+
+    only the given features are extracted and set (e.g., cfg.FEATURES first,
+    the others in a later pass); chunks are analyzed once they have all 
+    analyzed features (cfg.FEATURES, see db.set_complete)
+
+    args:
+        ses_id: session to process
+        features: features to extract (see cfg.FEATURES_ALL)
+        missing_only: whether to extract only those of the given features
+            that are missing (null) per chunk, skipping complete chunks
+    '''
     db.connect(cfg.CORPUS_ID_SB)
     path = cfg.get_corpus_path(cfg.CORPUS_ID_SB)
     for a_or_b in ['A', 'B']:
         fname = 'sw%05d.%s.wav' % (ses_id, a_or_b)
         all_features = {}
-        for chu_id, words, start, end in db.find_chunks(ses_id, a_or_b):
+        # chunks are fetched entirely (one session and speaker) before praat
+        # runs, so the read lock is not held while other processes write
+        if missing_only:
+            chunks = list(db.find_missing_features(ses_id, a_or_b, features))
+        else:
+            chunks = [c + (features,) for c in db.find_chunks(ses_id, a_or_b)]
+        for chu_id, words, start, end, chu_features in chunks:
             if end - start >= 0.04: # min duration for 75Hz min pitch
                 all_features[chu_id] = fio.extract_features(
-                    path, fname, ses_id, chu_id, words, start, end)
+                    path, fname, ses_id, chu_id, words, start, end, 
+                    chu_features)
         # function is invoked in parallel, database might be locked;
         # keep trying to update until it works
         done = False
         while not done:
             try:
-                for chu_id, features in all_features.items():
-                    db.set_features(chu_id, features)
+                db.set_features(all_features)
                 db.commit()
                 done = True
             except sqlite3.OperationalError:
@@ -0,0 +1,423 @@
+import concurrent.futures
+import numpy as np
+import os
+import pandas as pd
+import re
+import shutil
+
+import ap
+import cfg
+import db
+import fio
+import lex
+import sb
+
+# this module runs the per-session processing stages on shards of a corpus:
+# the corpus is split by ranges of session ids into shard databases (each with
+# token and lm directory), every shard is processed independently (in a local
+# process here, but each shard directory is self-contained, so shards can just
+# as well be processed on other machines, see prepare_shard and
+# measure_shard), and the outputs of all shards are merged
+#
+# every shard keeps the global speaker, topic, and session tables (the
+# metadata needed for non-partner baselines), but only the tasks, turns, and
+# chunks of its own sessions; what needs all sessions is merged between two
+# phases: the vocabulary (lms of all shards are based on the same one) and the
+# raw feature moments (features are normalized per speaker across shards, see
+# ap.store_feature_stats)
+#
+# the local measures are merged from their sums per task and speaker (see
+# ap.lsim_from_sums, ap.corr_from_sums), so results (for all grouping levels,
+# including those across sessions) are the same as for the unsharded corpus;
+# global and lexical measures compare speakers across sessions and are
+# computed on the main database, into which merge_shards copies the shards'
+# features, chunk pairs, feature moments, tokens, and lms
+#
+# typical order of calls (with an open connection to the main database):
+#     df_ranges = shard.split(corpus_id, path, n_shards)
+#     results = shard.run(corpus_id, path, len(df_ranges))
+#     shard.merge_shards(corpus_id, path, len(df_ranges))
+# (or shard.run(..., merge=True) for the last two)
+
+
+
+# per-session stages, run on each shard in this order (features only for
+# switchboard, lms need srilm)
+STAGES = ['features', 'chunk_pairs', 'tokens', 'lms', 'measures']
+# tables copied entirely into every shard, and tables copied only for the
+# sessions of a shard (with condition selecting those rows, formatted with the
+# shard's range of session ids, see split); all other tables
+# are (re)computed per shard
+_GLOBAL_TABLES = ['speakers', 'topics', 'sessions', 'complete_features']
+_SESSION_TABLES = [
+    ('tasks', 'ses_id BETWEEN %(first_ses_id)d AND %(last_ses_id)d'),
+    ('turns', 'tsk_id IN (SELECT tsk_id FROM shard.tasks)'),
+    ('chunks', 'tur_id IN (SELECT tur_id FROM shard.turns)'),
+    ('chunk_features', 'chu_id IN (SELECT chu_id FROM shard.chunks)')
+]
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _get_shard_path(path, shard):
+    ''' returns directory (with trailing "/") of given shard '''
+    return '%sshard_%03d/' % (path, shard)
+
+
+def _set_paths(corpus_id, shard_path):
+    ''' points cfg to given shard, returns previous values (see _reset_paths)
+
+    (database, lm, vocabulary, and dump paths of given corpus)
+    '''
+    paths = {
+        'DB_FNAME_': shard_path + corpus_id.lower() + '.db',
+        'LMN_PATH_': shard_path + 'lm_ngrams/',
+        'VOCAB_FNAME_': shard_path + 'lm_ngrams/vocab.txt',
+        'DUMP_PATH_': shard_path + 'dumps/'
+    }
+    prev = {}
+    for name, value in paths.items():
+        prev[name + corpus_id] = getattr(cfg, name + corpus_id)
+        setattr(cfg, name + corpus_id, value)
+    return prev
+
+
+def _reset_paths(prev):
+    ''' resets cfg paths as returned by _set_paths '''
+    for name, value in prev.items():
+        setattr(cfg, name, value)
+
+
+def _copy_lmn_files(corpus_id, ses_ids, tsk_ids, src, dst, exts):
+    ''' copies token/lm/count files of given sessions and tasks, if any '''
+    for tsk_or_ses, tsk_ses_ids in [('ses', ses_ids), ('tsk', tsk_ids)]:
+        for tsk_ses_id in tsk_ses_ids:
+            for a_or_b in ['A', 'B']:
+                _, fname = fio.get_lmn_pfn(
+                    corpus_id, tsk_or_ses, tsk_ses_id, a_or_b)
+                for ext in exts:
+                    if os.path.isfile(src + fname + ext):
+                        shutil.copyfile(src + fname + ext, dst + fname + ext)
+
+
+def _copy_schema(table, src, dst):
+    ''' creates table (and its indices) of attached database src in dst
+
+    returns:
+        whether table exists in src (e.g., no topics in the games corpus)
+    '''
+    schema = db.dbc.execute(
+        'SELECT type, sql\n'
+        'FROM   %s.sqlite_master\n'
+        'WHERE  tbl_name == ?\n'
+        'AND    sql IS NOT NULL\n'
+        'ORDER BY type DESC;' % src, (table,)).fetchall()
+    for obj_type, sql in schema:
+        # same statement, with schema name of dst (no-op if it exists)
+        obj_type = obj_type.upper()
+        db.dbc.execute(re.sub(
+            r'^CREATE (UNIQUE )?%s (IF NOT EXISTS )?"?(\w+)"?' % obj_type,
+            r'CREATE \1%s IF NOT EXISTS %s.\3' % (obj_type, dst),
+            sql.strip()))
+    return len(schema) > 0
+
+
+def _map_shards(func, args, n_jobs):
+    ''' returns func applied to each tuple of arguments, in parallel '''
+    if n_jobs == 1:
+        return [func(*a) for a in args]
+    with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+        return list(executor.map(func, *zip(*args)))
+
+
+def _get_ses_tsk_ids(schema='main'):
+    ''' returns session and task ids with tasks in given (attached) database '''
+    df = db.pd_read_sql_query('SELECT ses_id, tsk_id FROM %s.tasks;' % schema)
+    return sorted(set(df['ses_id'])), sorted(df['tsk_id'])
+
+
+def _run_shard(func, corpus_id, shard_path, *args):
+    ''' runs func on given shard (in any process)
+
+    cfg paths and the global connection (if any) are restored afterwards
+    '''
+    prev = _set_paths(corpus_id, shard_path)
+    dbc = db.dbc
+    try:
+        db.connect(corpus_id)
+        try:
+            return func(corpus_id, *args)
+        finally:
+            db.close()
+    finally:
+        db.dbc = dbc
+        _reset_paths(prev)
+
+
+def _prepare(corpus_id, stages):
+    ''' runs the first phase on the connected shard (see prepare_shard) '''
+    ses_ids, _ = _get_ses_tsk_ids()
+    if 'features' in stages:
+        assert corpus_id == cfg.CORPUS_ID_SB, 'features only for switchboard'
+        # sb.extract_features connects to the database itself
+        db.close()
+        for ses_id in ses_ids:
+            sb.extract_features(ses_id)
+        db.connect(corpus_id)
+    if 'chunk_pairs' in stages:
+        db.executescript(cfg.SQL_PATH, cfg.SQL_AT_FNAME)
+    if 'tokens' in stages:
+        fio.store_tokens(corpus_id)
+    ap.store_feature_stats()
+    vocab = []
+    if os.path.isfile(cfg.get_vocab_fname(corpus_id)):
+        with open(cfg.get_vocab_fname(corpus_id)) as vocab_file:
+            vocab = [w for w in vocab_file.read().split('\n') if w != '']
+    return vocab, db.pd_read_sql_query('SELECT * FROM feature_moments;')
+
+
+def _measure(corpus_id, stages, vocab, df_moments, nrm_type):
+    ''' runs the second phase on the connected shard (see measure_shard) '''
+    ses_ids, _ = _get_ses_tsk_ids()
+    if vocab is not None:
+        with open(cfg.get_vocab_fname(corpus_id), 'w') as vocab_file:
+            vocab_file.write('\n'.join(vocab))
+    # moments of all shards, so that features are normalized across shards
+    db.dbc.execute('DELETE FROM feature_moments;')
+    db.dbc.executemany(
+        'INSERT INTO feature_moments (ses_id, spk_id, feature, n, mean, m2)\n'
+        'VALUES (?, ?, ?, ?, ?, ?);',
+        df_moments[['ses_id', 'spk_id', 'feature', 'n', 'mean', 'm2']]
+        .astype(object).where(pd.notna(df_moments), None).values.tolist())
+    db.commit()
+    if 'lms' in stages:
+        lex.store_lms_ngrams(corpus_id, ses_ids=ses_ids)
+    if 'measures' not in stages:
+        return None
+    df_bt = ap.load_data(nrm_type, stored_stats=nrm_type != cfg.NRM_RAW)
+    # sums are not shifted, sums of all shards can be added up
+    return ap.get_local_sums(df_bt)
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def split(corpus_id, path, n_shards):
+    ''' splits the connected (main) corpus database into shards
+
+    sessions are split into n_shards ranges of session ids with about the
+    same number of chunks each; each shard gets a directory in path with a
+    database (global tables and tables of its sessions, see _GLOBAL_TABLES
+    and _SESSION_TABLES) and a directory for tokens and lms, into which
+    existing token, lm, and vocabulary files of its sessions are copied
+
+    args:
+        corpus_id: corpus of the connected database
+        path: directory (with trailing "/") for shards (overwritten)
+        n_shards: number of shards (at most; fewer if single sessions have
+            more than a shard's share of chunks)
+    returns:
+        pandas dataframe with first and last session id and number of
+        sessions and chunks per shard (indexed by shard)
+    '''
+    df_ses = db.pd_read_sql_query(
+        'SELECT ses.ses_id,\n'
+        '       COUNT(chu.chu_id) n_chunks\n'
+        'FROM   sessions ses\n'
+        'LEFT JOIN tasks tsk\n'
+        'ON     ses.ses_id == tsk.ses_id\n'
+        'LEFT JOIN turns tur\n'
+        'ON     tsk.tsk_id == tur.tsk_id\n'
+        'LEFT JOIN chunks chu\n'
+        'ON     tur.tur_id == chu.tur_id\n'
+        'GROUP BY ses.ses_id\n'
+        'ORDER BY ses.ses_id;')
+    assert n_shards > 0, 'at least one shard'
+    # contiguous ranges with about equally many chunks: shard of a session by
+    # the chunks before it, empty shards (sessions larger than a shard) dropped
+    n_before = np.cumsum(df_ses['n_chunks'].values) - df_ses['n_chunks'].values
+    shards = n_before * n_shards // max(df_ses['n_chunks'].sum(), 1)
+    _, shards = np.unique(shards, return_inverse=True)
+    df_ses['shard'] = shards
+    df_ranges = df_ses.groupby('shard').agg(
+        first_ses_id=('ses_id', 'min'), last_ses_id=('ses_id', 'max'),
+        n_sessions=('ses_id', 'count'), n_chunks=('n_chunks', 'sum'))
+    lmn_path = cfg.get_lmn_path(corpus_id)
+    # shards get flags of complete chunks for the analyzed features
+    db.set_complete()
+    db.commit()
+    for shard, row in df_ranges.iterrows():
+        shard_path = _get_shard_path(path, shard)
+        if os.path.isdir(shard_path):
+            shutil.rmtree(shard_path)
+        os.makedirs(shard_path + 'lm_ngrams/')
+        os.makedirs(shard_path + 'dumps/')
+        db.dbc.execute('ATTACH DATABASE ? AS shard;', (
+            shard_path + corpus_id.lower() + '.db',))
+        tables = [(t, None) for t in _GLOBAL_TABLES] + _SESSION_TABLES
+        for table, cond in tables:
+            if not _copy_schema(table, 'main', 'shard'):
+                continue
+            db.dbc.execute('INSERT INTO shard.%s SELECT * FROM main.%s%s;' % (
+                table, table,
+                '' if cond is None else '\nWHERE  ' + cond % row.to_dict()))
+        db.commit()
+        ses_ids, tsk_ids = _get_ses_tsk_ids('shard')
+        db.dbc.execute('DETACH DATABASE shard;')
+        _copy_lmn_files(corpus_id, ses_ids, tsk_ids, lmn_path,
+                        shard_path + 'lm_ngrams/',
+                        ['.txt', '.lm', '.cnt', '.sig'])
+        if os.path.isfile(cfg.get_vocab_fname(corpus_id)):
+            shutil.copyfile(cfg.get_vocab_fname(corpus_id),
+                            shard_path + 'lm_ngrams/vocab.txt')
+    return df_ranges
+
+
+def prepare_shard(corpus_id, shard_path, stages=STAGES):
+    ''' runs the first phase of given stages on one shard (in any process)
+
+    features, chunk pairs, tokens (as requested), and raw feature moments
+    (always; see ap.store_feature_stats)
+
+    args:
+        corpus_id: corpus the shard belongs to
+        shard_path: directory of the shard (see split)
+        stages: stages to run (see STAGES)
+    returns:
+        tuple of the shard's vocabulary (list of words, empty if no tokens)
+        and pandas dataframe with its feature moments
+    '''
+    return _run_shard(_prepare, corpus_id, shard_path, stages)
+
+
+def measure_shard(corpus_id, shard_path, vocab, df_moments, stages=STAGES,
+                  nrm_type=cfg.NRM_SPK):
+    ''' runs the second phase of given stages on one shard (in any process)
+
+    stores the merged vocabulary and feature moments of all shards, then
+    computes lms and the sums of the local measures (as requested)
+
+    args:
+        corpus_id: corpus the shard belongs to
+        shard_path: directory of the shard (see split)
+        vocab: vocabulary of all shards (list of words; None to keep the
+            shard's vocabulary file)
+        df_moments: pandas dataframe with feature moments of all shards
+        stages: stages to run (see STAGES)
+        nrm_type: how to normalize features (see cfg.NRM_TYPES)
+    returns:
+        dict with pandas dataframe with sums per task and speaker per local
+        measure (see ap.get_lsim_sums, ap.get_corr_sums), None if measures
+        are not among the stages
+    '''
+    return _run_shard(_measure, corpus_id, shard_path, stages, vocab,
+                      df_moments, nrm_type)
+
+
+def run(corpus_id, path, n_shards, stages=STAGES, nrm_type=cfg.NRM_SPK,
+        n_jobs=None, merge=False):
+    ''' runs given stages on all shards in parallel and merges the results
+
+    args:
+        corpus_id: corpus that was split (see split)
+        path: directory (with trailing "/") of the shards
+        n_shards: number of shards
+        stages: stages to run (see STAGES)
+        nrm_type: how to normalize features (see cfg.NRM_TYPES)
+        n_jobs: number of processes (default: number of cpus; 1 runs all
+            shards in this process)
+        merge: whether to copy the shards' outputs into the main database
+            and directories afterwards (see merge_shards)
+    returns:
+        dict with result dataframe per local measure (lsim, syn, lcon, for
+        all grouping levels; like ap.lsim, ap.syn, ap.lcon), empty if
+        measures are not among the stages
+    '''
+    for stage in stages:
+        assert stage in STAGES, 'unknown stage'
+    shard_paths = [_get_shard_path(path, i) for i in range(n_shards)]
+    res = _map_shards(
+        prepare_shard, [(corpus_id, p, stages) for p in shard_paths], n_jobs)
+    print('shards prepared: %s' % ', '.join(
+        s for s in stages if s in ['features', 'chunk_pairs', 'tokens']))
+    # vocabulary and feature moments of all shards
+    vocab = sorted(set(w for v, _ in res for w in v)) \
+        if 'tokens' in stages else None
+    df_moments = pd.concat([df for _, df in res], ignore_index=True)
+    if vocab is not None:
+        with open(cfg.get_vocab_fname(corpus_id), 'w') as vocab_file:
+            vocab_file.write('\n'.join(vocab))
+    res = _map_shards(measure_shard, [
+        (corpus_id, p, vocab, df_moments, stages, nrm_type)
+        for p in shard_paths], n_jobs)
+    print('shards measured: %s' % ', '.join(
+        s for s in stages if s in ['lms', 'measures']))
+    results = {}
+    if 'measures' in stages:
+        grp_bys = {
+            cfg.MEA_LSIM: cfg.GRP_BYS,
+            cfg.MEA_SYN: [g for g in cfg.GRP_BYS if g != cfg.GRP_BY_SES_TYPE],
+            cfg.MEA_LCON: [cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK]
+        }
+        for mea_id, grp_by in grp_bys.items():
+            df = pd.concat([r[mea_id] for r in res])
+            from_sums = ap.lsim_from_sums if mea_id == cfg.MEA_LSIM \
+                else ap.corr_from_sums
+            results[mea_id] = from_sums(
+                df.index.to_frame(index=False), df.values, grp_by)
+    if merge:
+        merge_shards(corpus_id, path, n_shards, stages)
+    return results
+
+
+def merge_shards(corpus_id, path, n_shards, stages=STAGES):
+    ''' copies outputs of all shards into the connected (main) database
+
+    features (chunk_features), chunk pairs, and feature moments are replaced
+    for the shards' sessions, token, lm, count, and vocabulary files are 
+    copied into the main lm directory (as produced by the given stages), so 
+    that global and lexical measures can be computed on the main database
+
+    args:
+        corpus_id: corpus of the connected database
+        path: directory (with trailing "/") of the shards
+        n_shards: number of shards
+        stages: stages that were run (see STAGES)
+    '''
+    lmn_path = cfg.get_lmn_path(corpus_id)
+    db.commit()
+    for shard in range(n_shards):
+        shard_path = _get_shard_path(path, shard)
+        db.dbc.execute('ATTACH DATABASE ? AS shard;', (
+            shard_path + corpus_id.lower() + '.db',))
+        if 'features' in stages:
+            db.dbc.execute('INSERT OR REPLACE INTO main.chunk_features\n'
+                           'SELECT * FROM shard.chunk_features;')
+        if 'chunk_pairs' in stages:
+            _copy_schema('chunk_pairs', 'shard', 'main')
+            db.dbc.execute(
+                'DELETE\n'
+                'FROM   main.chunk_pairs\n'
+                'WHERE  chu_id2 IN (SELECT chu_id FROM shard.chunks);')
+            db.dbc.execute(
+                'INSERT INTO main.chunk_pairs SELECT * FROM shard.chunk_pairs;')
+        ap._create_moments_table()
+        db.dbc.execute(
+            'INSERT OR REPLACE INTO main.feature_moments\n'
+            'SELECT *\n'
+            'FROM   shard.feature_moments\n'
+            'WHERE  ses_id IN (SELECT ses_id FROM shard.tasks);')
+        db.commit()
+        ses_ids, tsk_ids = _get_ses_tsk_ids('shard')
+        db.dbc.execute('DETACH DATABASE shard;')
+        exts = (['.txt'] if 'tokens' in stages else []) \
+            + (['.lm', '.cnt', '.sig'] if 'lms' in stages else [])
+        _copy_lmn_files(corpus_id, ses_ids, tsk_ids, shard_path + 'lm_ngrams/',
+                        lmn_path, exts)
+    print('merged %d shards' % n_shards)
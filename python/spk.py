@@ -0,0 +1,324 @@
+import numpy as np
+import pandas as pd
+import time
+
+import db
+import lex
+
+# this module determines pairs of speakers (partners and non-partners) whose
+# similarity is compared by the global and lexical entrainment measures
+#
+# the number of non-partners grows with the corpus (each target speaker is
+# paired with all eligible speakers), and so does the number of speaker pairs,
+# roughly quadratically; sample_spk_pairs bounds the non-partners per target
+# (stratified, optionally biased toward speakers of similar entropy as the
+# partner), compare_sampling shows how much results shift by sampling
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _load_sub():
+    ''' loads speaker and partner info per task from both perspectives
+
+    equivalent of the "sub" query in cfg.SQL_SP_FNAME; *_s and *_p refer to
+    speaker and partner, resp.
+
+    returns:
+        pandas dataframe with two rows per task, one per speaker
+    '''
+    df_tsk = db.pd_read_sql_query(
+        'SELECT ses.type ses_type,\n'
+        '       ses.ses_id,\n'
+        '       tsk.tsk_id,\n'
+        '       tsk.a_or_b,\n'
+        '       ses.top_id,\n'
+        '       ses.spk_id_a,\n'
+        '       ses.spk_id_b,\n'
+        '       spk_a.gender gender_a,\n'
+        '       spk_b.gender gender_b\n'
+        'FROM   tasks tsk\n'
+        'JOIN   sessions ses\n'
+        'ON     tsk.ses_id == ses.ses_id\n'
+        'JOIN   speakers spk_a\n'
+        'ON     ses.spk_id_a == spk_a.spk_id\n'
+        'JOIN   speakers spk_b\n'
+        'ON     ses.spk_id_b == spk_b.spk_id;')
+    dfs = []
+    for s, p in [('a', 'b'), ('b', 'a')]:
+        df = df_tsk.loc[:, ['ses_type', 'ses_id', 'tsk_id', 'top_id']]
+        df['spk_id_s'] = df_tsk['spk_id_' + s]
+        df['spk_id_p'] = df_tsk['spk_id_' + p]
+        df['a_or_b_s'] = s.upper()
+        df['a_or_b_p'] = p.upper()
+        df['gender_s'] = df_tsk['gender_' + s]
+        df['gender_p'] = df_tsk['gender_' + p]
+        df['role_s'] = np.where(df_tsk['a_or_b'] == s.upper(), 'd', 'f')
+        dfs += [df]
+    return pd.concat(dfs, ignore_index=True).drop_duplicates()
+
+
+def _pair_keys(spk_ids1, spk_ids2):
+    ''' returns one int key per pair of speaker ids, independent of order '''
+    spk_ids1 = np.asarray(spk_ids1, dtype=np.int64)
+    spk_ids2 = np.asarray(spk_ids2, dtype=np.int64)
+    return (np.minimum(spk_ids1, spk_ids2) << 32) \
+        | np.maximum(spk_ids1, spk_ids2)
+
+
+def _get_interacted():
+    ''' returns hashed set (pandas index) of keys of all interacting pairs '''
+    df_ses = db.pd_read_sql_query('SELECT spk_id_a, spk_id_b FROM sessions;')
+    return pd.Index(_pair_keys(df_ses['spk_id_a'], df_ses['spk_id_b'])).unique()
+
+
+def _to_pairs(df, p_or_x, tsk_or_ses):
+    ''' converts given merged speaker/paired speaker rows to output format '''
+    df_out = pd.DataFrame({
+        'p_or_x': p_or_x,
+        'ses_type': df['ses_type'],
+        'ses_id': df['ses_id'],
+        'tsk_id': df['tsk_id'] if tsk_or_ses == 'tsk' else 0,
+        'spk_id': df['spk_id_s'],
+        'a_or_b': df['a_or_b_s'],
+        'ses_id_paired': df['ses_id_paired'],
+        'tsk_id_paired': df['tsk_id_paired'] if tsk_or_ses == 'tsk' else 0,
+        'spk_id_paired': df['spk_id_paired'],
+        'a_or_b_paired': df['a_or_b_paired']
+    })
+    return df_out.drop_duplicates()
+
+
+def _get_strata(df_spk_pairs):
+    ''' returns stratum per speaker pair, from paired speaker's attributes
+
+    strata are topic, gender, and role (if there is more than one task per
+    session) of the paired speaker in the paired task/session, as integer codes
+    '''
+    df_ses = db.pd_read_sql_query(
+        'SELECT ses_id, top_id FROM sessions;').set_index('ses_id')
+    df_spk = db.pd_read_sql_query(
+        'SELECT spk_id, gender FROM speakers;').set_index('spk_id')
+    df = pd.DataFrame({
+        'top_id': df_ses['top_id'].reindex(
+            df_spk_pairs['ses_id_paired']).values,
+        'gender': df_spk['gender'].reindex(
+            df_spk_pairs['spk_id_paired']).values})
+    if db.get_task_index_count() > 1:
+        df_tsk = db.pd_read_sql_query(
+            'SELECT tsk_id, a_or_b FROM tasks;').set_index('tsk_id')
+        # describer if the paired speaker gives the task's instructions, none
+        # for sessions
+        a_or_b = df_tsk['a_or_b'].reindex(
+            df_spk_pairs['tsk_id_paired']).values
+        df['role'] = np.where(
+            df_spk_pairs['tsk_id_paired'].values == 0, '',
+            np.where(a_or_b == df_spk_pairs['a_or_b_paired'].values, 'd', 'f'))
+    return df.fillna('').astype(str).apply(
+        lambda x: '|'.join(x), axis=1).factorize()[0]
+
+
+def _get_entropy_bias(corpus_id, df_spk_pairs):
+    ''' returns sampling weight per speaker pair, by entropy difference
+
+    raw weights as in lex.get_entropy_weights, i.e., minimum difference of
+    entropy with the actual partner per target over the pair's difference
+    '''
+    df_ent3 = lex.get_entropy_triplets(corpus_id, df_spk_pairs)
+    diffs = abs(df_ent3['entropy_partner'] - df_ent3['entropy_paired'])
+    grp_cols = ['p_or_x', 'ses_id', 'tsk_id', 'spk_id']
+    mins = diffs.groupby([df_ent3[c] for c in grp_cols]).transform('min')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(diffs == 0, 1.0, mins / diffs)
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def get_spk_pairs():
+    ''' determines partner and non-partner pairs of speakers for analysis
+
+    produces the same result as cfg.SQL_SP_FNAME (same columns, rows and
+    order) in seconds instead of minutes: speakers are bucketed by session
+    type, topic, gender of speaker and partner, and role; non-partner
+    candidates are the bucket-wise products of matching buckets (a hash join)
+    and whether two speakers ever interacted is looked up in a precomputed
+    hashed set of speaker pairs, not checked per candidate against sessions
+
+    non-partners of a target speaker must not be the target or their partner,
+    must never have interacted with the target, must have the same gender as
+    the target's partner (and their partner the same gender as the target),
+    must talk about the same topic in the same type of session and must have
+    the role of the target's partner (if there is more than one task per
+    session, otherwise roles are meaningless); session pairs are the distinct
+    task pairs without tsk_id (note: the sql script does not compare session
+    types for session pairs; all sessions in a corpus have the same type)
+
+    returns:
+        pandas dataframe with one row per speaker pair and task/session
+        (tsk_id 0 for sessions) with columns p_or_x, ses_type, ses_id, tsk_id,
+        spk_id, a_or_b and the same (except p_or_x, ses_type) for the paired
+        speaker with suffix "_paired"
+    '''
+    df_sub = _load_sub()
+    # buckets: paired speaker's own attributes must match the target's
+    # partner's attributes, i.e., genders are swapped and roles differ
+    # (roles are ignored if there is only one task per session)
+    keys = ['ses_type', 'top_id', 'gender_s', 'gender_p']
+    if db.get_task_index_count() > 1:
+        keys += ['role_s']
+    df_tgt = df_sub.rename(columns={
+        'gender_s': 'gender_p',
+        'gender_p': 'gender_s'})
+    df_tgt['role_s'] = np.where(df_tgt['role_s'] == 'd', 'f', 'd')
+    df_prd = df_sub.loc[:, keys + ['ses_id', 'tsk_id', 'spk_id_s', 'a_or_b_s']]
+    df_prd = df_prd.rename(columns={
+        'ses_id': 'ses_id_paired',
+        'tsk_id': 'tsk_id_paired',
+        'spk_id_s': 'spk_id_paired',
+        'a_or_b_s': 'a_or_b_paired'})
+    # bucket-wise products of target and paired speakers
+    df_x = df_tgt.merge(df_prd, on=keys)
+    # exclude target, target's partner, and anyone who ever interacted with
+    # the target (the latter includes the partner, checked separately anyway)
+    fltr = (df_x['spk_id_s'] != df_x['spk_id_paired']) \
+        & (df_x['spk_id_p'] != df_x['spk_id_paired']) \
+        & ~pd.Index(_pair_keys(df_x['spk_id_s'], df_x['spk_id_paired'])).isin(
+            _get_interacted())
+    df_x = df_x[fltr]
+    # partners are simply the speakers of the same task
+    df_p = df_sub.assign(
+        ses_id_paired=df_sub['ses_id'],
+        tsk_id_paired=df_sub['tsk_id'],
+        spk_id_paired=df_sub['spk_id_p'],
+        a_or_b_paired=df_sub['a_or_b_p'])
+    # combine, remove duplicates and sort like the union in the sql script
+    df_spk_pairs = pd.concat([
+        _to_pairs(df_x, 'x', 'tsk'),
+        _to_pairs(df_x, 'x', 'ses'),
+        _to_pairs(df_p, 'p', 'tsk'),
+        _to_pairs(df_p, 'p', 'ses')
+    ], ignore_index=True).drop_duplicates()
+    df_spk_pairs.sort_values(list(df_spk_pairs.columns), inplace=True)
+    return df_spk_pairs.reset_index(drop=True)
+
+
+def sample_spk_pairs(df_spk_pairs, k, seed=0, corpus_id=None):
+    ''' samples at most k non-partners per target speaker and task/session
+
+    non-partners are allotted to strata (topic, gender, and role of the paired
+    speaker, see _get_strata) in proportion to their number, largest
+    remainders rounded up; within strata, they are sampled without replacement,
+    uniformly or, given a corpus id, with probability proportional to the
+    entropy weights of lex.get_entropy_weights (using the keys of Efraimidis
+    and Spirakis, rand^(1/weight), of which the k largest are kept); partners
+    are all kept
+
+    args:
+        df_spk_pairs: speaker pairs dataframe as returned by get_spk_pairs
+        k: maximum number of non-partners per target
+        seed: random seed, same sample for same seed and pairs
+        corpus_id: one of the corpus ids in cfg.CORPUS_IDS, to bias sampling
+            toward entropy-matched non-partners (needs lm files, see
+            lex.store_lms_ngrams); uniform sampling if None
+    returns:
+        pandas dataframe with a subset of the rows of df_spk_pairs (same
+        order); column "weight" (if any) renormalized per target
+    '''
+    assert k > 0, 'k must be positive'
+    df = df_spk_pairs.reset_index(drop=True)
+    fltr_x = (df['p_or_x'] == 'x').values
+    df_x = df[fltr_x]
+    tgt = df_x.groupby(['ses_id', 'tsk_id', 'spk_id'], sort=False).ngroup()
+    tgt = tgt.values
+    strata = _get_strata(df_x)
+    grp = pd.Series(list(zip(tgt, strata))).factorize()[0]
+    # quota per target and stratum
+    n_tgt = np.bincount(tgt)
+    n_grp = np.bincount(grp)
+    tgt_grp = np.zeros(len(n_grp), dtype=int)
+    tgt_grp[grp] = tgt
+    exact = np.minimum(k, n_tgt[tgt_grp]) * n_grp / n_tgt[tgt_grp]
+    quota = np.floor(exact + 1e-9).astype(int)
+    rng = np.random.default_rng(seed)
+    missing = np.minimum(k, n_tgt) - np.bincount(
+        tgt_grp, quota, minlength=len(n_tgt)).astype(int)
+    # strata ordered per target by remainder (ties at random), ranked
+    n_strata = np.bincount(tgt_grp, minlength=len(n_tgt))
+    order = np.lexsort((rng.random(len(n_grp)), quota - exact, tgt_grp))
+    rank = np.empty(len(n_grp), dtype=int)
+    rank[order] = np.arange(len(n_grp)) \
+        - np.repeat(np.cumsum(n_strata) - n_strata, n_strata)
+    quota += rank < missing[tgt_grp]
+    # sampling keys, k largest per target and stratum kept
+    keys = np.log(rng.random(len(df_x)))
+    if corpus_id is not None:
+        with np.errstate(divide='ignore'):
+            keys = keys / _get_entropy_bias(corpus_id, df_x)
+    order = np.lexsort((-keys, grp))
+    rank = np.empty(len(df_x), dtype=int)
+    rank[order] = np.arange(len(df_x)) - np.repeat(
+        np.cumsum(n_grp) - n_grp, n_grp)
+    fltr = ~fltr_x
+    fltr[np.flatnonzero(fltr_x)[rank < quota[grp]]] = True
+    df = df[fltr]
+    if 'weight' in df:
+        grp_cols = ['p_or_x', 'ses_id', 'tsk_id', 'spk_id']
+        df = df.assign(
+            weight=df['weight'] / df.groupby(grp_cols)['weight'].transform(
+                'sum'))
+    return df.reset_index(drop=True)
+
+
+def compare_sampling(func, df_spk_pairs, ks, seed=0, corpus_id=None,
+                     stats=['t', 'p', 'dof']):
+    ''' compares results on sampled speaker pairs with exhaustive results
+
+    args:
+        func: function computing results from speaker pairs, returning a
+            pandas dataframe with result tuples, e.g.,
+            lambda df: ap.gsim(df_bt, df)[0]
+        df_spk_pairs: speaker pairs dataframe as returned by get_spk_pairs
+        ks: maximum numbers of non-partners per target to compare
+        seed, corpus_id: see sample_spk_pairs
+        stats: names of the values in the result tuples
+    returns:
+        pandas dataframe with one row per k (None for exhaustive results),
+        result row (index of the results), and result column ("col"), with
+        number of speaker pairs ("n_pairs"), runtime of func in seconds, and
+        per value (e.g., "t") the value, its exhaustive counterpart (e.g.,
+        "t_full"), and difference between the two (e.g., "t_shift")
+    '''
+    def __tidy(df):
+        df = df.stack().rename('vals').reset_index()
+        df = df.rename(columns={df.columns[-2]: 'col'})
+        vals = [tuple(v)[:len(stats)] for v in df['vals']]
+        df[stats] = pd.DataFrame(
+            [v + (np.nan,) * (len(stats) - len(v)) for v in vals],
+            index=df.index, dtype=float)
+        return df.drop('vals', axis=1)
+    dfs = []
+    for k in [None] + list(ks):
+        df = df_spk_pairs if k is None \
+            else sample_spk_pairs(df_spk_pairs, k, seed, corpus_id)
+        start = time.time()
+        df_res = __tidy(func(df))
+        df_res.insert(0, 'seconds', time.time() - start)
+        df_res.insert(0, 'n_pairs', len(df))
+        df_res.insert(0, 'k', k)
+        dfs += [df_res]
+        print('k=%s: %d speaker pairs, %.1fs' % (
+            k, len(df), df_res['seconds'].iloc[0]))
+    key_cols = [c for c in dfs[0].columns
+                if c not in ['k', 'n_pairs', 'seconds'] + stats]
+    df_full = dfs[0].set_index(key_cols)[stats]
+    df = pd.concat(dfs, ignore_index=True).join(
+        df_full, on=key_cols, rsuffix='_full')
+    for s in stats:
+        df[s + '_shift'] = df[s] - df[s + '_full']
+    return df
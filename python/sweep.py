@@ -0,0 +1,242 @@
+import concurrent.futures
+import itertools
+import numpy as np
+import pandas as pd
+
+import ap
+import cfg
+import spk
+
+# this module runs the acoustic-prosodic measures for a grid of configurations
+# (normalization type, feature set, grouping levels) and collects all results
+# in one tidy dataframe
+#
+# the work shared between configurations is done once: the raw data and the
+# chunk pair rows are loaded once (see ap.load_raw_data), features are
+# normalized once per normalization type (see ap.prepare_data), and each
+# measure is computed once per normalization type and grouping, for the union
+# of all feature sets; all measures are computed per feature (including the
+# permutation tests, seeded per feature), so the results for a feature set
+# are those of the union restricted to its features, i.e., the same as if
+# computed on their own
+#
+# typical use (with an open database connection):
+#     configs = sweep.grid([cfg.NRM_SPK, cfg.NRM_GND], [cfg.FEATURES, feats])
+#     df_results = sweep.run(configs)
+
+
+
+# measures available in sweeps, grouping levels each supports (None if the
+# measure has no grouping argument), and names of the values in the result
+# tuples of each (see ap.lsim etc.; empirical p-value "p_perm" if n_perm > 0)
+MEASURES = [cfg.MEA_LSIM, cfg.MEA_SYN, cfg.MEA_LCON, cfg.MEA_GCON, cfg.MEA_GSIM]
+GRP_BYS = {
+    cfg.MEA_LSIM: cfg.GRP_BYS,
+    cfg.MEA_SYN: [g for g in cfg.GRP_BYS if g != cfg.GRP_BY_SES_TYPE],
+    cfg.MEA_LCON: [cfg.GRP_BY_SES, cfg.GRP_BY_SES_SPK],
+    cfg.MEA_GCON: None,
+    cfg.MEA_GSIM: None
+}
+STATS = {
+    cfg.MEA_LSIM: ['t', 'p', 'dof', 'mean'],
+    cfg.MEA_SYN: ['r', 'p', 'dof'],
+    cfg.MEA_LCON: ['r', 'p', 'dof'],
+    cfg.MEA_GCON: ['t', 'p', 'dof'],
+    cfg.MEA_GSIM: ['t', 'p', 'dof']
+}
+# index columns of result dataframes (measures without all of them have 0)
+_KEY_COLS = ['ses_type', 'ses_id', 'tsk_id', 'spk_id']
+# data per normalization type and speaker pairs, set per worker process
+_data = {}
+_df_spk_pairs = None
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _init_worker(data, df_spk_pairs, features):
+    ''' sets data and feature set used by _run_unit (once per process) '''
+    global _data, _df_spk_pairs
+    _data = data
+    _df_spk_pairs = df_spk_pairs
+    cfg.FEATURES = features
+
+
+def _run_unit(nrm_type, mea_id, grp_by, n_perm, seed):
+    ''' computes one measure for one normalization type and grouping
+
+    returns:
+        pandas dataframe with results of the measure (for all features of the
+        sweep), indexed as in ap results
+    '''
+    df_bt = _data[nrm_type]
+    if mea_id == cfg.MEA_LSIM:
+        return ap.lsim(df_bt, list(grp_by), n_perm=n_perm, n_jobs=1, seed=seed)
+    if mea_id == cfg.MEA_SYN:
+        return ap.syn(df_bt, list(grp_by))
+    if mea_id == cfg.MEA_LCON:
+        return ap.lcon(df_bt, list(grp_by))
+    if mea_id == cfg.MEA_GCON:
+        return ap.gcon(df_bt)[0]
+    return ap.gsim(df_bt, _df_spk_pairs, n_perm=n_perm, n_jobs=1, seed=seed)[0]
+
+
+def _get_grp_by_col(df_keys):
+    ''' returns grouping level per result row, from its "all" (0) keys '''
+    grp_bys = pd.Series('all', index=df_keys.index)
+    for grp_by, cols in cfg.GRP_BY_COLS.items():
+        fltr = np.ones(len(df_keys), dtype=bool)
+        for c in _KEY_COLS:
+            fltr &= (df_keys[c] != 0) == (c in cols)
+        grp_bys[fltr] = grp_by
+    return grp_bys
+
+
+def _get_tidy(df, mea_id, features):
+    ''' returns results of one measure as tidy dataframe (row per feature)
+
+    args:
+        df: pandas dataframe with results as returned by _run_unit
+        mea_id: measure of the results
+        features: features to include
+    returns:
+        pandas dataframe with key columns, grouping level ("grp_by"),
+        feature, and one column per value in the result tuples
+    '''
+    df_keys = df.index.to_frame(index=False)
+    for c in _KEY_COLS:
+        if c not in df_keys:
+            df_keys[c] = 0
+    df_keys = df_keys[_KEY_COLS]
+    df_keys['grp_by'] = _get_grp_by_col(df_keys)
+    dfs = []
+    for f in features:
+        vals = [tuple(v) if isinstance(v, tuple) else () for v in df[f]]
+        n_vals = max([len(v) for v in vals] + [0])
+        stats = (STATS[mea_id] + ['p_perm'])[:n_vals]
+        df_f = pd.DataFrame(
+            [v + (np.nan,) * (n_vals - len(v)) for v in vals],
+            columns=stats, dtype=float)
+        df_f.insert(0, 'feature', f)
+        dfs += [pd.concat([df_keys, df_f], axis=1)]
+    return pd.concat(dfs, ignore_index=True)
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def grid(nrm_types=[cfg.NRM_SPK], feature_sets=[cfg.FEATURES], grp_bys=None,
+         measures=MEASURES):
+    ''' returns configurations for all combinations of the given values
+
+    args:
+        nrm_types: normalization types (see cfg.NRM_TYPES)
+        feature_sets: lists of features (subsets of cfg.FEATURES_ALL)
+        grp_bys: lists of grouping levels (each restricted to the levels a
+            measure supports, see GRP_BYS); all supported levels if None
+        measures: measures to compute (see MEASURES)
+    returns:
+        list of dicts, one per configuration, with keys "nrm_type",
+        "features", "grp_by" (None for measures without grouping), and
+        "measure"
+    '''
+    configs = []
+    for nrm_type, features, mea_id in itertools.product(
+            nrm_types, feature_sets, measures):
+        if GRP_BYS[mea_id] is None:
+            options = [None]
+        elif grp_bys is None:
+            options = [GRP_BYS[mea_id]]
+        else:
+            options = [[g for g in grp_by if g in GRP_BYS[mea_id]]
+                       for grp_by in grp_bys]
+            # duplicates after restriction only once, none without levels
+            options = [list(g) for g in dict.fromkeys(
+                tuple(g) for g in options if len(g) > 0)]
+        for grp_by in options:
+            configs += [{'nrm_type': nrm_type, 'features': list(features),
+                         'grp_by': grp_by, 'measure': mea_id}]
+    return configs
+
+
+def run(configs, n_jobs=None, stored_stats=False, n_perm=0, seed=0):
+    ''' computes all configurations, sharing work between them
+
+    data are loaded once, normalized once per normalization type, and each
+    measure is computed once per normalization type and grouping for the
+    union of all features (in parallel; see module comment)
+
+    args:
+        configs: list of configurations as returned by grid (or dicts with
+            the same keys)
+        n_jobs: number of processes (default: number of cpus; 1 runs all in
+            this process)
+        stored_stats: whether to normalize with the statistics stored by
+            ap.store_feature_stats (instead of computing them from the data)
+        n_perm: number of permutations for lsim and gsim (0 for none)
+        seed: random seed for the permutation tests
+    returns:
+        tidy pandas dataframe with one row per configuration (running number
+        "config"), result key (ses_type, ses_id, tsk_id, spk_id, and grouping
+        level "grp_by"), and feature; with nrm_type, measure, and one column
+        per value of the results (see STATS), nan where not applicable
+    '''
+    for config in configs:
+        assert config['measure'] in MEASURES, 'unsupported measure'
+        assert config['nrm_type'] in cfg.NRM_TYPES, 'unknown normalization type'
+        for f in config['features']:
+            assert f in cfg.FEATURES_ALL, 'unknown feature'
+        if GRP_BYS[config['measure']] is not None:
+            cfg.check_grp_by(config['grp_by'], GRP_BYS[config['measure']])
+    # work units: measure per normalization type and grouping
+    units = list(dict.fromkeys(
+        (c['nrm_type'], c['measure'],
+         None if c['grp_by'] is None else tuple(c['grp_by']))
+        for c in configs))
+    features_orig = cfg.FEATURES
+    features = [f for f in cfg.FEATURES_ALL
+                if any(f in c['features'] for c in configs)]
+    try:
+        cfg.FEATURES = features
+        raw_data = ap.load_raw_data()
+        data = {}
+        for nrm_type in dict.fromkeys(u[0] for u in units):
+            df_stats = ap.get_feature_stats(nrm_type) \
+                if stored_stats and nrm_type != cfg.NRM_RAW else None
+            data[nrm_type] = ap.prepare_data(
+                raw_data, nrm_type, ['gender'], df_stats)
+        del raw_data
+        df_spk_pairs = spk.get_spk_pairs() \
+            if any(u[1] == cfg.MEA_GSIM for u in units) else None
+        print('data prepared: %d normalization types, %d features' % (
+            len(data), len(features)))
+        args = [u + (n_perm, seed) for u in units]
+        if n_jobs == 1:
+            _init_worker(data, df_spk_pairs, features)
+            res = [_run_unit(*a) for a in args]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=n_jobs, initializer=_init_worker,
+                    initargs=(data, df_spk_pairs, features)) as executor:
+                res = list(executor.map(_run_unit, *zip(*args)))
+        print('computed %d measures for %d configurations' % (
+            len(units), len(configs)))
+    finally:
+        # data of this process released, cfg restored
+        _init_worker({}, None, features_orig)
+    results = dict(zip(units, res))
+    dfs = []
+    for i, c in enumerate(configs):
+        grp_by = None if c['grp_by'] is None else tuple(c['grp_by'])
+        df = _get_tidy(results[(c['nrm_type'], c['measure'], grp_by)],
+                       c['measure'], c['features'])
+        df.insert(0, 'measure', c['measure'])
+        df.insert(0, 'nrm_type', c['nrm_type'])
+        df.insert(0, 'config', i)
+        dfs += [df]
+    return pd.concat(dfs, ignore_index=True)
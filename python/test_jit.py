@@ -0,0 +1,146 @@
+import math
+import numpy as np
+import pytest
+
+import cfg
+import jit
+
+# this module tests the kernels in jit.py (run with pytest from this directory,
+# with cfg.py configured): the fallback versions against reference versions of
+# the code they replaced (the backoff loop of lex.compute_kld and the turn
+# assignment loop of sb.populate_turns_and_chunks) on random inputs, and, if
+# numba is installed, the compiled versions (cfg.USE_JIT) against the fallbacks
+
+
+
+# random seeds, one set of inputs each
+SEEDS = list(range(10))
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _get_dists(rng, n_types=50):
+    ''' returns two random type distributions with partly shared types '''
+    dists = []
+    for _ in range(2):
+        types = rng.choice(n_types, rng.integers(1, n_types), replace=False)
+        probs = rng.dirichlet(np.ones(len(types)))
+        dists += [{'t%d' % t: p for t, p in zip(types, probs)}]
+    return dists
+
+
+def _kld_ref(p, q):
+    ''' kld with backoff, as lex.compute_kld computed it with dicts (q may be
+    empty, for the empty document) '''
+    P = [dict(p), dict(q)]
+    V = set(P[0].keys()).union(set(P[1].keys()))
+    epsilon = min(min(P[0].values()), min(P[1].values(), default=1.0)) / 10.0
+    for i in [0, 1]:
+        coeff = 1 - (len(V) - len(P[i].keys())) * epsilon
+        for key, val in P[i].items():
+            P[i][key] = coeff * val
+        for t in V:
+            if t not in P[i]:
+                P[i][t] = epsilon
+    kld = 0.0
+    for t in V:
+        kld += (P[0][t]) * math.log(P[0][t] / P[1][t])
+    return kld, epsilon
+
+
+def _kld_args(p, q, epsilon):
+    ''' returns arguments of jit.kld for two distributions (as lex does) '''
+    V = list(set(p.keys()).union(set(q.keys())))
+    return (np.array([p.get(t, 0.0) for t in V]),
+            np.array([q.get(t, 0.0) for t in V]),
+            np.array([t in p for t in V], dtype=bool),
+            np.array([t in q for t in V], dtype=bool),
+            epsilon)
+
+
+def _get_intervals(rng, n=200):
+    ''' returns random, partly overlapping chunks of two speakers, sorted by
+    start time, as speaker index (0 for A, 1 for B) and end time per chunk '''
+    starts = np.sort(rng.uniform(0, n, n))
+    ends = starts + rng.exponential(1.5, n)
+    return rng.integers(0, 2, n), ends
+
+
+def _turns_ref(spk_idx, ends, tur_id):
+    ''' assigns chunks to turns, as sb.populate_turns_and_chunks did per chunk
+
+    returns:
+        list of tuples per chunk: whether it starts a new turn, turn id, turn
+        index, and chunk index
+    '''
+    tur_ids = [tur_id, tur_id]
+    last_ends = [0.0, 0.0]
+    tur_cnts = [0, 0]
+    chu_cnts = [0, 0]
+    res = []
+    for idx, end in zip(spk_idx, ends):
+        new_turn = last_ends[1-idx] > last_ends[idx] \
+            or tur_cnts[1-idx] > tur_cnts[idx] \
+            or tur_cnts[idx] == 0
+        if new_turn:
+            tur_cnts[idx] = max(tur_cnts) + 1
+            tur_ids[idx] = max(tur_ids) + 1
+            chu_cnts[idx] = 1
+        else:
+            chu_cnts[idx] += 1
+        last_ends[idx] = end
+        res += [(new_turn, tur_ids[idx], tur_cnts[idx], chu_cnts[idx])]
+    return res
+
+
+
+################################################################################
+#                                    TESTS                                     #
+################################################################################
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_kld(seed):
+    p, q = _get_dists(np.random.default_rng(seed))
+    for q_seed in [q, {}]:
+        kld, epsilon = _kld_ref(p, q_seed)
+        res = jit.kld(*_kld_args(p, q_seed, epsilon), use_jit=False)
+        assert res == pytest.approx(kld, rel=1e-12, abs=1e-15)
+
+
+@pytest.mark.parametrize('seed', SEEDS)
+def test_turns(seed):
+    spk_idx, ends = _get_intervals(np.random.default_rng(seed))
+    tur_id = seed * 100
+    res = jit.turns(spk_idx, ends, tur_id, use_jit=False)
+    assert list(zip(*[r.tolist() for r in res])) \
+        == _turns_ref(spk_idx.tolist(), ends.tolist(), tur_id)
+
+
+@pytest.mark.skipif(not jit.is_available(), reason='numba not installed')
+@pytest.mark.parametrize('seed', SEEDS)
+def test_kld_jit(seed, monkeypatch):
+    p, q = _get_dists(np.random.default_rng(seed))
+    for q_seed in [q, {}]:
+        _, epsilon = _kld_ref(p, q_seed)
+        args = _kld_args(p, q_seed, epsilon)
+        monkeypatch.setattr(cfg, 'USE_JIT', False)
+        res_np = jit.kld(*args)
+        monkeypatch.setattr(cfg, 'USE_JIT', True)
+        assert jit._get_kernel('kld') is not jit.KERNELS['kld'][0]
+        assert jit.kld(*args) == pytest.approx(res_np, rel=1e-12, abs=1e-15)
+
+
+@pytest.mark.skipif(not jit.is_available(), reason='numba not installed')
+@pytest.mark.parametrize('seed', SEEDS)
+def test_turns_jit(seed, monkeypatch):
+    spk_idx, ends = _get_intervals(np.random.default_rng(seed))
+    monkeypatch.setattr(cfg, 'USE_JIT', False)
+    res_np = jit.turns(spk_idx, ends, seed)
+    monkeypatch.setattr(cfg, 'USE_JIT', True)
+    assert jit._get_kernel('turns') is not jit.KERNELS['turns'][0]
+    for r_jit, r_np in zip(jit.turns(spk_idx, ends, seed), res_np):
+        assert np.array_equal(r_jit, r_np)
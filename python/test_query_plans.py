@@ -0,0 +1,39 @@
+import pytest
+
+import cfg
+import db
+
+# this module tests that no query in db.py and sql/ falls back to a full scan
+# (run with pytest from this directory, with cfg.py configured, see
+# db.check_query_plans), apart from the outer loops of the statements listed
+# in db.FULL_SCANS_ALLOWED
+
+
+
+################################################################################
+#                                    TESTS                                     #
+################################################################################
+
+@pytest.fixture
+def empty_db(monkeypatch):
+    ''' points the global connection to an empty, initialized database '''
+    monkeypatch.setattr(db, 'dbc', db.DatabaseConnection(':memory:'))
+    db.executescript(cfg.SQL_PATH, cfg.SQL_INIT_FNAME_SB)
+
+
+def test_query_plans():
+    assert db.check_query_plans() == []
+
+
+def test_full_scans(empty_db):
+    sql_stmt = 'SELECT chu_id FROM chunks WHERE words == ?;'
+    assert db.find_full_scans(sql_stmt, ('',)) == ['SCAN chunks']
+    assert db.find_full_scans(sql_stmt, ('',), allowed=['chunks']) == []
+    # scan in a nested loop, never acceptable
+    sql_stmt = \
+        'SELECT chu1.chu_id\n' \
+        'FROM   chunks chu1\n' \
+        'JOIN   chunks chu2\n' \
+        'ON     chu1.words != chu2.words;'
+    assert db.find_full_scans(sql_stmt, allowed=['chu1', 'chu2']) \
+        == ['SCAN chu2']
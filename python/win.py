@@ -0,0 +1,186 @@
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+import ap
+import cfg
+
+# this module computes time-resolved entrainment: local similarity (lsim),
+# synchrony (syn), and global similarity between partners (gsim, similarity of
+# the speakers' mean feature values) in sliding windows over each session,
+# yielding one trajectory per session, measure, and feature
+#
+# windows are not grouped one by one: the sums the measures are based on (see
+# ap.get_lsim_sums, ap.get_corr_sums) are computed once per row, sorted by
+# session and position, and accumulated into prefix sums; the sums of any
+# window are then the difference of two prefix sums, found by binary search,
+# so all windows of all sessions cost about as much as one batch pass
+
+
+
+# units of window size and step: seconds (start times of chunks) or turns
+# (index of the turn in the session)
+UNIT_TIME = 'time'
+UNIT_TURN = 'turn'
+UNITS = [UNIT_TIME, UNIT_TURN]
+# measures computed per window
+MEASURES = [cfg.MEA_LSIM, cfg.MEA_SYN, cfg.MEA_GSIM]
+
+
+
+################################################################################
+#                                AUX FUNCTIONS                                 #
+################################################################################
+# auxiliary functions used only internally within this module
+
+def _get_windows(df_chu, pos_col, size, step):
+    ''' determines sliding windows per session
+
+    windows start at the first position of a session and are shifted by step
+    until the last position is covered (at least one window per session)
+
+    args:
+        df_chu: pandas dataframe with ses_type, ses_id, and position per chunk
+        pos_col: name of the position column
+        size, step: window size and step (same unit as positions)
+    returns:
+        pandas dataframe with ses_type, ses_id, window (running number per
+        session), start, and end (exclusive) per window
+    '''
+    df_ses = df_chu.groupby(['ses_type', 'ses_id'])[pos_col].agg(['min', 'max'])
+    n_win = 1 + np.ceil(np.maximum(
+        df_ses['max'] - df_ses['min'] - size, 0) / step).astype(int)
+    df_win = df_ses.loc[df_ses.index.repeat(n_win)].reset_index()
+    df_win['window'] = df_win.groupby('ses_id').cumcount()
+    df_win['start'] = df_win['min'] + df_win['window'] * step
+    df_win['end'] = df_win['start'] + size
+    return df_win.drop(['min', 'max'], axis=1)
+
+
+def _window_sums(df_win, ses_ids, pos, sums):
+    ''' returns sums over all rows within each window, from prefix sums
+
+    args:
+        df_win: pandas dataframe with windows as returned by _get_windows
+        ses_ids, pos: numpy arrays with session and position per row
+        sums: numpy array with sums per row (rows) and column
+    returns:
+        numpy array with sums per window (rows) and column
+    '''
+    # rows sorted by session (as ordered in df_win) and position, and windows
+    # located by binary search on (session, position) pairs as one key
+    ses = pd.Index(df_win['ses_id'].unique()).get_indexer(ses_ids)
+    ses_win = pd.Index(df_win['ses_id'].unique()).get_indexer(df_win['ses_id'])
+    fltr = ses >= 0
+    ses, pos, sums = ses[fltr], pos[fltr], sums[fltr]
+    offset = min(pos.min(initial=0), df_win['start'].min())
+    span = max(pos.max(initial=0), df_win['end'].max()) - offset + 1
+    keys = ses * span + (pos - offset)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    prefix = np.vstack([
+        np.zeros((1, sums.shape[1])), np.cumsum(sums[order], axis=0)])
+    lo = np.searchsorted(keys, ses_win * span + (df_win['start'] - offset))
+    hi = np.searchsorted(keys, ses_win * span + (df_win['end'] - offset))
+    return prefix[hi] - prefix[lo]
+
+
+
+################################################################################
+#                                MAIN FUNCTIONS                                #
+################################################################################
+
+def windows(df_bt, size, step=None, unit=UNIT_TIME, measures=MEASURES):
+    ''' computes entrainment measures in sliding windows over each session
+
+    args:
+        df_bt: "big table" pandas dataframe as returned by ap.load_data
+        size: window size, in seconds or turns (see unit)
+        step: offset between consecutive windows (default: size / 2)
+        unit: UNIT_TIME (windows by chunk start time) or UNIT_TURN (by
+            turn_index_ses); turn exchanges belong to the window of their
+            turn-initial chunk
+        measures: list of measures to compute (see MEASURES)
+    returns:
+        pandas dataframe indexed by ses_type, ses_id, and window, with start
+        and end (exclusive) of each window, number of chunks ("n_chu") and
+        turn exchanges ("n_exc"), and per feature (as requested):
+        - lsim: mean local similarity, t-statistic, and p-value ("*_lsim",
+          "*_lsim_t", "*_lsim_p"; see ap.lsim)
+        - syn: r-value and p-value ("*_syn_r", "*_syn_p"; see ap.syn)
+        - gsim: similarity between the partners' mean values ("*_gsim")
+    '''
+    assert unit in UNITS, 'unknown unit'
+    for mea_id in measures:
+        assert mea_id in MEASURES, 'unsupported measure'
+    step = size / 2 if step is None else step
+    assert size > 0 and step > 0, 'window size and step must be positive'
+    pos_col = 'start_time' if unit == UNIT_TIME else 'turn_index_ses'
+    # one row per chunk (not per chunk pair)
+    df_chu = df_bt[df_bt['p_or_x'] != 'x']
+    df_win = _get_windows(df_chu, pos_col, size, step)
+    df_win['n_chu'] = _window_sums(
+        df_win, df_chu['ses_id'].values, df_chu[pos_col].values,
+        np.ones((len(df_chu), 1)))[:, 0].astype(int)
+    # turn exchanges, one row per turn-initial chunk
+    df_p = df_bt[df_bt['p_or_x'] == 'p']
+    df_win['n_exc'] = _window_sums(
+        df_win, df_p['ses_id'].values, df_p[pos_col].values,
+        np.ones((len(df_p), 1)))[:, 0].astype(int)
+    cols = {}
+    if cfg.MEA_LSIM in measures:
+        df_sims = ap.get_lsim_sims(df_bt).reset_index()
+        df_sims = df_sims.join(
+            df_p.set_index('chu_id')[pos_col].rename('_pos'), on='chu_id')
+        sims_p = df_sims[[f + '_sim_p' for f in cfg.FEATURES]].values
+        sims_x = df_sims[[f + '_sim_x' for f in cfg.FEATURES]].values
+        with np.errstate(invalid='ignore'):
+            shift = np.nan_to_num(np.nanmean(sims_p - sims_x, axis=0))
+        _, t, p, lsim_means = ap.lsim_stats(_window_sums(
+            df_win, df_sims['ses_id'].values, df_sims['_pos'].values,
+            ap.get_lsim_sums(sims_p, sims_x, shift)), shift)
+        for j, f in enumerate(cfg.FEATURES):
+            cols[f + '_lsim'] = lsim_means[:, j]
+            cols[f + '_lsim_t'] = t[:, j]
+            cols[f + '_lsim_p'] = p[:, j]
+    if cfg.MEA_SYN in measures:
+        _, r, p = ap.corr_stats(_window_sums(
+            df_win, df_p['ses_id'].values, df_p[pos_col].values,
+            ap.get_corr_sums(
+                df_p[cfg.FEATURES].values.astype(float),
+                df_p[[f + '_paired' for f in cfg.FEATURES]].values.astype(
+                    float))))
+        for j, f in enumerate(cfg.FEATURES):
+            cols[f + '_syn_r'] = r[:, j]
+            cols[f + '_syn_p'] = p[:, j]
+    if cfg.MEA_GSIM in measures:
+        # mean feature values per speaker (a/b) and window, nan if missing
+        means = []
+        for a_or_b in ['A', 'B']:
+            df = df_chu[df_chu['speaker_a_or_b'] == a_or_b]
+            X = df[cfg.FEATURES].values.astype(float)
+            sums = _window_sums(
+                df_win, df['ses_id'].values, df[pos_col].values,
+                np.hstack([pd.notna(X), np.nan_to_num(X)]))
+            n, s = np.split(sums, 2, axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                means += [s / n]
+        for j, f in enumerate(cfg.FEATURES):
+            cols[f + '_gsim'] = -abs(means[0][:, j] - means[1][:, j])
+    df_win = pd.concat([df_win, pd.DataFrame(cols)], axis=1)
+    return df_win.set_index(['ses_type', 'ses_id', 'window'])
+
+
+def plot(df_win, ses_id, col):
+    ''' plots trajectory of a column (e.g., "pitch_mean_lsim") in a session '''
+    df = df_win.xs(ses_id, level=1)
+    fig, ax = plt.subplots()
+    ax.plot((df['start'] + df['end']) / 2, df[col], 'o-')
+    ax.axhline(0, color='gray', linewidth=0.5)
+    fig.set_size_inches(8, 4)
+    plt.xlabel('window center', fontsize=14)
+    plt.ylabel(col, fontsize=14)
+    plt.grid()
+    plt.tight_layout()
+    plt.show()
+    plt.close()
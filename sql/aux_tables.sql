@@ -15,6 +15,11 @@
 -- note 2: 
 --     selection of non-adjacent turn exchanges involves randomness;
 --     code assumes continuous timestamps per session, no reset per task!
+-- note 3:
+--     if table ses_todo lists any sessions, only their chunk pairs are 
+--     (re)computed and those of all other sessions are kept (see inc.py); 
+--     otherwise, chunk pairs are computed for all sessions; either way, pairs 
+--     of sessions that no longer exist are deleted and ses_todo is emptied
 
 
 
@@ -23,7 +28,53 @@ DROP TABLE IF EXISTS consecutive_3_chunks;
 DROP TABLE IF EXISTS tmp;
 DROP TABLE IF EXISTS tmp2;
 DROP TABLE IF EXISTS tmp3;
-DROP TABLE IF EXISTS chunk_pairs;
+DROP TABLE IF EXISTS ses_sel;
+
+
+
+CREATE TABLE IF NOT EXISTS ses_todo (
+    -- sessions to process in the next run of this script (see note 3)
+    ses_id    INTEGER NOT NULL,
+    PRIMARY KEY (ses_id)
+);
+
+
+
+CREATE TABLE ses_sel
+AS
+-- sessions processed in this run (see note 3)
+SELECT ses_id
+FROM   sessions
+WHERE  ses_id IN (SELECT ses_id FROM ses_todo)
+OR     NOT EXISTS (SELECT 1 FROM ses_todo);
+
+CREATE UNIQUE INDEX ses_sel_pk ON ses_sel (ses_id);
+
+
+
+CREATE TABLE IF NOT EXISTS chunk_pairs (
+    -- pairs of turn-final and turn-initial chunks (see insert below)
+    p_or_x     TEXT,
+    chu_id1    INTEGER,
+    chu_id2    INTEGER,
+    rid        INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS chp_chu_fk1 ON chunk_pairs (chu_id1);
+CREATE INDEX IF NOT EXISTS chp_chu_fk2 ON chunk_pairs (chu_id2);
+
+DELETE 
+FROM   chunk_pairs
+-- keep only pairs of sessions that still exist and are not processed again
+WHERE  chu_id2 NOT IN (
+           SELECT chu.chu_id
+           FROM   chunks chu
+           JOIN   turns tur
+           ON     chu.tur_id == tur.tur_id
+           JOIN   tasks tsk
+           ON     tur.tsk_id == tsk.tsk_id
+           WHERE  tsk.ses_id NOT IN (SELECT ses_id FROM ses_sel)
+       );
 
 
 
@@ -37,7 +88,10 @@ WITH chu_last AS
  FROM   chunks chu
  JOIN   turns tur
  ON     chu.tur_id == tur.tur_id
- WHERE  NOT EXISTS (
+ JOIN   tasks tsk
+ ON     tur.tsk_id == tsk.tsk_id
+ WHERE  tsk.ses_id IN (SELECT ses_id FROM ses_sel)
+ AND    NOT EXISTS (
                     SELECT 1
                     FROM   chunks chu2
                     JOIN   turns tur2
@@ -52,7 +106,10 @@ tur_last AS
  -- id for all turns which are last in their task
  SELECT tur.tur_id
  FROM   turns tur
- WHERE  NOT EXISTS (
+ JOIN   tasks tsk
+ ON     tur.tsk_id == tsk.tsk_id
+ WHERE  tsk.ses_id IN (SELECT ses_id FROM ses_sel)
+ AND    NOT EXISTS (
                     SELECT 1
                     FROM   turns tur2
                     WHERE  tur.tsk_id == tur2.tsk_id
@@ -66,9 +123,7 @@ chu AS
         tsk.tsk_id,
         ses.ses_id,
         CASE 
-            WHEN tur.speaker_role == 'd' AND tsk.a_or_b == 'A'
-            THEN spk_a.spk_id
-            WHEN tur.speaker_role == 'f' AND tsk.a_or_b == 'B'
+            WHEN tur.speaker_a_or_b == 'A'
             THEN spk_a.spk_id
             ELSE spk_b.spk_id
         END spk_id,
@@ -76,17 +131,9 @@ chu AS
         tur.turn_index,
         tsk.task_index,
         tur.speaker_role,
+        tur.speaker_a_or_b a_or_b,
         CASE 
-            WHEN tur.speaker_role == 'd' AND tsk.a_or_b == 'A'
-            THEN 'A'
-            WHEN tur.speaker_role == 'f' AND tsk.a_or_b == 'B'
-            THEN 'A'
-            ELSE 'B'
-        END a_or_b,
-        CASE 
-            WHEN tur.speaker_role == 'd' AND tsk.a_or_b == 'A'
-            THEN spk_a.gender
-            WHEN tur.speaker_role == 'f' AND tsk.a_or_b == 'B'
+            WHEN tur.speaker_a_or_b == 'A'
             THEN spk_a.gender
             ELSE spk_b.gender
         END gender,
@@ -102,23 +149,8 @@ chu AS
             THEN 1
             ELSE 0
         END is_last_in_task,
-        CASE
-            WHEN chu.pitch_min IS NOT NULL 
-            AND  chu.pitch_max IS NOT NULL 
-            AND  chu.pitch_mean IS NOT NULL 
-            AND  chu.pitch_std IS NOT NULL 
-            AND  chu.intensity_min IS NOT NULL 
-            AND  chu.intensity_max IS NOT NULL 
-            AND  chu.intensity_mean IS NOT NULL 
-            AND  chu.intensity_std IS NOT NULL 
-            AND  chu.rate_vcd IS NOT NULL 
-            AND  chu.rate_syl IS NOT NULL 
-            AND  chu.jitter IS NOT NULL 
-            AND  chu.shimmer IS NOT NULL 
-            AND  chu.nhr IS NOT NULL 
-            THEN 1
-            ELSE 0
-        END has_all_features
+        -- all analyzed features, see db.set_complete
+        COALESCE(chf.complete, 0) has_all_features
  FROM   chunks chu
  JOIN   turns tur
  ON     chu.tur_id == tur.tur_id
@@ -130,10 +162,13 @@ chu AS
  ON     ses.spk_id_a == spk_a.spk_id
  JOIN   speakers spk_b
  ON     ses.spk_id_b == spk_b.spk_id
+ LEFT JOIN chunk_features chf
+ ON     chu.chu_id == chf.chu_id
  LEFT JOIN chu_last
  ON     chu.chu_id == chu_last.chu_id
  LEFT JOIN tur_last
  ON     tur.tur_id == tur_last.tur_id
+ WHERE  ses.ses_id IN (SELECT ses_id FROM ses_sel)
 )
 SELECT chu1.chu_id chu_id1,
        chu2.chu_id chu_id2,
@@ -239,13 +274,12 @@ ON     con1.chu_id2 == con2.chu_id1;
 
 
 
-CREATE TABLE chunk_pairs
-AS
+INSERT INTO chunk_pairs
 -- pairs of turn-final and turn-initial chunks;
 -- used to compute local entrainment measures;
 -- some are adjacent ('p'), some are not ('x');
 -- all belong to the same session but not necessarily to the same task;
--- this initial create inserts all adjacent and almost adjacent pairs (three 
+-- this initial insert adds all adjacent and almost adjacent pairs (three 
 -- separate selects for different adjacency types; for switchboard and columbia
 -- games corpus, all overlapping turn exchanges are excluded to avoid 
 -- cross-channel contamination; for other corpora, this may not be necessary);
@@ -305,9 +339,6 @@ AND    con.has_all_features2
 -- AND    con.has_all_features3
 ;
 
-CREATE INDEX chp_chu_fk1 ON chunk_pairs (chu_id1);
-CREATE INDEX chp_chu_fk2 ON chunk_pairs (chu_id2);
-
 
 
 CREATE TABLE tmp
@@ -323,9 +354,7 @@ WITH chu AS
         chp.chu_id2,
         ses.ses_id,
         CASE 
-            WHEN tur1.speaker_role == 'd' AND tsk1.a_or_b == 'A'
-            THEN ses.spk_id_a
-            WHEN tur1.speaker_role == 'f' AND tsk1.a_or_b == 'B'
+            WHEN tur1.speaker_a_or_b == 'A'
             THEN ses.spk_id_a
             ELSE ses.spk_id_b
         END spk_id1,
@@ -339,6 +368,8 @@ WITH chu AS
  ON     tur1.tsk_id == tsk1.tsk_id
  JOIN   sessions ses
  ON     tsk1.ses_id == ses.ses_id
+ WHERE  chp.p_or_x == 'p'
+ AND    ses.ses_id IN (SELECT ses_id FROM ses_sel)
 )
 SELECT chu_x.chu_id1,
        chu_p.chu_id2
@@ -396,6 +427,8 @@ DROP TABLE tmp2;
 DROP TABLE tmp3;
 DROP TABLE consecutive_2_chunks;
 DROP TABLE consecutive_3_chunks;
+DROP TABLE ses_sel;
+DELETE FROM ses_todo;
 
 
 
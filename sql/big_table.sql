@@ -1,5 +1,7 @@
 -- collects the tables of the normalized, hierarchical schema into a single,
--- unnormalized table with redundant information
+-- unnormalized table with redundant information; transcripts are not
+-- included, chunks are read from a covering index (see indexes.sql) and
+-- features from the narrow chunk_features table
 WITH halfway_points AS
 -- select assumes continuous timestamps per session, no reset per task!
 -- start/end are determined based on *all* chunks, even those missing features
@@ -26,24 +28,14 @@ WITH halfway_points AS
 ), spk AS
 (
  SELECT tur.tur_id,
+        tur.speaker_a_or_b,
         CASE
-            WHEN tsk.a_or_b == "A" AND tur.speaker_role == "d"
-            THEN "A"
-            WHEN tsk.a_or_b == "B" AND tur.speaker_role == "f"
-            THEN "A"
-            ELSE "B"
-        END speaker_a_or_b,
-        CASE
-            WHEN tsk.a_or_b == "A" AND tur.speaker_role == "d"
-            THEN spk_a.spk_id
-            WHEN tsk.a_or_b == "B" AND tur.speaker_role == "f"
+            WHEN tur.speaker_a_or_b == "A"
             THEN spk_a.spk_id
             ELSE spk_b.spk_id
         END spk_id,
         CASE
-            WHEN tsk.a_or_b == "A" AND tur.speaker_role == "d"
-            THEN spk_a.gender
-            WHEN tsk.a_or_b == "B" AND tur.speaker_role == "f"
+            WHEN tur.speaker_a_or_b == "A"
             THEN spk_a.gender
             ELSE spk_b.gender
         END gender
@@ -78,20 +70,19 @@ SELECT ses.ses_id,
        chu.start_time,
        chu.end_time,
        chu.duration,
-       chu.words,
-       chu.pitch_min pitch_min_raw,
-       chu.pitch_max pitch_max_raw,
-       chu.pitch_mean pitch_mean_raw,
-       chu.pitch_std pitch_std_raw,
-       chu.rate_syl rate_syl_raw,
-       chu.rate_vcd rate_vcd_raw,
-       chu.intensity_min intensity_min_raw,
-       chu.intensity_max intensity_max_raw,
-       chu.intensity_mean intensity_mean_raw,
-       chu.intensity_std intensity_std_raw,
-       chu.jitter jitter_raw,
-       chu.shimmer shimmer_raw,
-       chu.nhr nhr_raw,
+       chf.pitch_min pitch_min_raw,
+       chf.pitch_max pitch_max_raw,
+       chf.pitch_mean pitch_mean_raw,
+       chf.pitch_std pitch_std_raw,
+       chf.rate_syl rate_syl_raw,
+       chf.rate_vcd rate_vcd_raw,
+       chf.intensity_min intensity_min_raw,
+       chf.intensity_max intensity_max_raw,
+       chf.intensity_mean intensity_mean_raw,
+       chf.intensity_std intensity_std_raw,
+       chf.jitter jitter_raw,
+       chf.shimmer shimmer_raw,
+       chf.nhr nhr_raw,
        tur.speaker_role,
        tsk.a_or_b,
        ses.type ses_type,
@@ -102,9 +93,7 @@ SELECT ses.ses_id,
        -- other paired info can be loaded for only real/fake turn exchanges  
        -- using extra_cols in ap._load_pairs()
        CASE
-           WHEN tsk.a_or_b == "A" AND tur.speaker_role == "d"
-           THEN spk_b.spk_id
-           WHEN tsk.a_or_b == "B" AND tur.speaker_role == "f"
+           WHEN tur.speaker_a_or_b == "A"
            THEN spk_b.spk_id
            ELSE spk_a.spk_id
        END partner_spk_id
@@ -125,6 +114,10 @@ JOIN   halfway_points hlf_ses
 ON     ses.ses_id == hlf_ses.ses_id
 JOIN   spk
 ON     tur.tur_id == spk.tur_id
+-- features only of chunks that have all analyzed features (null otherwise)
+LEFT JOIN chunk_features chf
+ON     chu.chu_id == chf.chu_id
+AND    chf.complete
 ORDER BY ses.ses_id, tsk.task_index, tur.turn_index, chu.chunk_index;
 
 
@@ -1,4 +1,16 @@
 -- audio for a few switchboard sessions is missing; this deletes them
+DELETE 
+FROM   chunk_features 
+WHERE  chu_id IN (
+    SELECT chu_id
+    FROM   chunks
+    WHERE  tur_id IN (
+        SELECT tur_id 
+        FROM turns 
+        WHERE tsk_id IN (2289, 4361, 4379)
+    )
+);
+
 DELETE 
 FROM   chunks 
 WHERE  tur_id IN (
@@ -0,0 +1,50 @@
+-- covering indexes for the queries in db.py and the other sql scripts;
+-- the same indexes are created by init_gc.sql and init_sb.sql, this script
+-- only needs to be run for databases that were initialized before they existed
+-- (turns.speaker_a_or_b has to exist, see db.add_speaker_a_or_b);
+-- all statements are idempotent, the script can safely be run repeatedly;
+-- db.check_query_plans verifies that no query falls back to a full scan
+
+
+
+-- persisted speaker (A or B) per turn, replaces the CASE expressions over
+-- speaker_role and tasks.a_or_b that previously had to be evaluated per row
+UPDATE turns
+SET speaker_a_or_b = (
+    SELECT CASE
+               WHEN tsk.a_or_b == "A" AND turns.speaker_role == "d"
+               THEN "A"
+               WHEN tsk.a_or_b == "B" AND turns.speaker_role == "f"
+               THEN "A"
+               ELSE "B"
+           END
+    FROM   tasks tsk
+    WHERE  tsk.tsk_id == turns.tsk_id
+)
+WHERE  speaker_a_or_b IS NULL;
+
+
+
+-- "ever interacted" check in speaker_pairs.sql (NOT EXISTS on both speakers)
+CREATE INDEX IF NOT EXISTS ses_spk_ab_ix ON sessions (spk_id_a, spk_id_b);
+-- tasks per session in order, with describer; covers all joins from turns
+CREATE INDEX IF NOT EXISTS tsk_ses_ix ON tasks (
+    ses_id, task_index, tsk_id, a_or_b);
+-- turns of one speaker per task in order (db.find_chunks, db.get_words)
+CREATE INDEX IF NOT EXISTS tur_tsk_spk_ix ON turns (
+    tsk_id, speaker_a_or_b, turn_index, tur_id);
+-- turns per task in order (last turn per task in aux_tables.sql etc.)
+CREATE INDEX IF NOT EXISTS tur_tsk_idx_ix ON turns (
+    tsk_id, turn_index, tur_id, speaker_a_or_b, speaker_role);
+-- chunks per turn in order with timestamps (last chunk per turn in
+-- aux_tables.sql, halfway points in big_table.sql) and duration, so that
+-- big_table.sql reads chunks from this index only, not the table pages with
+-- the transcripts (replaces chu_tur_idx_ix, which lacked duration)
+DROP INDEX IF EXISTS chu_tur_idx_ix;
+CREATE INDEX IF NOT EXISTS chu_tur_time_ix ON chunks (
+    tur_id, chunk_index, chu_id, start_time, end_time, duration);
+
+
+
+-- refresh statistics so the planner picks the indexes above
+ANALYZE;
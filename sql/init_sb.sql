@@ -3,6 +3,7 @@
 --     allows for reuse of code
 
 
+DROP TABLE IF EXISTS chunk_features;
 DROP TABLE IF EXISTS chunks;
 DROP TABLE IF EXISTS turns;
 DROP TABLE IF EXISTS tasks;
@@ -82,6 +83,9 @@ CREATE TABLE turns (
     -- (same as for task, column only included for consistency)
     turn_index_ses    INTEGER NOT NULL,
     speaker_role      TEXT NOT NULL,
+    -- whether speaker "A" or "B" of the session is speaking; redundant with 
+    -- speaker_role and tasks.a_or_b, but persisted so filters can use an index
+    speaker_a_or_b    TEXT NOT NULL,
     PRIMARY KEY (tur_id),
     FOREIGN KEY (tsk_id) REFERENCES tasks (tsk_id)
 );
@@ -100,6 +104,17 @@ CREATE TABLE chunks (
     -- duration redundant for consistency with games corpus structure
     duration          INTEGER,
     words             TEXT,
+    PRIMARY KEY (chu_id),
+    FOREIGN KEY (tur_id) REFERENCES turns (tur_id)
+);
+
+
+
+CREATE TABLE chunk_features (
+    -- acoustic-prosodic features per chunk, apart from chunks so that scans
+    -- of the features do not read the transcripts; written in bulk as 
+    -- features are extracted (see db.set_features)
+    chu_id            INTEGER NOT NULL,
     pitch_min         NUMERIC,
     pitch_max         NUMERIC,
     pitch_mean        NUMERIC,
@@ -113,8 +128,12 @@ CREATE TABLE chunks (
     jitter            NUMERIC,
     shimmer           NUMERIC,
     nhr               NUMERIC,
+    -- whether all analyzed features (cfg.FEATURES) are set; analysis uses
+    -- only complete chunks ("all or nothing"), set with the features and 
+    -- recomputed when the analyzed features change (see db.set_complete)
+    complete          INTEGER NOT NULL DEFAULT 0,
     PRIMARY KEY (chu_id),
-    FOREIGN KEY (tur_id) REFERENCES turns (tur_id)
+    FOREIGN KEY (chu_id) REFERENCES chunks (chu_id)
 );
 
 
@@ -134,4 +153,15 @@ CREATE INDEX tur_tsk_fk ON turns (tsk_id);
 CREATE UNIQUE INDEX chu_pk ON chunks (chu_id);
 CREATE UNIQUE INDEX chu_uk ON chunks (chu_id, chunk_index);
 CREATE INDEX chu_tur_fk ON chunks (tur_id);
+CREATE UNIQUE INDEX chf_pk ON chunk_features (chu_id);
+-- covering indexes for the joins and filters in db.py and the sql scripts
+-- (see indexes.sql for details; kept in sync with that script)
+CREATE INDEX ses_spk_ab_ix ON sessions (spk_id_a, spk_id_b);
+CREATE INDEX tsk_ses_ix ON tasks (ses_id, task_index, tsk_id, a_or_b);
+CREATE INDEX tur_tsk_spk_ix ON turns (
+    tsk_id, speaker_a_or_b, turn_index, tur_id);
+CREATE INDEX tur_tsk_idx_ix ON turns (
+    tsk_id, turn_index, tur_id, speaker_a_or_b, speaker_role);
+CREATE INDEX chu_tur_time_ix ON chunks (
+    tur_id, chunk_index, chu_id, start_time, end_time, duration);
 